@@ -0,0 +1,91 @@
+"""Add content addressed images
+
+Revision ID: a7c3e5f9b2d8
+Revises: f4a6d8b2c0e5
+Create Date: 2026-10-17 16:52:11.436815
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "a7c3e5f9b2d8"
+down_revision = "f4a6d8b2c0e5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "images",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("hash", sa.Unicode(length=64), nullable=False),
+        sa.Column("path", sa.Unicode(length=200), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_images")),
+        sa.UniqueConstraint("hash", name=op.f("uq_images_hash")),
+    )
+    op.create_table(
+        "image_urls",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("url_hash", sa.Unicode(length=64), nullable=False),
+        sa.Column("url", sa.Unicode(length=10000), nullable=False),
+        sa.Column("image_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["image_id"],
+            ["images.id"],
+            name=op.f("fk_image_urls_image_id_images"),
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_image_urls")),
+        sa.UniqueConstraint("url_hash", name=op.f("uq_image_urls_url_hash")),
+    )
+    op.create_index(
+        op.f("ix_image_urls_image_id"), "image_urls", ["image_id"], unique=False
+    )
+    op.create_table(
+        "listing_images",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("listing_id", sa.Integer(), nullable=False),
+        sa.Column("image_id", sa.Integer(), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["image_id"],
+            ["images.id"],
+            name=op.f("fk_listing_images_image_id_images"),
+            onupdate="CASCADE",
+            ondelete="RESTRICT",
+        ),
+        sa.ForeignKeyConstraint(
+            ["listing_id"],
+            ["listings.id"],
+            name=op.f("fk_listing_images_listing_id_listings"),
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_listing_images")),
+        sa.UniqueConstraint(
+            "listing_id", "position", name=op.f("uq_listing_images_listing_id")
+        ),
+    )
+    op.create_index(
+        op.f("ix_listing_images_image_id"), "listing_images", ["image_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_listing_images_listing_id"),
+        "listing_images",
+        ["listing_id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_listing_images_listing_id"), table_name="listing_images")
+    op.drop_index(op.f("ix_listing_images_image_id"), table_name="listing_images")
+    op.drop_table("listing_images")
+    op.drop_index(op.f("ix_image_urls_image_id"), table_name="image_urls")
+    op.drop_table("image_urls")
+    op.drop_table("images")
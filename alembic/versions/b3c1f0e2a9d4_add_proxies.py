@@ -0,0 +1,36 @@
+"""Add proxies
+
+Revision ID: b3c1f0e2a9d4
+Revises: 7a4074e7d667
+Create Date: 2026-10-17 09:12:44.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b3c1f0e2a9d4"
+down_revision = "7a4074e7d667"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "proxies",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("url", sa.Unicode(length=200), nullable=False),
+        sa.Column("requests", sa.Integer(), nullable=False),
+        sa.Column("successes", sa.Integer(), nullable=False),
+        sa.Column("captchas", sa.Integer(), nullable=False),
+        sa.Column("latency", sa.Float(), nullable=True),
+        sa.Column("fetched_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_proxies")),
+        sa.UniqueConstraint("url", name=op.f("uq_proxies_url")),
+    )
+
+
+def downgrade():
+    op.drop_table("proxies")
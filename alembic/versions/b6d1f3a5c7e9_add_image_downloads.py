@@ -0,0 +1,63 @@
+"""Add image downloads
+
+Revision ID: b6d1f3a5c7e9
+Revises: c8f2a4e6d0b9
+Create Date: 2026-10-17 19:47:52.118364
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "b6d1f3a5c7e9"
+down_revision = "c8f2a4e6d0b9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "image_downloads",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("listing_id", sa.Integer(), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column("url", sa.Unicode(length=10000), nullable=False),
+        sa.Column("status", sa.Unicode(length=10), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("claimed_at", sa.DateTime(), nullable=True),
+        sa.Column("hash", sa.Unicode(length=64), nullable=True),
+        sa.Column("path", sa.Unicode(length=200), nullable=True),
+        sa.Column("size", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["listing_id"],
+            ["listings.id"],
+            name=op.f("fk_image_downloads_listing_id_listings"),
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_image_downloads")),
+        sa.UniqueConstraint(
+            "listing_id", "position", name=op.f("uq_image_downloads_listing_id")
+        ),
+    )
+    op.create_index(
+        op.f("ix_image_downloads_listing_id"),
+        "image_downloads",
+        ["listing_id"],
+        unique=False,
+    )
+    op.create_index(
+        op.f("ix_image_downloads_status"), "image_downloads", ["status"], unique=False
+    )
+    op.add_column(
+        "listings", sa.Column("images_status", sa.Unicode(length=10), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("listings", "images_status")
+    op.drop_index(op.f("ix_image_downloads_status"), table_name="image_downloads")
+    op.drop_index(op.f("ix_image_downloads_listing_id"), table_name="image_downloads")
+    op.drop_table("image_downloads")
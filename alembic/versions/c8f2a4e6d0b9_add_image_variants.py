@@ -0,0 +1,30 @@
+"""Add image variants
+
+Revision ID: c8f2a4e6d0b9
+Revises: a7c3e5f9b2d8
+Create Date: 2026-10-17 18:24:37.905126
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "c8f2a4e6d0b9"
+down_revision = "a7c3e5f9b2d8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "listings",
+        sa.Column(
+            "image_variants", postgresql.JSON(astext_type=sa.Text()), nullable=True
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("listings", "image_variants")
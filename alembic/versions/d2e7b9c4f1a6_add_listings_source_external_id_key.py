@@ -0,0 +1,36 @@
+"""Add a unique key on listings' source and external id
+
+Revision ID: d2e7b9c4f1a6
+Revises: b6d1f3a5c7e9
+Create Date: 2026-10-17 23:41:08.512937
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d2e7b9c4f1a6"
+down_revision = "b6d1f3a5c7e9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest listing of each key. Later listings with the same key lose
+    # their external id, rather than failing the unique constraint.
+    op.execute(
+        "UPDATE listings SET external_listing_id = NULL "
+        "WHERE source IS NOT NULL AND external_listing_id IS NOT NULL "
+        "AND id NOT IN ("
+        "SELECT MIN(id) FROM listings "
+        "WHERE source IS NOT NULL AND external_listing_id IS NOT NULL "
+        "GROUP BY source, external_listing_id"
+        ")"
+    )
+    op.create_unique_constraint(
+        op.f("uq_listings_source"), "listings", ["source", "external_listing_id"]
+    )
+
+
+def downgrade():
+    op.drop_constraint(op.f("uq_listings_source"), "listings", type_="unique")
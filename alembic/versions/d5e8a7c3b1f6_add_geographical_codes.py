@@ -0,0 +1,36 @@
+"""Add geographical codes
+
+Revision ID: d5e8a7c3b1f6
+Revises: b3c1f0e2a9d4
+Create Date: 2026-10-17 11:02:16.583471
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d5e8a7c3b1f6"
+down_revision = "b3c1f0e2a9d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "geographical_codes",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("source", sa.Unicode(length=100), nullable=False),
+        sa.Column("post_code", sa.Unicode(length=10), nullable=False),
+        sa.Column("geo_type", sa.Unicode(length=10), nullable=False),
+        sa.Column("geo_code", sa.Unicode(length=20), nullable=False),
+        sa.Column("fetched_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_geographical_codes")),
+        sa.UniqueConstraint(
+            "source", "post_code", name=op.f("uq_geographical_codes_source")
+        ),
+    )
+
+
+def downgrade():
+    op.drop_table("geographical_codes")
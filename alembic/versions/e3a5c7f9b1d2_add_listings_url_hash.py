@@ -0,0 +1,75 @@
+"""Add listings' url hash
+
+Revision ID: e3a5c7f9b1d2
+Revises: d2e7b9c4f1a6
+Create Date: 2026-10-18 00:37:26.904117
+
+"""
+
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e3a5c7f9b1d2"
+down_revision = "d2e7b9c4f1a6"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def _hash_url(url):
+    # frozen copy of Listing.hash_url, as of this revision
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in [("http", "80"), ("https", "443")]:
+        netloc = netloc.rpartition(":")[0]
+    normalized = urlunsplit((scheme, netloc, parts.path, parts.query, ""))
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def upgrade():
+    op.add_column("listings", sa.Column("url_hash", sa.Unicode(length=32)))
+
+    # backfill, oldest listings first. Later listings with the same url keep a null
+    # hash, rather than failing the unique constraint.
+    conn = op.get_bind()
+    seen = set()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.text(
+                "SELECT id, url FROM listings WHERE id > :last_id "
+                "ORDER BY id LIMIT :batch_size"
+            ),
+            last_id=last_id,
+            batch_size=BATCH_SIZE,
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for id_, url in rows:
+            url_hash = _hash_url(url) if url else None
+            if (url_hash is None) or (url_hash in seen):
+                continue
+            seen.add(url_hash)
+            updates.append({"id": id_, "url_hash": url_hash})
+        if updates:
+            conn.execute(
+                sa.text("UPDATE listings SET url_hash = :url_hash WHERE id = :id"),
+                updates,
+            )
+        last_id = rows[-1][0]
+
+    op.create_unique_constraint(op.f("uq_listings_url_hash"), "listings", ["url_hash"])
+    # only databases created from the models had a unique constraint on the urls
+    op.execute("ALTER TABLE listings DROP CONSTRAINT IF EXISTS uq_listings_url")
+
+
+def downgrade():
+    op.drop_constraint(op.f("uq_listings_url_hash"), "listings", type_="unique")
+    op.drop_column("listings", "url_hash")
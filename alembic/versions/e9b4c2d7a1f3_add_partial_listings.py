@@ -0,0 +1,27 @@
+"""Add partial listings
+
+Revision ID: e9b4c2d7a1f3
+Revises: d5e8a7c3b1f6
+Create Date: 2026-10-17 13:41:05.274118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e9b4c2d7a1f3"
+down_revision = "d5e8a7c3b1f6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "listings",
+        sa.Column("is_partial", sa.Boolean(create_constraint=False), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("listings", "is_partial")
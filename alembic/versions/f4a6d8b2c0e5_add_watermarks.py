@@ -0,0 +1,33 @@
+"""Add watermarks
+
+Revision ID: f4a6d8b2c0e5
+Revises: e9b4c2d7a1f3
+Create Date: 2026-10-17 15:08:37.902641
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f4a6d8b2c0e5"
+down_revision = "e9b4c2d7a1f3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "watermarks",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("source", sa.Unicode(length=100), nullable=False),
+        sa.Column("search", sa.Unicode(length=64), nullable=False),
+        sa.Column("value", sa.Unicode(length=100), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_watermarks")),
+        sa.UniqueConstraint("source", "search", name=op.f("uq_watermarks_source")),
+    )
+
+
+def downgrade():
+    op.drop_table("watermarks")
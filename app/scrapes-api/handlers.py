@@ -12,6 +12,12 @@ from pogam.models import Listing
 
 logger = logging.getLogger("pogam")
 
+# search options that only some of the scrapers accept
+SOURCE_OPTIONS = {
+    "leboncoin": ["incremental", "defer_images", "shard"],
+    "seloger": ["lite"],
+}
+
 
 def _jsonify(status_code, data, message):
     body = {"data": data, "message": message}
@@ -66,6 +72,11 @@ def run(event, context):
                 Payload=json.dumps(data),
             )
         return
+    options = {
+        option: search.pop(option)
+        for option in set(it.chain(*SOURCE_OPTIONS.values()))
+        if option in search
+    }
     app = create_app()
     added_listings: List[Listing] = []
     seen_listings: List[Listing] = []
@@ -73,7 +84,10 @@ def run(event, context):
     for source in sources:
         scraper = getattr(scrapers, source)
         with app.app_context():
-            results = scraper(**search)
+            source_options = {
+                k: v for k, v in options.items() if k in SOURCE_OPTIONS.get(source, [])
+            }
+            results = scraper(**search, **source_options)
 
             added_listings += [listing.to_dict() for listing in results["added"]]
             seen_listings += results["seen"]
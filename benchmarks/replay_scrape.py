@@ -0,0 +1,60 @@
+"""
+Benchmark a scrape, replaying a cassette recorded with `pogam scrape --record`.
+
+The scrape runs against a fresh in-memory database, with the scrapers' pacing and
+backoff turned off, so that the timings reflect our own parsing and engine.
+
+Usage:
+    python benchmarks/replay_scrape.py CASSETTE SOURCE TRANSACTION POST_CODE...
+        [--latency] [--number N]
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+from pogam import create_app, scrapers
+from pogam.scrapers.cassettes import Cassette, full_speed
+
+
+def replay(cassette, source, transaction, post_codes, latency):
+    with tempfile.TemporaryDirectory() as folder:
+        os.environ["POGAM_DATABASE_URL"] = "sqlite://"
+        os.environ["POGAM_PROXY_CACHE"] = os.path.join(folder, "proxies.json")
+        os.environ["POGAM_HTTP_CACHE"] = os.path.join(folder, "http_cache.sqlite")
+        os.environ["POGAM_IMAGES_FOLDER"] = folder
+        with cassette.replay(latency=latency), full_speed():
+            with create_app("cli").app_context():
+                return getattr(scrapers, source)(transaction, post_codes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("cassette")
+    parser.add_argument("source", choices=["leboncoin", "seloger"])
+    parser.add_argument("transaction", choices=["rent", "buy"])
+    parser.add_argument("post_codes", nargs="+")
+    parser.add_argument("--latency", action="store_true")
+    parser.add_argument("--number", type=int, default=3)
+    args = parser.parse_args()
+
+    cassette = Cassette(args.cassette).load()
+    print(f"Replaying {len(cassette.interactions)} recorded requests.")
+
+    results = {}
+
+    def run():
+        results.update(
+            replay(
+                cassette, args.source, args.transaction, args.post_codes, args.latency
+            )
+        )
+
+    seconds = min(timeit.repeat(run, number=1, repeat=args.number))
+    counts = ", ".join(f"{len(v)} {k}" for k, v in results.items())
+    print(f"{seconds:.3f} s per scrape ({counts}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark the extraction of a seloger listing, from its HTML page.
+
+Compares the previous approach (download the whole page, scan it with an uncompiled
+pattern, decode escape sequences one codec call at a time) to the streaming
+extractor of `pogam.scrapers.extractors`.
+
+Usage:
+    python benchmarks/seloger_extractor.py [--number N]
+"""
+
+import argparse
+import codecs
+import os
+import re
+import timeit
+
+from httmock import response  # type: ignore
+
+from pogam.scrapers.extractors import (
+    CONFIG_DETAIL_END,
+    CONFIG_DETAIL_START,
+    ESCAPE_SEQUENCE_RE,
+    SELOGER_FIELDS,
+    SELOGER_NUMERICAL_FIELDS,
+    read_until,
+    seloger_config_detail,
+    seloger_listing,
+)
+
+here = os.path.dirname(__file__)
+fixture = os.path.join(here, "..", "tests", "fixtures", "seloger", "success.html")
+
+
+def _make_response(body):
+    page = response(200, body, headers={"Content-Type": "text/html; charset=utf-8"})
+    page.encoding = "utf-8"
+    return page
+
+
+def legacy(body):
+    page = _make_response(body)
+    is_field = (
+        r"Object\.defineProperty\(\s*ConfigDetail,\s*['\"](.*)['\"],\s*"
+        r"{\s*value:\s*['\"](.*)['\"],\s*enumerable:\s*\S+\s*}"
+    )
+    matches = dict(re.findall(is_field, page.text))
+    data = {field: matches.get(key, None) for field, key in SELOGER_FIELDS.items()}
+    data["description"] = ESCAPE_SEQUENCE_RE.sub(
+        lambda match: codecs.decode(match.group(0), "unicode-escape"),
+        data["description"],
+    )
+    data["bathrooms"] = (
+        float(matches.get("bain", 0) or 0) + float(matches.get("eau", 0) or 0) / 2
+    )
+    data["currency"] = "€"
+    for field in SELOGER_NUMERICAL_FIELDS:
+        try:
+            data[field] = float(data[field].replace(",", "."))
+        except (KeyError, ValueError, AttributeError):
+            pass
+    return data
+
+
+def streaming(body):
+    page = _make_response(body)
+    html = read_until(page, CONFIG_DETAIL_START, CONFIG_DETAIL_END)
+    return seloger_listing(seloger_config_detail(html))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=500)
+    args = parser.parse_args()
+
+    with open(fixture, "rb") as f:
+        body = f.read()
+    assert legacy(body) == streaming(body)
+
+    page = _make_response(body)
+    read = len(read_until(page, CONFIG_DETAIL_START, CONFIG_DETAIL_END).encode())
+    print(f"Page size: {len(body):,} bytes. Read by the extractor: {read:,} bytes.")
+    for name, fn in [("legacy", legacy), ("streaming", streaming)]:
+        seconds = min(timeit.repeat(lambda: fn(body), number=args.number, repeat=3))
+        print(f"{name:>10}: {seconds / args.number * 1e3:.3f} ms per listing")
+
+
+if __name__ == "__main__":
+    main()
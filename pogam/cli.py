@@ -1,3 +1,4 @@
+import contextlib
 import json
 import logging
 import os
@@ -5,7 +6,7 @@ import stat
 import subprocess
 import sys
 from datetime import datetime, timedelta
-from typing import Iterable, List
+from typing import Iterable, List, Optional
 
 import click
 import click_log  # type: ignore
@@ -14,6 +15,11 @@ from requests.compat import urljoin  # type: ignore
 
 from . import SOURCES, create_app, scrapers
 from .models import Listing
+from .scrapers.cassettes import Cassette, full_speed
+from .scrapers.leboncoin import download_images
+from .scrapers.packs import compact_images
+from .scrapers.seloger import enrich
+from .scrapers.variants import derive_variants
 
 logger = logging.getLogger("pogam")
 click_log.basic_config(logger)
@@ -95,6 +101,53 @@ def cli():
     type=click.Choice(SOURCES, case_sensitive=False),
     help="Sources to scrape.",
 )
+@click.option(
+    "--lite",
+    is_flag=True,
+    help=(
+        "Only fetch the listing pages from seloger, deferring their details to "
+        "`pogam enrich`."
+    ),
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help=(
+        "Walk leboncoin's results past the ones previous scrapes of the same search "
+        "were done with."
+    ),
+)
+@click.option(
+    "--defer-images",
+    is_flag=True,
+    help=(
+        "Add leboncoin listings without waiting for their images, leaving them to "
+        "`pogam download-images`."
+    ),
+)
+@click.option(
+    "--shard",
+    is_flag=True,
+    help=(
+        "Split large leboncoin searches by property type, post code, price and size, "
+        "and scrape the parts side by side."
+    ),
+)
+@click.option(
+    "--record",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Record every request and response of the scrape to this cassette file.",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Replay the scrape recorded in this cassette file, at full speed.",
+)
+@click.option(
+    "--replay-latency",
+    is_flag=True,
+    help="When replaying, wait as long as the recorded responses took to arrive.",
+)
 def scrape_cmd(
     transaction: str,
     post_codes: Iterable[str],
@@ -110,6 +163,13 @@ def scrape_cmd(
     num_results: int,
     max_duplicates: int,
     sources: Iterable[str],
+    lite: bool,
+    full: bool,
+    defer_images: bool,
+    shard: bool,
+    record: Optional[str],
+    replay: Optional[str],
+    replay_latency: bool,
 ):
     """
     Run (local) scrape for offers for a TRANSACTION in the given POST_CODES.
@@ -119,33 +179,50 @@ def scrape_cmd(
     """
     if transaction.lower() not in TRANSACTION_TYPES:
         raise ValueError(f"Unexpected transaction type {transaction}.")
+    if record and replay:
+        raise click.UsageError("Cannot both --record and --replay a scrape.")
     if not sources:
         sources = SOURCES
     added_listings: List[Listing] = []
     seen_listings: List[Listing] = []
     failed_listings: List[str] = []
-    for source in sources:
-        logger.info(f"Scraping {source}...")
-        scraper = getattr(scrapers, source)
-        with app.app_context():
-            results = scraper(
-                transaction,
-                post_codes,
-                property_types=property_types,
-                min_price=min_price,
-                max_price=max_price,
-                min_size=min_size,
-                max_size=max_size,
-                min_rooms=min_rooms,
-                max_rooms=max_rooms,
-                min_beds=min_beds,
-                max_beds=max_beds,
-                num_results=num_results,
-                max_duplicates=max_duplicates,
-            )
-            added_listings += results["added"]
-            seen_listings += results["seen"]
-            failed_listings += results["failed"]
+    with contextlib.ExitStack() as stack:
+        if record:
+            stack.enter_context(Cassette(record).record())
+        if replay:
+            stack.enter_context(full_speed())
+            stack.enter_context(Cassette(replay).replay(latency=replay_latency))
+        for source in sources:
+            logger.info(f"Scraping {source}...")
+            scraper = getattr(scrapers, source)
+            options = {
+                "leboncoin": {
+                    "incremental": not full,
+                    "defer_images": defer_images,
+                    "shard": shard,
+                },
+                "seloger": {"lite": lite},
+            }[source]
+            with app.app_context():
+                results = scraper(
+                    transaction,
+                    post_codes,
+                    property_types=property_types,
+                    min_price=min_price,
+                    max_price=max_price,
+                    min_size=min_size,
+                    max_size=max_size,
+                    min_rooms=min_rooms,
+                    max_rooms=max_rooms,
+                    min_beds=min_beds,
+                    max_beds=max_beds,
+                    num_results=num_results,
+                    max_duplicates=max_duplicates,
+                    **options,
+                )
+                added_listings += results["added"]
+                seen_listings += results["seen"]
+                failed_listings += results["failed"]
 
     num_added = len(added_listings)
     num_seen = len(seen_listings)
@@ -159,6 +236,101 @@ def scrape_cmd(
     click.echo(msg)
 
 
+@cli.command(name="enrich")
+@click.option(
+    "--num-listings",
+    type=int,
+    default=100,
+    show_default=True,
+    help="Maximum number of listings to enrich.",
+)
+def enrich_cmd(num_listings: int):
+    """
+    Fetch the details of the listings scraped with `pogam scrape --lite`.
+    """
+    with app.app_context():
+        results = enrich(num_listings=num_listings)
+    num_enriched = len(results["enriched"])
+    num_failed = len(results["failed"])
+    msg = (
+        f"{Color.BOLD}All done!✨ 🍰 ✨{Color.END}\n"
+        f"We enriched {num_enriched} listings and choked on {num_failed}."
+    )
+    click.echo(msg)
+
+
+@cli.command(name="download-images")
+@click.option(
+    "--num-images",
+    type=int,
+    default=500,
+    show_default=True,
+    help="Maximum number of images to download.",
+)
+def download_images_cmd(num_images: int):
+    """
+    Download the images of the listings scraped with `pogam scrape --defer-images`.
+    """
+    with app.app_context():
+        results = download_images(num_images=num_images)
+    num_downloaded = len(results["downloaded"])
+    num_failed = len(results["failed"])
+    msg = (
+        f"{Color.BOLD}All done!✨ 🍰 ✨{Color.END}\n"
+        f"We downloaded {num_downloaded} images and choked on {num_failed}."
+    )
+    click.echo(msg)
+
+
+@cli.command(name="derive-images")
+@click.option(
+    "--num-listings",
+    type=int,
+    default=100,
+    show_default=True,
+    help="Maximum number of listings to process.",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    help="Number of worker processes. Defaults to the number of CPUs.",
+)
+def derive_images_cmd(num_listings: int, max_workers: Optional[int]):
+    """
+    Derive thumbnails and WebP versions of the listings' stored images.
+    """
+    with app.app_context():
+        results = derive_variants(num_listings=num_listings, max_workers=max_workers)
+    num_processed = len(results["processed"])
+    num_failed = len(results["failed"])
+    msg = (
+        f"{Color.BOLD}All done!✨ 🍰 ✨{Color.END}\n"
+        f"We processed the images of {num_processed} listings and choked on "
+        f"{num_failed}."
+    )
+    click.echo(msg)
+
+
+@cli.command(name="compact-images")
+def compact_images_cmd():
+    """
+    Reclaim the space of the images no listing uses anymore.
+
+    Only applies to the pack image store (POGAM_IMAGES_BACKEND=pack).
+    """
+    with app.app_context():
+        try:
+            results = compact_images()
+        except RuntimeError as e:
+            raise click.UsageError(str(e))
+    msg = (
+        f"{Color.BOLD}All done!✨ 🍰 ✨{Color.END}\n"
+        f"We deleted {results['deleted']} images and reclaimed "
+        f"{results['reclaimed'] / 2**20:.1f} MB."
+    )
+    click.echo(msg)
+
+
 # ------------------------------------------------------------------------------------ #
 #                                     App Commands                                     #
 # ------------------------------------------------------------------------------------ #
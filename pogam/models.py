@@ -1,8 +1,12 @@
+import hashlib
 import re
-from typing import Dict, List
+from datetime import datetime
+from typing import Any, Dict, List, Sequence, Tuple
+from urllib.parse import urlsplit, urlunsplit
 
 import sqlalchemy as sa  # type: ignore
 from sqlalchemy.ext.declarative import declared_attr  # type: ignore
+from sqlalchemy.dialects import postgresql  # type: ignore
 from sqlalchemy.dialects.postgresql import JSON
 
 from . import db
@@ -12,7 +16,19 @@ DPE_EMISSIONS = {"A": 5, "B": 7.5, "C": 15, "D": 27.5, "E": 45, "F": 67.5}
 ROSETTA_STONE = {"appartement": "apartment", "location": "rent"}
 
 
-__all__ = ["Property", "Listing", "City", "Neighborhood"]
+__all__ = [
+    "Property",
+    "Listing",
+    "City",
+    "Neighborhood",
+    "Proxy",
+    "GeographicalCode",
+    "Watermark",
+    "Image",
+    "ImageUrl",
+    "ListingImage",
+    "ImageDownload",
+]
 
 
 class TimestampMixin(object):
@@ -263,14 +279,27 @@ class Listing(TimestampMixin, UniqueMixin, db.Model):
         property: reference property.
         source: source of the scrape.
         url: url of the source listing.
+        url_hash: 16-byte digest of the normalized url, in hexadecimal, on which urls
+            are unique and looked up. Null for the few listings that were scraped
+            twice under the same url before urls were hashed.
         transaction: type of transaction (buy, rent).
         description: full text description in the listing.
         price: listing's price.
         currency: listing's currency.
         external_listing_id: source's listing id
+        is_partial: whether the listing still misses the details that some sources
+            only provide on a separate page (e.g. amenities, broker fee).
+        images: paths of the listing's stored images.
+        image_variants: for each of the listing's images, the paths of its thumbnail
+            and WebP versions (None if it could not be transcoded). Null until
+            derived.
+        images_status: status of the listing's deferred image downloads: 'pending',
+            'done', or 'failed' if some of them failed. Null if the images were
+            downloaded with the listing.
     """
 
     __tablename__ = "listings"
+    __table_args__ = (sa.UniqueConstraint("source", "external_listing_id"),)
     id: int = sa.Column(sa.Integer, primary_key=True)
     property_id: int = sa.Column(
         sa.Integer,
@@ -279,7 +308,8 @@ class Listing(TimestampMixin, UniqueMixin, db.Model):
     )
     property_: Property = sa.orm.relationship("Property", back_populates="listings")
     source: str = sa.Column(sa.Unicode(100), nullable=False)
-    url: str = sa.Column(sa.Unicode(10_000), nullable=False, unique=True)
+    url: str = sa.Column(sa.Unicode(10_000), nullable=False)
+    url_hash: str = sa.Column(sa.Unicode(32), unique=True)
     first_publication_date: str = sa.Column(
         sa.Unicode(100)
     )  # https://github.com/chanzuckerberg/sqlalchemy-aurora-data-api/issues/7
@@ -292,15 +322,22 @@ class Listing(TimestampMixin, UniqueMixin, db.Model):
     broker_fee_is_included: bool = sa.Column(sa.Boolean(create_constraint=False))
     security_deposit: float = sa.Column(sa.Float)
     images: JSON = sa.Column(JSON)
+    image_variants: JSON = sa.Column(JSON)
+    images_status: str = sa.Column(sa.Unicode(10))
     external_listing_id: str = sa.Column(sa.Unicode(200))
+    is_partial: bool = sa.Column(sa.Boolean(create_constraint=False), default=False)
 
     @classmethod
     def unique_columns(cls):
-        return ["external_listing_id"]
+        return ["source", "external_listing_id"]
 
     @classmethod
     def create(cls, **data):
         """Create a new listing."""
+        return cls(**cls._columns(data))
+
+    @staticmethod
+    def _columns(data: Dict[str, Any]) -> Dict[str, Any]:
         for field in ["source", "url", "transaction"]:
             if not data.get(field, None):
                 msg = f"Field '{field}' is required."
@@ -312,7 +349,167 @@ class Listing(TimestampMixin, UniqueMixin, db.Model):
             k: (columns[k] if (columns[k] or (columns[k] is False)) else None)
             for k in columns
         }
-        return cls(**columns)
+        columns["url_hash"] = Listing.hash_url(columns["url"])
+        return columns
+
+    @staticmethod
+    def hash_url(url: str) -> str:
+        """
+        Digest of a listing's url, to check whether we already have the listing.
+
+        Urls are normalized first: their scheme and host are lowercased, and their
+        default port and fragment are dropped.
+        """
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        netloc = parts.netloc.lower()
+        if (scheme, netloc.rpartition(":")[2]) in [("http", "80"), ("https", "443")]:
+            netloc = netloc.rpartition(":")[0]
+        normalized = urlunsplit((scheme, netloc, parts.path, parts.query, ""))
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+    @sa.orm.validates("url")
+    def _hash_url(self, key, url):
+        self.url_hash = Listing.hash_url(url) if url else None
+        return url
+
+    @classmethod
+    def upsert(
+        cls, records: Sequence[Dict[str, Any]], update: bool = False
+    ) -> List[Tuple["Listing", bool]]:
+        """
+        Add a batch of scraped listings, and their properties, to the database session.
+
+        The listings already in the database are looked up with a single query, on
+        their source and external id or on their url, and only the new ones get a
+        property. On Postgres, the properties are written with a single `INSERT ...
+        RETURNING id`; on SQLite, they are flushed one by one. The new listings are
+        then written with a single `INSERT ... ON CONFLICT DO NOTHING` (`INSERT OR
+        IGNORE` on SQLite), so that a listing added in the meantime, e.g. by another
+        scrape, is not an error.
+
+        Args:
+            records: the listings' data, along with their properties', as for
+                :meth:`create`.
+            update: True to also update the listings already in the database with
+                the records' values. Values missing from a record are left alone.
+
+        Returns:
+            for each record, in order, the listing and a flag indicating whether it is
+            a new listing.
+        """
+        if not records:
+            return []
+        rows = [cls._columns(data) for data in records]
+        table = cls.__table__
+
+        def _lookup(rows):
+            ids: Dict[str, List[str]] = {}
+            for row in rows:
+                if row.get("external_listing_id"):
+                    ids.setdefault(row["source"], []).append(row["external_listing_id"])
+            clauses = [cls.url_hash.in_([row["url_hash"] for row in rows])]
+            clauses += [
+                sa.and_(cls.source == source, cls.external_listing_id.in_(ids_))
+                for source, ids_ in ids.items()
+            ]
+            listings = cls.query.filter(sa.or_(*clauses)).all()
+            by_key = {
+                (listing.source, listing.external_listing_id): listing
+                for listing in listings
+                if listing.external_listing_id
+            }
+            by_url = {listing.url_hash: listing for listing in listings}
+            return [
+                by_key.get((row["source"], row.get("external_listing_id")))
+                or by_url.get(row["url_hash"])
+                for row in rows
+            ]
+
+        existing = _lookup(rows)
+        if update:
+            for listing, row in zip(existing, rows):
+                if listing is None:
+                    continue
+                for column, value in row.items():
+                    if value is not None:
+                        setattr(listing, column, value)
+
+        def _values(table, row):
+            # a multi-row insert needs every column in every row. Missing values are
+            # SQL nulls, rather than JSON nulls.
+            return {
+                column.key: (
+                    row[column.key]
+                    if row.get(column.key) is not None
+                    else getattr(column.default, "arg", sa.null())
+                )
+                for column in table.columns
+                if not column.primary_key
+            }
+
+        new = [i for i, listing in enumerate(existing) if listing is None]
+        properties = [Property.create(records[i]) for i in new]
+        dialect = db.session.get_bind().dialect.name
+        if properties and (dialect == "postgresql"):
+            property_table = Property.__table__
+            statement = (
+                postgresql.insert(property_table)
+                .values(
+                    [
+                        _values(
+                            property_table,
+                            {
+                                column.key: getattr(property_, column.key)
+                                for column in property_table.columns
+                            },
+                        )
+                        for property_ in properties
+                    ]
+                )
+                .returning(property_table.c.id)
+            )
+            # the ids come back in the order of the rows
+            property_ids = [id_ for (id_,) in db.session.execute(statement)]
+        else:
+            db.session.add_all(properties)
+            db.session.flush()
+            property_ids = [property_.id for property_ in properties]
+        values = [
+            _values(table, dict(rows[i], property_id=property_id))
+            for i, property_id in zip(new, property_ids)
+        ]
+
+        if values:
+            statement = table.insert().values(values)
+            if dialect == "postgresql":
+                statement = postgresql.insert(table).values(values)
+                statement = statement.on_conflict_do_nothing()
+            elif dialect == "sqlite":
+                statement = statement.prefix_with("OR IGNORE")
+            db.session.execute(statement)
+            for i, listing in zip(new, _lookup([rows[i] for i in new])):
+                existing[i] = listing
+
+        outcomes = []
+        for i, listing in enumerate(existing):
+            if listing is None:
+                msg = f"Failed to add the listing at {rows[i]['url']}."
+                raise RuntimeError(msg)
+            outcomes.append((listing, False))
+        spare = []
+        for i, property_id in zip(new, property_ids):
+            listing = existing[i]
+            if listing.property_id == property_id:
+                outcomes[i] = (listing, True)
+            else:
+                # the listing was added in the meantime, or twice in the batch
+                spare.append(property_id)
+        if spare:
+            Property.query.filter(Property.id.in_(spare)).delete(
+                synchronize_session="fetch"
+            )
+        return outcomes
 
     def to_dict(self):
         return {
@@ -330,4 +527,187 @@ class Listing(TimestampMixin, UniqueMixin, db.Model):
             "property": self.property_.to_dict(),
             "url": self.url,
             "external_listing_id": self.external_listing_id,
+            "is_partial": self.is_partial,
         }
+
+
+class Proxy(db.Model):
+    """
+    A proxy, and how well it has been doing, shared across scrapes.
+
+    Attributes:
+        id: primary key
+        url: url of the proxy, e.g. 'http://1.2.3.4:8080'.
+        requests: number of requests sent through the proxy.
+        successes: number of those requests that succeeded.
+        captchas: number of those requests that got served a captcha.
+        latency: moving average of the proxy's latency, in seconds.
+        fetched_at: when the proxy list was last fetched from the providers (UTC).
+        updated_at: when the proxy's statistics were last updated (UTC).
+    """
+
+    __tablename__ = "proxies"
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    url: str = sa.Column(sa.Unicode(200), nullable=False, unique=True)
+    requests: int = sa.Column(sa.Integer, nullable=False, default=0)
+    successes: int = sa.Column(sa.Integer, nullable=False, default=0)
+    captchas: int = sa.Column(sa.Integer, nullable=False, default=0)
+    latency: float = sa.Column(sa.Float)
+    fetched_at: datetime = sa.Column(sa.DateTime, nullable=False)
+    updated_at: datetime = sa.Column(sa.DateTime)
+
+
+class GeographicalCode(db.Model):
+    """
+    A source's own geographical code for a French post code.
+
+    Attributes:
+        id: primary key
+        source: source of the code, e.g. 'seloger'.
+        post_code: standard French post code.
+        geo_type: type of the geographical code, in the source's nomenclature.
+        geo_code: the geographical code, in the source's nomenclature.
+        fetched_at: when the code was fetched from the source (UTC).
+    """
+
+    __tablename__ = "geographical_codes"
+    __table_args__ = (sa.UniqueConstraint("source", "post_code"),)
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    source: str = sa.Column(sa.Unicode(100), nullable=False)
+    post_code: str = sa.Column(sa.Unicode(10), nullable=False)
+    geo_type: str = sa.Column(sa.Unicode(10), nullable=False)
+    geo_code: str = sa.Column(sa.Unicode(20), nullable=False)
+    fetched_at: datetime = sa.Column(sa.DateTime, nullable=False)
+
+
+class Watermark(db.Model):
+    """
+    The newest result seen by a search whose results are sorted newest first.
+
+    Attributes:
+        id: primary key
+        source: source of the search, e.g. 'leboncoin'.
+        search: hash of the normalized search parameters.
+        value: sort key (e.g. publication date) of the newest result we are done with.
+        updated_at: when the watermark was last moved (UTC).
+    """
+
+    __tablename__ = "watermarks"
+    __table_args__ = (sa.UniqueConstraint("source", "search"),)
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    source: str = sa.Column(sa.Unicode(100), nullable=False)
+    search: str = sa.Column(sa.Unicode(64), nullable=False)
+    value: str = sa.Column(sa.Unicode(100), nullable=False)
+    updated_at: datetime = sa.Column(sa.DateTime, nullable=False)
+
+
+class Image(TimestampMixin, db.Model):
+    """
+    An image, stored once however many listings (or urls) it shows up in.
+
+    Attributes:
+        id: primary key
+        hash: SHA-256 digest of the image's content, in hexadecimal.
+        path: path of the image, relative to the images folder (or bucket).
+        size: size of the image, in bytes.
+    """
+
+    __tablename__ = "images"
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    hash: str = sa.Column(sa.Unicode(64), nullable=False, unique=True)
+    path: str = sa.Column(sa.Unicode(200), nullable=False)
+    size: int = sa.Column(sa.Integer)
+
+
+class ImageUrl(db.Model):
+    """
+    A remote url we downloaded an image from.
+
+    Attributes:
+        id: primary key
+        url_hash: SHA-256 digest of the url, in hexadecimal, to index long urls.
+        url: the remote url.
+        image_id: the image found at the url.
+    """
+
+    __tablename__ = "image_urls"
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    url_hash: str = sa.Column(sa.Unicode(64), nullable=False, unique=True)
+    url: str = sa.Column(sa.Unicode(10_000), nullable=False)
+    image_id: int = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("images.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    image: Image = sa.orm.relationship("Image")
+
+
+class ListingImage(db.Model):
+    """
+    An image of a listing.
+
+    Attributes:
+        id: primary key
+        listing_id: the listing.
+        image_id: the image.
+        position: position of the image in the listing, starting at 0.
+    """
+
+    __tablename__ = "listing_images"
+    __table_args__ = (sa.UniqueConstraint("listing_id", "position"),)
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    listing_id: int = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("listings.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    image_id: int = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("images.id", onupdate="CASCADE", ondelete="RESTRICT"),
+        nullable=False,
+        index=True,
+    )
+    position: int = sa.Column(sa.Integer, nullable=False)
+    listing: Listing = sa.orm.relationship("Listing")
+    image: Image = sa.orm.relationship("Image")
+
+
+class ImageDownload(TimestampMixin, db.Model):
+    """
+    An image download deferred until after its listing was ingested.
+
+    Attributes:
+        id: primary key
+        listing_id: the listing.
+        position: position of the image in the listing, starting at 0.
+        url: the remote url of the image.
+        status: 'pending', 'running', 'done' or 'failed'.
+        attempts: number of times we tried to download the image.
+        claimed_at: when a worker last claimed the download.
+        hash: SHA-256 digest of the image's content, once downloaded.
+        path: path of the stored image, once downloaded.
+        size: size of the image, in bytes, once downloaded.
+    """
+
+    __tablename__ = "image_downloads"
+    __table_args__ = (sa.UniqueConstraint("listing_id", "position"),)
+    id: int = sa.Column(sa.Integer, primary_key=True)
+    listing_id: int = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("listings.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    position: int = sa.Column(sa.Integer, nullable=False)
+    url: str = sa.Column(sa.Unicode(10_000), nullable=False)
+    status: str = sa.Column(
+        sa.Unicode(10), nullable=False, default="pending", index=True
+    )
+    attempts: int = sa.Column(sa.Integer, nullable=False, default=0)
+    claimed_at: datetime = sa.Column(sa.DateTime)
+    hash: str = sa.Column(sa.Unicode(64))
+    path: str = sa.Column(sa.Unicode(200))
+    size: int = sa.Column(sa.Integer)
+    listing: Listing = sa.orm.relationship("Listing")
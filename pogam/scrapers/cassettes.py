@@ -0,0 +1,228 @@
+import base64
+import contextlib
+import gzip
+import hashlib
+import importlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .httpcache import normalize_url
+
+logger = logging.getLogger(__name__)
+
+# scraper modules whose pacing and backoff we turn off when replaying at full speed
+SCRAPERS = ["pogam.scrapers.leboncoin", "pogam.scrapers.seloger"]
+
+
+def _digest(body: Any) -> Optional[str]:
+    if not body:
+        return None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+
+def _key(method: str, url: str, body: Any) -> Tuple[str, str, Optional[str]]:
+    return (method.upper(), normalize_url(url), _digest(body))
+
+
+class Cassette(object):
+    """
+    Every request and response of a scrape, to replay it offline.
+
+    Requests are matched on their method, normalized url and body. Headers and
+    proxies are ignored, since scrapes pick them at random. Identical requests are
+    answered in the order they were recorded, the last answer being repeated once we
+    run out of them.
+
+    Cassettes are stored as gzipped JSON lines, one interaction per line. Replays are
+    most faithful against the database and caches the scrape was recorded with.
+
+    Typical usage::
+
+        with Cassette(path).record():
+            seloger("rent", "75")
+
+        with Cassette(path).replay():
+            seloger("rent", "75")
+
+    Args:
+        path: path of the cassette file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.interactions: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._answers: Dict[Tuple, Deque[Dict[str, Any]]] = {}
+
+    # ------------------------------------------------------------------------------ #
+    #                                   Storage                                       #
+    # ------------------------------------------------------------------------------ #
+    def load(self) -> "Cassette":
+        """Read the interactions from the cassette file."""
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            self.interactions = [json.loads(line) for line in f if line.strip()]
+        return self
+
+    def save(self):
+        """Write the interactions to the cassette file."""
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            for interaction in self.interactions:
+                f.write(json.dumps(interaction) + "\n")
+
+    # ------------------------------------------------------------------------------ #
+    #                                  Recording                                      #
+    # ------------------------------------------------------------------------------ #
+    def _record(self, request: requests.PreparedRequest, outcome: Dict[str, Any]):
+        interaction = {
+            "key": _key(request.method, request.url, request.body),
+            "method": request.method,
+            "url": request.url,
+            **outcome,
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+
+    @contextlib.contextmanager
+    def record(self) -> Iterator["Cassette"]:
+        """
+        Record every request sent with `requests`, and save the cassette on exit.
+
+        Streamed responses are read in full, so that they can be replayed.
+        """
+        send = requests.Session.send
+        cassette = self
+
+        def _send(self, request, **kwargs):
+            try:
+                response = send(self, request, **kwargs)
+            except requests.exceptions.RequestException as e:
+                cassette._record(request, {"error": type(e).__name__})
+                raise
+            cassette._record(
+                request,
+                {
+                    "status_code": response.status_code,
+                    "response_url": response.url,
+                    "headers": dict(response.headers),
+                    "body": base64.b64encode(response.content).decode("ascii"),
+                    "elapsed": response.elapsed.total_seconds(),
+                },
+            )
+            return response
+
+        requests.Session.send = _send
+        try:
+            yield self
+        finally:
+            requests.Session.send = send
+            self.save()
+            msg = f"Recorded {len(self.interactions)} requests to {self.path}."
+            logger.info(msg)
+
+    # ------------------------------------------------------------------------------ #
+    #                                   Replay                                        #
+    # ------------------------------------------------------------------------------ #
+    def _answer(self, request: requests.PreparedRequest) -> Optional[Dict[str, Any]]:
+        key = _key(request.method, request.url, request.body)
+        with self._lock:
+            answers = self._answers.get(key)
+            if not answers:
+                return None
+            return answers.popleft() if len(answers) > 1 else answers[0]
+
+    @staticmethod
+    def _response(
+        request: requests.PreparedRequest, interaction: Dict[str, Any]
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = interaction["status_code"]
+        response.headers = CaseInsensitiveDict(interaction["headers"])
+        # the recorded body was already decoded by `requests`
+        for header in ["content-encoding", "transfer-encoding"]:
+            response.headers.pop(header, None)
+        response._content = base64.b64decode(interaction["body"])
+        response._content_consumed = True
+        response.url = interaction["response_url"]
+        response.request = request
+        response.elapsed = timedelta(seconds=interaction["elapsed"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    @contextlib.contextmanager
+    def replay(self, *, latency: bool = False) -> Iterator["Cassette"]:
+        """
+        Answer every request sent with `requests` from the cassette.
+
+        Requests that were not recorded fail with a ConnectionError.
+
+        Args:
+            latency: True to wait as long as the recorded responses took to arrive.
+                Otherwise, responses are served immediately.
+        """
+        if not self.interactions:
+            self.load()
+        answers: Dict[Tuple, Deque[Dict[str, Any]]] = defaultdict(deque)
+        for interaction in self.interactions:
+            answers[tuple(interaction["key"])].append(interaction)
+        self._answers = dict(answers)
+        send = requests.Session.send
+        cassette = self
+
+        def _send(self, request, **kwargs):
+            interaction = cassette._answer(request)
+            if interaction is None:
+                msg = f"No recorded response to {request.method} {request.url}."
+                raise requests.exceptions.ConnectionError(msg, request=request)
+            if "error" in interaction:
+                exception = getattr(
+                    requests.exceptions,
+                    interaction["error"],
+                    requests.exceptions.ConnectionError,
+                )
+                raise exception(f"Recorded {interaction['error']}.", request=request)
+            if latency:
+                time.sleep(interaction["elapsed"])
+            return cassette._response(request, interaction)
+
+        requests.Session.send = _send
+        try:
+            yield self
+        finally:
+            requests.Session.send = send
+
+
+@contextlib.contextmanager
+def full_speed() -> Iterator[None]:
+    """
+    Turn off the scrapers' pacing and backoff, e.g. to replay a cassette.
+    """
+    modules = [importlib.import_module(name) for name in SCRAPERS]
+    saved = []
+    for module in modules:
+        rates = module.RATES  # type: ignore
+        retries = {
+            name: dict(getattr(module, name))
+            for name in ["RETRY", "IMAGE_RETRY"]
+            if hasattr(module, name)
+        }
+        saved.append((module, rates, retries))
+        module.RATES = {}  # type: ignore
+        for name in retries:
+            getattr(module, name)["base_delay"] = 0
+    try:
+        yield
+    finally:
+        for module, rates, retries in saved:
+            module.RATES = rates  # type: ignore
+            for name, retry in retries.items():
+                getattr(module, name).update(retry)
@@ -0,0 +1,103 @@
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import sqlalchemy as sa  # type: ignore
+
+from .. import db
+from ..models import Listing
+
+logger = logging.getLogger(__name__)
+
+Candidate = Tuple[Optional[str], Optional[str]]
+
+
+class ListingIndex(object):
+    """
+    Check which listings of a source are already in the database, one page at a time.
+
+    Rather than loading every known url upfront, we ask the database about the
+    handful of candidates found on each page of results. Keys we already know to be
+    in the database are remembered in a bounded LRU cache, so that listings showing
+    up on several pages (or under several urls) don't cost another round-trip. Urls
+    are matched on their hash, see :meth:`Listing.hash_url`.
+
+    Args:
+        source: source of the listings, e.g. 'seloger'.
+        maxsize: maximum number of keys kept in the in-memory cache.
+    """
+
+    def __init__(self, source: str, maxsize: int = 10_000):
+        self.source = source
+        self.maxsize = maxsize
+        self._known: "OrderedDict[Tuple[str, Optional[str]], None]" = OrderedDict()
+
+    def _remember(self, key: Tuple[str, Optional[str]]) -> None:
+        self._known[key] = None
+        self._known.move_to_end(key)
+        while len(self._known) > self.maxsize:
+            self._known.popitem(last=False)
+
+    def _is_cached(self, url: Optional[str], id_: Optional[str]) -> bool:
+        url_hash = Listing.hash_url(url) if url else None
+        for key in [("url", url_hash), ("id", id_)]:
+            if key[1] and key in self._known:
+                self._known.move_to_end(key)
+                return True
+        return False
+
+    def add(self, url: Optional[str] = None, external_listing_id: Optional[str] = None):
+        """Record that a listing is now in the database."""
+        if url:
+            self._remember(("url", Listing.hash_url(url)))
+        if external_listing_id:
+            self._remember(("id", str(external_listing_id)))
+
+    def known(self, candidates: Iterable[Candidate]) -> List[bool]:
+        """
+        Flag the candidates that are already in the database.
+
+        Args:
+            candidates: (url, external listing id) pairs. Either may be None.
+
+        Returns:
+            for each candidate, True if a listing with the same url or the same
+            external listing id is already in the database.
+        """
+        candidates = [
+            (url, str(id_) if id_ is not None else None) for url, id_ in candidates
+        ]
+        flags = [self._is_cached(url, id_) for url, id_ in candidates]
+
+        unknown = [c for c, flag in zip(candidates, flags) if not flag]
+        urls = sorted({url for url, _ in unknown if url})
+        ids = sorted({id_ for _, id_ in unknown if id_})
+        if urls or ids:
+            for url_hash, id_ in self._query(urls, ids):
+                if url_hash:
+                    self._remember(("url", url_hash))
+                if id_:
+                    self._remember(("id", id_))
+            flags = [
+                flag or self._is_cached(url, id_)
+                for (url, id_), flag in zip(candidates, flags)
+            ]
+        return flags
+
+    def _query(self, urls: Sequence[str], ids: Sequence[str]):
+        clauses = []
+        if urls:
+            clauses.append(
+                Listing.url_hash.in_({Listing.hash_url(url) for url in urls})
+            )
+        if ids:
+            clauses.append(Listing.external_listing_id.in_(ids))
+        query = db.session.query(Listing.url_hash, Listing.external_listing_id).filter(
+            Listing.source == self.source, sa.or_(*clauses)
+        )
+        msg = (
+            f"Checking {len(urls)} urls and {len(ids)} listing ids "
+            f"against the {self.source} listings in the database."
+        )
+        logger.debug(msg)
+        return query.all()
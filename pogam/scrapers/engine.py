@@ -0,0 +1,293 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import exceptions
+from .httpcache import ResponseCache
+from .proxies import ProxyPool
+from .retry import CircuitBreaker
+from .throttle import Throttle
+
+logger = logging.getLogger(__name__)
+
+
+class Engine(object):
+    """
+    Concurrent HTTP fetcher shared by the scrapers.
+
+    Scrapers submit tasks (fetching and parsing a listing, downloading an image, etc.)
+    to a pool of worker threads, and those tasks issue their requests through
+    :meth:`request`. The engine takes care of:
+
+    - bounding the number of concurrent requests made to any given host,
+    - pacing requests to each host, speeding up or backing off depending on how the
+      host responds,
+    - refusing to send requests through proxies, or to hosts, that keep failing
+      (circuit breakers),
+    - reporting how each proxy performed to the proxy pool, if any,
+    - pooling connections, with one session per set of proxies,
+    - sharing the response between identical GET requests that are in flight at the
+      same time,
+    - revalidating the GET responses it has cached, if any, instead of downloading
+      them again.
+
+    Database access must stay on the calling thread: tasks should return parsed data
+    and let the scraper ingest it.
+
+    Args:
+        max_workers: number of worker threads.
+        max_per_host: maximum number of concurrent requests to a single host.
+        throttle: per-host rate controllers. Defaults to no throttling.
+        breakers: circuit breaker for hosts and proxies.
+        proxy_pool: pool to report the outcome of requests sent through its proxies.
+        cache: cache of responses to revalidate with conditional requests.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_workers: int = 8,
+        max_per_host: int = 4,
+        throttle: Optional[Throttle] = None,
+        breakers: Optional[CircuitBreaker] = None,
+        proxy_pool: Optional[ProxyPool] = None,
+        cache: Optional[ResponseCache] = None,
+    ):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.throttle = throttle if throttle is not None else Throttle()
+        self.breakers = breakers if breakers is not None else CircuitBreaker()
+        self.proxy_pool = proxy_pool
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pogam-engine"
+        )
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, threading.BoundedSemaphore] = {}
+        self._sessions: Dict[Hashable, requests.Session] = {}
+        self._in_flight: Dict[Hashable, Future] = {}
+
+    # ------------------------------------------------------------------------------ #
+    #                                  Life Cycle                                     #
+    # ------------------------------------------------------------------------------ #
+    def __enter__(self) -> "Engine":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the workers and close all the pooled connections."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    # ------------------------------------------------------------------------------ #
+    #                                    Tasks                                        #
+    # ------------------------------------------------------------------------------ #
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Run `fn(*args, **kwargs)` on one of the engine's workers."""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    # ------------------------------------------------------------------------------ #
+    #                                   Requests                                      #
+    # ------------------------------------------------------------------------------ #
+    def session(self, proxies: Optional[Mapping[str, str]] = None) -> requests.Session:
+        """Return the pooled session for a given set of proxies."""
+        key = frozenset((proxies or {}).items())
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.max_workers, pool_maxsize=self.max_workers
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.proxies.update(proxies or {})
+                self._sessions[key] = session
+        return session
+
+    def _host(self, url: str) -> threading.BoundedSemaphore:
+        netloc = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._hosts.get(netloc)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.max_per_host)
+                self._hosts[netloc] = semaphore
+        return semaphore
+
+    @staticmethod
+    def _key(method: str, url: str, kwargs: Mapping[str, Any]) -> Optional[Tuple]:
+        if method.upper() not in ("GET", "HEAD") or kwargs.get("stream"):
+            return None
+        return (method.upper(), _full_url(url, kwargs))
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        proxies: Optional[Mapping[str, str]] = None,
+        blocked: Optional[Callable[[requests.Response], bool]] = None,
+        use_cache: bool = True,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        Send a request, blocking the calling thread until the response arrives.
+
+        Args:
+            method: HTTP method, e.g. 'GET'.
+            url: url of the request.
+            proxies: proxies to route the request through, as in `requests`.
+            blocked: function telling whether a response means the server turned us
+                down. Defaults to :func:`is_blocked`.
+            use_cache: False to neither revalidate nor cache the response. Streamed
+                responses are only cached once the caller has read their whole body.
+            kwargs: any other keyword argument accepted by `requests.request`.
+
+        Returns:
+            the response. Identical GET requests issued while this one is in flight
+            get the very same response object. Cached responses the server says are
+            still fresh are replayed from the cache, with `from_cache` set to True.
+
+        Raises:
+            exceptions.CircuitOpen if the host, or the proxy, has been failing too
+                often lately.
+        """
+        key = self._key(method, url, kwargs)
+        if key is not None:
+            with self._lock:
+                pending = self._in_flight.get(key)
+                if pending is None:
+                    owner: Future = Future()
+                    self._in_flight[key] = owner
+            if pending is not None:
+                logger.debug(f"Waiting on identical in-flight request to {url}.")
+                return pending.result()
+        if key is None:
+            return self._send(method, url, proxies, blocked, use_cache, kwargs)
+
+        # whatever happens, requests waiting on this one must not wait forever
+        try:
+            response = self._send(method, url, proxies, blocked, use_cache, kwargs)
+        except BaseException as e:
+            self._resolve(key, owner, exception=e)
+            raise
+        self._resolve(key, owner, response=response)
+        return response
+
+    def _send(self, method, url, proxies, blocked, use_cache, kwargs):
+        use_cache = use_cache and (self.cache is not None) and (method.upper() == "GET")
+        cached = None
+        if use_cache:
+            cache_url = _full_url(url, kwargs)
+            cached = self.cache.get(cache_url)
+            if cached is not None:
+                headers = dict(kwargs.get("headers") or {})
+                headers.update(cached.conditional_headers())
+                kwargs = {**kwargs, "headers": headers}
+
+        proxy = (proxies or {}).get(urlparse(url).scheme)
+        circuits = [f"host:{urlparse(url).netloc}"]
+        circuits += [f"proxy:{proxy}"] if proxy else []
+        try:
+            for circuit in circuits:
+                if self.breakers.is_open(circuit):
+                    msg = f"Circuit open for {circuit}. Not sending request to {url}."
+                    raise exceptions.CircuitOpen(msg)
+            with self._host(url):
+                self.throttle.acquire(url)
+                response = self.session(proxies).request(method, url, **kwargs)
+            if (cached is not None) and (response.status_code == 304):
+                logger.debug(f"Cached response to {url} is still fresh.")
+                response = cached.replay(response)
+        except BaseException as e:
+            if isinstance(e, exceptions.CircuitOpen):
+                pass
+            elif is_timeout(e):
+                # the host is too slow to respond
+                self.throttle.failure(url)
+                for circuit in circuits:
+                    self.breakers.failure(circuit)
+                self._report(proxy, kwargs, ok=False)
+            elif isinstance(e, requests.exceptions.RequestException):
+                # we could not get through to the host
+                for circuit in circuits[1:]:
+                    self.breakers.failure(circuit)
+                self._report(proxy, kwargs, ok=False)
+            raise
+        if (blocked or is_blocked)(response):
+            self.throttle.failure(url)
+            for circuit in circuits:
+                self.breakers.failure(circuit)
+            # turned down without an error status code: most likely a captcha
+            captcha = is_captcha(response) or (response.status_code < 400)
+            self._report(proxy, kwargs, ok=False, captcha=captcha)
+        else:
+            self.throttle.success(url)
+            for circuit in circuits:
+                self.breakers.success(circuit)
+            latency = response.elapsed.total_seconds()
+            self._report(proxy, kwargs, ok=True, latency=latency)
+            if use_cache and not getattr(response, "from_cache", False):
+                if kwargs.get("stream"):
+                    # don't download what the caller may not want to read
+                    self.cache.put_when_read(cache_url, response)
+                else:
+                    self.cache.put(cache_url, response)
+        return response
+
+    def _report(self, proxy, kwargs, **outcome):
+        if self.proxy_pool is None:
+            return
+        headers = {k.lower(): v for k, v in (kwargs.get("headers") or {}).items()}
+        user_agent = headers.get("user-agent")
+        self.proxy_pool.report(proxy, user_agent=user_agent, **outcome)
+
+    def _resolve(self, key, future, *, response=None, exception=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Send a GET request. See :meth:`request`."""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Send a POST request. See :meth:`request`."""
+        return self.request("POST", url, **kwargs)
+
+
+def _full_url(url: str, kwargs: Mapping[str, Any]) -> str:
+    """The url of a request, including its query parameters."""
+    return requests.Request("GET", url, params=kwargs.get("params")).prepare().url
+
+
+def is_blocked(response: requests.Response) -> bool:
+    """Whether the server turned the request down, e.g. with an error or a captcha."""
+    return (response.status_code >= 400) or is_captcha(response)
+
+
+def is_captcha(response: requests.Response) -> bool:
+    """Whether the server redirected us to a captcha."""
+    final_url = response.url or ""
+    return ("captcha" in final_url) or ("datadome" in final_url)
+
+
+def is_timeout(exception: BaseException) -> bool:
+    """Whether the server (rather than the proxy) timed out."""
+    return isinstance(exception, requests.exceptions.Timeout) and not isinstance(
+        exception, requests.exceptions.ProxyError
+    )
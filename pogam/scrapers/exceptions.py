@@ -5,5 +5,9 @@ class Captcha(requests.exceptions.RequestException):
     pass
 
 
+class CircuitOpen(requests.exceptions.RequestException):
+    pass
+
+
 class ListingParsingError(RuntimeError):
     pass
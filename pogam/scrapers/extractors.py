@@ -0,0 +1,385 @@
+import codecs
+import logging
+import re
+from html.parser import HTMLParser
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+)
+from urllib.parse import urljoin, urlparse
+
+import requests
+from bs4 import BeautifulSoup  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# https://stackoverflow.com/a/24519338
+ESCAPE_SEQUENCE_RE = re.compile(
+    r"""
+    ( \\U........      # 8-digit hex escapes
+    | \\u....          # 4-digit hex escapes
+    | \\x..            # 2-digit hex escapes
+    | \\[0-7]{1,3}     # Octal escapes
+    | \\N\{[^}]+\}     # Unicode characters by name
+    | \\[\\'"abfnrtv]  # Single-character escapes
+    )""",
+    re.UNICODE | re.VERBOSE,
+)
+SINGLE_CHARACTER_ESCAPES = {
+    f"\\{c}": codecs.decode(f"\\{c}", "unicode-escape") for c in "\\'\"abfnrtv"
+}
+
+# seloger's listing pages describe the listing in a `ConfigDetail` javascript object
+CONFIG_DETAIL_START = b"window.ConfigDetail"
+CONFIG_DETAIL_END = b"</script>"
+CONFIG_DETAIL_FIELD_RE = re.compile(
+    r"Object\.defineProperty\(\s*ConfigDetail,\s*['\"](.*)['\"],\s*"
+    r"{\s*value:\s*['\"](.*)['\"],\s*enumerable:\s*\S+\s*}"
+)
+# links to the listings, on seloger's results pages
+SELOGER_LINK_NAME = "classified-link"
+SELOGER_LINK_RE = re.compile(r".*seloger.com.*")  # exclude sponsored external listings
+SELOGER_LISTING_ID_RE = re.compile(r"/(\d+)\.htm$")
+SELOGER_FIELDS = {
+    "property_type": "typeBien",
+    "size": "surfaceT",
+    "floor": "etage",
+    "rooms": "nbPieces",
+    "bedrooms": "nbChambres",
+    "balconies": "balcon",
+    "heating": "idTypeChauffage",
+    "kitchen": "idTypeCuisine",
+    "dpe_consumption": "dpeC",
+    "dpe_emissions": "dpeL",
+    "postal_code": "cp",
+    "city": "ville",
+    "neighborhood": "nomQuartier",
+    "latitude": "mapCoordonneesLatitude",
+    "longitude": "mapCoordonneesLongitude",
+    "north_east_lat": "mapBoundingboxNortheastLatitude",
+    "north_east_long": "mapBoundingboxNortheastLongitude",
+    "south_west_lat": "mapBoundingboxSouthwestLatitude",
+    "south_west_long": "mapBoundingboxSouthwestLongitude",
+    "transaction": "typeTransaction",
+    "description": "descriptionBien",
+    "price": "rawPrice",
+    "external_listing_id": "idAnnonce",
+}
+SELOGER_NUMERICAL_FIELDS = frozenset(
+    [
+        "price",
+        "size",
+        "floor",
+        "rooms",
+        "bedrooms",
+        "balconies",
+        "dpe_consumption",
+        "dpe_emissions",
+        "latitude",
+        "longitude",
+        "north_east_lat",
+        "north_east_long",
+        "south_west_lat",
+        "south_west_long",
+    ]
+)
+
+# features of the listings, searched for in the criteria of its details document:
+# field, section, pattern, group, cast
+SELOGER_FEATURES: List[Tuple[str, str, str, int, Callable]] = [
+    ("terraces", "Les +", r"(\d+) Terrasse", 1, int),
+    ("has_lawn", "A l'extérieur", "Jardin", 0, bool),
+    ("has_pool", "Les +", "Piscine", 0, bool),
+    ("has_elevator", "Les +", "Ascenseur", 0, bool),
+    ("has_fireplace", "Les +", "Cheminée", 0, bool),
+    ("has_hardwood_floors", "A l'intérieur", "Parquet", 0, bool),
+    ("has_view", "Les +", "Vue", 0, bool),
+    ("exposure", "Les +", r"orientation (.*)", 1, lambda x: x.strip().lower()),
+    ("has_cellar", "Les +", "Cave", 0, bool),
+    ("parkings", "A l'extérieur", r"(\d+) Parking", 1, int),
+    ("has_super", "Les +", "Gardien", 0, bool),
+]
+SELOGER_EXPOSURES = {"nord": "north", "sud": "south", "est": "east", "ouest": "west"}
+
+
+def _decode_match(match: Match) -> str:
+    escape = match.group(0)
+    decoded = SINGLE_CHARACTER_ESCAPES.get(escape)
+    if decoded is None:
+        decoded = codecs.decode(escape, "unicode-escape")
+    return decoded
+
+
+def decode_escapes(s: str) -> str:
+    """Decode the (python-like) escape sequences of a string, in a single pass."""
+    try:
+        if "\\" not in s:
+            return s
+        escaped = ESCAPE_SEQUENCE_RE.sub(_decode_match, s)
+    except TypeError:
+        msg = f"Could not escape '{s}'."
+        raise TypeError(msg)
+    return escaped
+
+
+def read_until(
+    response: requests.Response,
+    start: bytes,
+    end: bytes,
+    *,
+    chunk_size: int = 16_384,
+) -> str:
+    """
+    Read the body of a streamed response up to the first `end` that follows `start`.
+
+    The rest of the body is never downloaded and the connection is released. If
+    `start`, or the `end` that follows it, can't be found, the whole body is read.
+
+    Args:
+        response: response of a request sent with `stream=True`.
+        start: marker of the beginning of the section we're after.
+        end: marker of the end of the section we're after.
+        chunk_size: number of bytes read at a time.
+
+    Returns:
+        the text of the body, up to (but excluding) `end`.
+    """
+    body = bytearray()
+    found_at: Optional[int] = None
+    try:
+        for chunk in response.iter_content(chunk_size):
+            # only search the new bytes (and enough of the old ones for a marker
+            # straddling two chunks)
+            searched = len(body)
+            body += chunk
+            if found_at is None:
+                found_at = body.find(start, max(searched - len(start) + 1, 0))
+                if found_at < 0:
+                    found_at = None
+                    continue
+                searched = found_at
+            stop = body.find(end, max(searched - len(end) + 1, found_at))
+            if stop >= 0:
+                del body[stop:]
+                break
+    finally:
+        response.close()
+    return bytes(body).decode(response.encoding or "utf-8", errors="replace")
+
+
+def iter_text(
+    response: requests.Response, *, chunk_size: int = 16_384
+) -> Iterator[str]:
+    """
+    Decode the body of a streamed response, one chunk at a time.
+
+    Args:
+        response: response of a request sent with `stream=True`.
+        chunk_size: number of bytes read at a time.
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")("replace")
+    try:
+        for chunk in response.iter_content(chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+    finally:
+        response.close()
+
+
+class _SelogerLinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        attributes = dict(attrs)
+        href = attributes.get("href")
+        if (attributes.get("name") == SELOGER_LINK_NAME) and href:
+            if SELOGER_LINK_RE.search(href):
+                self.links.append(href)
+
+
+def _seloger_links_from_soup(html: str) -> List[str]:
+    soup = BeautifulSoup(html, "html.parser")
+    return [
+        link["href"]
+        for link in soup.find_all(
+            "a", attrs={"name": SELOGER_LINK_NAME, "href": SELOGER_LINK_RE}
+        )
+    ]
+
+
+def seloger_listing_id(url: str) -> Optional[str]:
+    """Parse seloger's listing id out of the url of a listing."""
+    match = SELOGER_LISTING_ID_RE.search(urlparse(url).path)
+    return match.group(1) if match else None
+
+
+def seloger_links(chunks: Iterable[str]) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Extract the links to the listings of a seloger results page, as it is read.
+
+    The page is tokenized incrementally, without building a tree. If that doesn't
+    yield any link, we fall back to parsing the whole page with BeautifulSoup.
+
+    Args:
+        chunks: the html of the page, in chunks (e.g. as returned by
+            :func:`iter_text`).
+
+    Yields:
+        the canonical url of each listing, without query string, and seloger's
+        listing id, if it could be parsed out of the url. Listings showing up more
+        than once are only yielded the first time.
+    """
+    parser: Optional[_SelogerLinkParser] = _SelogerLinkParser()
+    read: List[str] = []
+    links_seen, ids_seen = set(), set()
+
+    def _drain(links: Iterable[str]) -> Iterator[Tuple[str, Optional[str]]]:
+        for link in links:
+            link = urljoin(link, urlparse(link).path)
+            listing_id = seloger_listing_id(link)
+            if (link in links_seen) or (listing_id in ids_seen):
+                continue
+            links_seen.add(link)
+            if listing_id is not None:
+                ids_seen.add(listing_id)
+            yield link, listing_id
+
+    for chunk in chunks:
+        read.append(chunk)
+        if parser is None:
+            continue
+        try:
+            parser.feed(chunk)
+        except Exception:
+            logger.debug("Failed to tokenize the results page.", exc_info=True)
+            parser = None
+            continue
+        yield from _drain(parser.links)
+        parser.links.clear()
+    if parser is not None:
+        parser.close()
+        yield from _drain(parser.links)
+
+    if (parser is None) or not links_seen:
+        yield from _drain(_seloger_links_from_soup("".join(read)))
+
+
+def seloger_config_detail(html: str) -> Dict[str, str]:
+    """Extract the fields of the `ConfigDetail` object of a seloger listing page."""
+    return dict(CONFIG_DETAIL_FIELD_RE.findall(html))
+
+
+def seloger_listing(matches: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Convert the fields of a seloger `ConfigDetail` object to the listing's data.
+
+    Args:
+        matches: fields of the `ConfigDetail` object, as returned by
+            :func:`seloger_config_detail`.
+    """
+    data: Dict[str, Any] = {}
+    for field, key in SELOGER_FIELDS.items():
+        value = matches.get(key, None)
+        if (field in SELOGER_NUMERICAL_FIELDS) and (value is not None):
+            # replace the french decimal comma with the decimal point
+            try:
+                value = float(value.replace(",", "."))
+            except ValueError:
+                pass
+        data[field] = value
+    data["description"] = decode_escapes(data["description"])
+    data["bathrooms"] = (
+        float(matches.get("bain", 0) or 0) + float(matches.get("eau", 0) or 0) / 2
+    )
+    data["currency"] = "€"
+    return data
+
+
+class _Feature(object):
+    def __init__(
+        self, field: str, section: str, pattern: str, group: int, cast: Callable
+    ):
+        self.field = field
+        self.section = section
+        self.pattern = pattern
+        self.regex: Pattern = re.compile(pattern, re.IGNORECASE)
+        self.group = group
+        self.cast = cast
+
+
+_SELOGER_FEATURES = [_Feature(*feature) for feature in SELOGER_FEATURES]
+_SELOGER_FEATURES_BY_SECTION: Dict[str, List[_Feature]] = {}
+for _feature in _SELOGER_FEATURES:
+    _SELOGER_FEATURES_BY_SECTION.setdefault(_feature.section, []).append(_feature)
+
+
+def seloger_features(details: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    Extract the features of a listing (garden, pool, exposure, etc.) from its details.
+
+    The criteria of the details document are indexed by section once, and every
+    feature pattern is then evaluated in a single pass over the criteria.
+
+    Args:
+        details: the listing's details document, from seloger's
+            caracteristique_bien.json endpoint.
+
+    Returns:
+        the value of each of the fields in :data:`SELOGER_FEATURES`. Missing
+        features are False, or None for non-boolean fields.
+    """
+    assert isinstance(details["categories"], list)
+    sections: Dict[str, List[List[Mapping[str, Any]]]] = {}
+    for category in details["categories"]:
+        if category["name"] in _SELOGER_FEATURES_BY_SECTION:
+            sections.setdefault(category["name"], []).append(category["criteria"])
+
+    found: Dict[str, List[Match]] = {feature.field: [] for feature in _SELOGER_FEATURES}
+    for section, features in _SELOGER_FEATURES_BY_SECTION.items():
+        criteria = sections.get(section)
+        if not criteria:
+            continue
+        assert len(criteria) == 1
+        for criterion in criteria[0]:
+            for feature in features:
+                match = feature.regex.search(criterion["value"])
+                if match:
+                    found[feature.field].append(match)
+
+    data: Dict[str, Any] = {}
+    for feature in _SELOGER_FEATURES:
+        matches = found[feature.field]
+        if not matches:
+            data[feature.field] = False if feature.cast is bool else None
+        elif feature.cast is bool:
+            data[feature.field] = True
+        elif len(matches) > 1:
+            msg = (
+                f"Unexpectedly got several matches while searching for "
+                f"'{feature.pattern}' in section '{feature.section}'."
+            )
+            raise RuntimeError(msg)
+        else:
+            data[feature.field] = feature.cast(matches[0].group(feature.group))
+
+    if data.get("exposure") is not None:
+        for french, english in SELOGER_EXPOSURES.items():
+            data["exposure"] = data["exposure"].replace(french, english)
+    return data
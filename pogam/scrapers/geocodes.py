@@ -0,0 +1,194 @@
+import csv
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+import sqlalchemy as sa  # type: ignore
+
+from .. import db
+from ..models import GeographicalCode
+from .retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+GeoCode = Tuple[str, str]
+
+# offline tables of geographical codes, shipped with the package if available:
+# one csv file per source, with columns 'post_code', 'geo_type' and 'geo_code'.
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "data")
+
+
+class GeoCodeResolver(object):
+    """
+    Convert French post codes to a source's own geographical codes.
+
+    Codes are looked up, in order, in memory, in the source's offline table (if any),
+    in the `geographical_codes` table and, as a last resort, on the source's website.
+    Codes fetched from the website are saved in the `geographical_codes` table, and
+    considered valid for `ttl`.
+
+    Database access happens on the calling thread only, which must be in an app
+    context.
+
+    Args:
+        source: name of the source, e.g. 'seloger'.
+        fetch: function fetching the code of a post code from the source's website.
+            Should raise ValueError for unknown post codes.
+        ttl: time after which the codes saved in the database are fetched again.
+        offline_table: path to the offline table. Defaults to
+            `DATA_FOLDER/<source>_geographical_codes.csv`, if it exists.
+        retry: keyword arguments of the :class:`RetryPolicy` used when fetching a
+            code fails.
+        max_workers: maximum number of codes fetched at the same time.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        fetch: Callable[[str], GeoCode],
+        *,
+        ttl: timedelta = timedelta(days=90),
+        offline_table: Optional[str] = None,
+        retry: Optional[Dict] = None,
+        max_workers: int = 8,
+    ):
+        self.source = source
+        self.fetch = fetch
+        self.ttl = ttl
+        if offline_table is None:
+            offline_table = os.path.join(
+                DATA_FOLDER, f"{source}_geographical_codes.csv"
+            )
+        self.offline_table = offline_table
+        self.retry = retry if retry is not None else {"max_attempts": 3}
+        self.max_workers = max_workers
+        self._codes: Dict[str, GeoCode] = {}
+        self._offline: Optional[Dict[str, GeoCode]] = None
+
+    def _load_offline_table(self) -> Dict[str, GeoCode]:
+        if self._offline is None:
+            self._offline = {}
+            if os.path.exists(self.offline_table):
+                with open(self.offline_table, newline="") as f:
+                    for row in csv.DictReader(f):
+                        self._offline[row["post_code"]] = (
+                            row["geo_type"],
+                            row["geo_code"],
+                        )
+                msg = (
+                    f"Loaded {len(self._offline)} {self.source} geographical codes "
+                    f"from {self.offline_table}."
+                )
+                logger.debug(msg)
+        return self._offline
+
+    def _query(self, post_codes: Iterable[str]) -> Dict[str, GeoCode]:
+        expires_at = datetime.utcnow() - self.ttl
+        rows = GeographicalCode.query.filter(
+            GeographicalCode.source == self.source,
+            GeographicalCode.post_code.in_(list(post_codes)),
+            GeographicalCode.fetched_at > expires_at,
+        ).all()
+        return {row.post_code: (row.geo_type, row.geo_code) for row in rows}
+
+    def _fetch(self, post_code: str) -> GeoCode:
+        retry = RetryPolicy(**self.retry)
+        for attempt in retry.attempts():
+            try:
+                return self.fetch(post_code)
+            except requests.exceptions.RequestException:
+                if attempt + 1 >= retry.max_attempts:
+                    raise
+        msg = f"Failed to fetch the geographical code of '{post_code}'."
+        raise RuntimeError(msg)
+
+    def _save(self, codes: Dict[str, GeoCode]):
+        now = datetime.utcnow()
+        try:
+            rows = {
+                row.post_code: row
+                for row in GeographicalCode.query.filter(
+                    GeographicalCode.source == self.source,
+                    GeographicalCode.post_code.in_(list(codes)),
+                )
+            }
+            for post_code, (geo_type, geo_code) in codes.items():
+                row = rows.get(post_code)
+                if row is None:
+                    row = GeographicalCode(source=self.source, post_code=post_code)
+                    db.session.add(row)
+                row.geo_type, row.geo_code, row.fetched_at = geo_type, geo_code, now
+            db.session.commit()
+        except sa.exc.SQLAlchemyError:
+            # e.g. a concurrent scrape saved the same codes first
+            db.session.rollback()
+            logger.debug("Failed to save geographical codes.", exc_info=True)
+
+    def resolve(self, post_code: str) -> GeoCode:
+        """Convert a single post code. See :meth:`resolve_many`."""
+        return self.resolve_many([post_code])[0]
+
+    def resolve_many(self, post_codes: Iterable[str]) -> List[GeoCode]:
+        """
+        Convert post codes, fetching the ones we don't know yet concurrently.
+
+        Args:
+            post_codes: standard French post codes.
+
+        Returns:
+            for each post code, the type of geographical code and the code itself,
+            in the source's nomenclature.
+
+        Raises:
+            ValueError if the source doesn't know one of the post codes.
+        """
+        post_codes = [str(post_code) for post_code in post_codes]
+        missing = [p for p in dict.fromkeys(post_codes) if p not in self._codes]
+
+        offline = self._load_offline_table()
+        self._codes.update({p: offline[p] for p in missing if p in offline})
+        missing = [p for p in missing if p not in self._codes]
+
+        if missing:
+            self._codes.update(self._query(missing))
+            missing = [p for p in missing if p not in self._codes]
+
+        errors: Dict[str, Exception] = {}
+        if missing:
+            msg = f"Fetching {len(missing)} {self.source} geographical codes."
+            logger.debug(msg)
+            workers = min(self.max_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {p: executor.submit(self._fetch, p) for p in missing}
+            fetched = {}
+            for post_code, future in futures.items():
+                try:
+                    fetched[post_code] = future.result()
+                except Exception as e:
+                    errors[post_code] = e
+            if fetched:
+                self._save(fetched)
+                self._codes.update(fetched)
+
+        for post_code in post_codes:
+            if post_code in errors:
+                raise errors[post_code]
+        return [self._codes[post_code] for post_code in post_codes]
+
+    def export(self, path: str):
+        """
+        Write all the codes saved in the database to an offline table.
+        """
+        rows = (
+            GeographicalCode.query.filter(GeographicalCode.source == self.source)
+            .order_by(GeographicalCode.post_code)
+            .all()
+        )
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["post_code", "geo_type", "geo_code"])
+            for row in rows:
+                writer.writerow([row.post_code, row.geo_type, row.geo_code])
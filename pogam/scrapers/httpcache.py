@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# headers describing the cached body, rather than the exchange that fetched it
+STORED_HEADERS = ["content-type", "etag", "last-modified"]
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a url, so that equivalent urls share the same cache entry.
+
+    The scheme and host are lower-cased, default ports and fragments dropped, and the
+    query parameters sorted.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class CachedResponse(object):
+    """
+    A response stored in the cache.
+
+    The body stays compressed until the response is actually replayed.
+    """
+
+    def __init__(self, url: str, status_code: int, headers: Dict, body: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """Headers making a request conditional on the cached body being stale."""
+        headers = {}
+        if self.headers.get("etag"):
+            headers["If-None-Match"] = self.headers["etag"]
+        if self.headers.get("last-modified"):
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+    def replay(self, not_modified: requests.Response) -> requests.Response:
+        """
+        Build the response to a conditional request the server answered with a 304.
+
+        Args:
+            not_modified: the server's 304 response.
+
+        Returns:
+            the cached response, with the headers refreshed by the 304.
+        """
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.headers.update(
+            {k: v for k, v in not_modified.headers.items() if k.lower() in self.headers}
+        )
+        response._content = zlib.decompress(self.body)
+        response._content_consumed = True
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.elapsed = not_modified.elapsed
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.from_cache = True  # type: ignore
+        not_modified.close()
+        return response
+
+
+class ResponseCache(object):
+    """
+    Cache of responses, to revalidate instead of downloading them again.
+
+    Only successful GET responses carrying an `ETag` or a `Last-Modified` header are
+    cached, since they are the only ones we can revalidate. Bodies are compressed and
+    the least recently used entries are evicted once the cache grows past `max_size`.
+    The total size of the bodies is kept up to date as they are added and evicted,
+    rather than added up on every write.
+
+    The cache is a sqlite database, safe to share between the engine's workers and
+    between concurrent scrapes.
+
+    Args:
+        path: path of the database. Defaults to the `POGAM_HTTP_CACHE` environment
+            variable, or ~/.pogam/http_cache.sqlite (/tmp/pogam/http_cache.sqlite on
+            AWS Lambda, where the home folder is read-only).
+        max_size: maximum total size of the compressed bodies, in bytes.
+    """
+
+    def __init__(self, path: Optional[str] = None, *, max_size: int = 256 * 2**20):
+        if path is None:
+            if os.getenv("LAMBDA_TASK_ROOT"):
+                default = "/tmp/pogam/http_cache.sqlite"
+            else:
+                default = os.path.expanduser("~/.pogam/http_cache.sqlite")
+            path = os.getenv("POGAM_HTTP_CACHE", default)
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, status_code INTEGER, headers TEXT, body BLOB, "
+            "size INTEGER, last_used REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_responses_last_used "
+            "ON responses (last_used)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        # caches from before we kept count
+        self._connection.execute(
+            "INSERT OR IGNORE INTO stats (key, value) "
+            "SELECT 'size', COALESCE(SUM(size), 0) FROM responses"
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()
+        return count
+
+    @property
+    def size(self) -> int:
+        """Total size of the compressed bodies, in bytes."""
+        with self._lock:
+            return self._size()
+
+    def _size(self) -> int:
+        (size,) = self._connection.execute(
+            "SELECT value FROM stats WHERE key = 'size'"
+        ).fetchone()
+        return size
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """Return the cached response for a url, if any, and mark it as used."""
+        url = normalize_url(url)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status_code, headers, body FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE responses SET last_used = ? WHERE url = ?", (time.time(), url)
+            )
+        status_code, headers, body = row
+        return CachedResponse(url, status_code, json.loads(headers), body)
+
+    @staticmethod
+    def cacheable(response: requests.Response) -> bool:
+        """Whether we will be able to revalidate a response, if we cache it."""
+        return (response.status_code == 200) and bool(
+            response.headers.get("etag") or response.headers.get("last-modified")
+        )
+
+    def put(self, url: str, response: requests.Response) -> bool:
+        """
+        Cache a response, if we will be able to revalidate it.
+
+        For streamed responses, this reads the rest of the body. See
+        :meth:`put_when_read` to wait for the caller to read it instead.
+
+        Returns:
+            whether the response was cached.
+        """
+        if not self.cacheable(response):
+            return False
+        return self._store(url, response, response.content)
+
+    def put_when_read(self, url: str, response: requests.Response) -> bool:
+        """
+        Cache a streamed response, once (and only if) its whole body has been read.
+
+        Returns:
+            whether the response will be cached once read.
+        """
+        if not self.cacheable(response):
+            return False
+        iter_content = response.iter_content
+
+        def _iter_content(chunk_size=1, decode_unicode=False):
+            def _chunks():
+                body = bytearray()
+                for chunk in iter_content(chunk_size):
+                    body += chunk
+                    yield chunk
+                try:
+                    self._store(url, response, bytes(body))
+                except Exception:
+                    # the caller got its body, caching it is only a bonus
+                    logger.debug(
+                        f"Failed to cache the response to {url}.", exc_info=True
+                    )
+
+            chunks = _chunks()
+            if decode_unicode:
+                chunks = requests.utils.stream_decode_response_unicode(chunks, response)
+            return chunks
+
+        response.iter_content = _iter_content  # type: ignore
+        return True
+
+    def _store(self, url: str, response: requests.Response, content: bytes) -> bool:
+        headers = {
+            k.lower(): v
+            for k, v in response.headers.items()
+            if k.lower() in STORED_HEADERS
+        }
+        body = zlib.compress(content)
+        if len(body) > self.max_size:
+            return False
+
+        url = normalize_url(url)
+        with self._lock:
+            # the size of the cache must move along with its entries, even when
+            # another scrape writes to it at the same time
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT size FROM responses WHERE url = ?", (url,)
+                ).fetchone()
+                replaced = row[0] if row is not None else 0
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(url, status_code, headers, body, size, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        url,
+                        response.status_code,
+                        json.dumps(headers),
+                        body,
+                        len(body),
+                        time.time(),
+                    ),
+                )
+                self._connection.execute(
+                    "UPDATE stats SET value = value + ? WHERE key = 'size'",
+                    (len(body) - replaced,),
+                )
+                self._evict()
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return True
+
+    def _evict(self):
+        if self._size() <= self.max_size:
+            return
+        rows = self._connection.execute(
+            "SELECT url, size FROM responses ORDER BY last_used DESC"
+        ).fetchall()
+        # keep the most recently used responses that fit, evict all the older ones
+        size = 0
+        kept = 0
+        evicted = []
+        for url, entry_size in rows:
+            size += entry_size
+            if size > self.max_size:
+                evicted.append((url,))
+            else:
+                kept = size
+        self._connection.executemany("DELETE FROM responses WHERE url = ?", evicted)
+        self._connection.execute(
+            "UPDATE stats SET value = ? WHERE key = 'size'", (kept,)
+        )
+        logger.debug(f"Evicted {len(evicted)} responses from the cache.")
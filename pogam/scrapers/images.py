@@ -0,0 +1,574 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import IO, Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+import sqlalchemy as sa  # type: ignore
+
+from .. import db
+from ..models import Image, ImageDownload, ImageUrl, Listing, ListingImage
+from . import exceptions
+from .engine import Engine
+from .retry import RetryPolicy
+
+try:
+    import boto3  # type: ignore
+    from boto3.exceptions import S3UploadFailedError  # type: ignore
+    from botocore.exceptions import ClientError  # type: ignore
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+StoredImage = Dict[str, Any]
+
+# images are read from the network, hashed and written out by chunks of this size...
+CHUNK_SIZE = 64 * 2**10
+# ... and spooled in memory up to this size, on their way to S3
+SPOOL_SIZE = 2**20
+
+
+def url_hash(url: str) -> str:
+    """Digest of a url, to index urls of any length."""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class ImageStore(object):
+    """
+    Where images are stored: the images folder or, on AWS Lambda, the bucket.
+
+    Paths are relative to the images folder (or the bucket). Stores are safe to share
+    between threads.
+    """
+
+    def __init__(self):
+        self.is_aws_invocation = os.getenv("LAMBDA_TASK_ROOT") is not None
+        if self.is_aws_invocation:
+            # clients of the default session can't be shared between threads, but a
+            # client of our own session can
+            self._s3 = boto3.session.Session().client("s3")
+            self.bucket = os.getenv("BUCKET_NAME")
+        else:
+            self.folder = os.getenv(
+                "POGAM_IMAGES_FOLDER",
+                os.path.join(os.path.expanduser("~/.pogam/images")),
+            )
+
+    @staticmethod
+    def default() -> "ImageStore":
+        """
+        The bucket when running in AWS. Otherwise, the images folder or, if the
+        `POGAM_IMAGES_BACKEND` environment variable is 'pack', a :class:`PackStore` in
+        the images folder.
+        """
+        if (os.getenv("LAMBDA_TASK_ROOT") is None) and (
+            os.getenv("POGAM_IMAGES_BACKEND", "files") == "pack"
+        ):
+            # the pack store builds on this module
+            from .packs import PackStore
+
+            return PackStore()
+        return ImageStore()
+
+    def exists(self, path: str) -> bool:
+        """Whether an image is stored at a given path."""
+        if self.is_aws_invocation:
+            try:
+                self._s3.head_object(Bucket=self.bucket, Key=path)
+            except ClientError:
+                return False
+            return True
+        return os.path.exists(os.path.join(self.folder, path))
+
+    def read(self, path: str) -> bytes:
+        """
+        Read a stored image.
+
+        Raises:
+            FileNotFoundError if there is no image at that path.
+        """
+        if self.is_aws_invocation:
+            try:
+                response = self._s3.get_object(Bucket=self.bucket, Key=path)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") == "NoSuchKey":
+                    raise FileNotFoundError(path) from e
+                raise
+            return response["Body"].read()
+        with open(os.path.join(self.folder, path), "rb") as f:
+            return f.read()
+
+    def write(self, path: str, content: bytes):
+        """Store a (small) image."""
+        if self.is_aws_invocation:
+            self._s3.put_object(Body=content, Bucket=self.bucket, Key=path)
+            return
+        local_path = os.path.join(self.folder, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as f:
+            f.write(content)
+
+    def spool(self) -> IO[bytes]:
+        """
+        Open a temporary file to write an image to, before it is :meth:`put` in store.
+        """
+        if self.is_aws_invocation:
+            return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        # on the same file system as the images, to move it there once complete
+        folder = os.path.join(self.folder, "tmp")
+        os.makedirs(folder, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=folder, delete=False)
+
+    def put(self, f: IO[bytes], path: str):
+        """Store an image written to a file opened with :meth:`spool`."""
+        if self.is_aws_invocation:
+            f.seek(0)
+            self._s3.upload_fileobj(f, self.bucket, path)
+            return
+        f.close()
+        local_path = os.path.join(self.folder, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        os.replace(f.name, local_path)
+
+    def discard(self, f: IO[bytes]):
+        """Clean up after a file opened with :meth:`spool`, stored or not."""
+        f.close()
+        if not self.is_aws_invocation and os.path.exists(f.name):
+            os.remove(f.name)
+
+
+class ImagePipeline(object):
+    """
+    Download listings' images and store them, concurrently.
+
+    Images are downloaded through the engine, then written to the images folder or,
+    on AWS Lambda, uploaded to the bucket. Each image is handled by one of the
+    pipeline's own workers, so that downloads and uploads overlap across images and
+    across listings, while the engine still bounds the number of concurrent requests
+    to each host.
+
+    Images are stored by content: an image that was already stored, e.g. for another
+    listing, is not stored again. Images whose remote url is already known (see
+    :class:`ImageIndex`) are not even downloaded.
+
+    Images are streamed, chunk by chunk, from the response to a temporary file next to
+    the images folder, or to a spooled temporary file uploaded to S3, so that memory
+    usage does not grow with the size of the images. Images larger than
+    `max_image_size` are dropped. The bytes downloaded and stored are metered in
+    `bytes_downloaded` and `bytes_stored`.
+
+    The pipeline has its own workers because the engine's workers wait on it: sharing
+    them could deadlock.
+
+    Args:
+        engine: engine through which to download the images.
+        retry: policy for retrying failed downloads.
+        max_workers: maximum number of images handled at the same time.
+        max_image_size: maximum size of an image, in bytes.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        retry: RetryPolicy,
+        *,
+        max_workers: int = 16,
+        max_image_size: int = 20 * 2**20,
+    ):
+        self.engine = engine
+        self.retry = retry
+        self.max_image_size = max_image_size
+        self.bytes_downloaded = 0
+        self.bytes_stored = 0
+        self._lock = threading.Lock()
+        self._stored: set = set()
+        self.store = ImageStore.default()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pogam-images"
+        )
+
+    def __enter__(self) -> "ImagePipeline":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Wait for the images in progress and stop the workers."""
+        self._executor.shutdown(wait=True)
+
+    def _meter(self, name: str, size: int):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + size)
+
+    def _read(
+        self, response: requests.Response, f: IO[bytes]
+    ) -> Optional[Tuple[str, int]]:
+        content_length = response.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_image_size:
+            return None
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            self._meter("bytes_downloaded", len(chunk))
+            if size > self.max_image_size:
+                return None
+            digest.update(chunk)
+            f.write(chunk)
+        return digest.hexdigest(), size
+
+    def _download(
+        self,
+        url: str,
+        f: IO[bytes],
+        headers: Mapping[str, str],
+        proxies: Mapping[str, str],
+        timeout: int,
+    ) -> Optional[Tuple[str, int]]:
+        for _ in self.retry.attempts():
+            f.seek(0)
+            f.truncate()
+            try:
+                # no need to revalidate images: the image index already spares us
+                # the urls we downloaded, and the bodies belong in the store rather
+                # than in the response cache
+                response = self.engine.get(
+                    url,
+                    headers=headers,
+                    proxies=proxies,
+                    timeout=timeout,
+                    stream=True,
+                    use_cache=False,
+                )
+            except exceptions.CircuitOpen:
+                # no point in trying again until the circuit closes
+                return None
+            except requests.exceptions.RequestException:
+                continue
+            try:
+                if response.status_code >= 400:
+                    continue
+                result = self._read(response, f)
+                if result is None:
+                    msg = f"Image at {url} is larger than {self.max_image_size} bytes."
+                    logger.warning(msg)
+                return result
+            except requests.exceptions.RequestException:
+                # the connection dropped while we were reading the image
+                continue
+            finally:
+                response.close()
+        return None
+
+    def _exists(self, path: str) -> bool:
+        with self._lock:
+            if path in self._stored:
+                return True
+        return self.store.exists(path)
+
+    def _store(self, i: int, f: IO[bytes], path: str, size: int) -> bool:
+        if self._exists(path):
+            logger.debug(f"Image #{i} is already stored as {path}.")
+            return True
+        try:
+            self.store.put(f, path)
+        except (ClientError, S3UploadFailedError):
+            msg = f"Could not upload image #{i}."
+            logger.exception(msg)
+            return False
+        self._meter("bytes_stored", size)
+        return True
+
+    def _process(
+        self,
+        i: int,
+        url: str,
+        headers: Mapping[str, str],
+        proxies: Mapping[str, str],
+        timeout: int,
+    ) -> Optional[StoredImage]:
+        with self.store.spool() as f:
+            try:
+                downloaded = self._download(url, f, headers, proxies, timeout)
+                if downloaded is None:
+                    msg = f"Could not download image #{i}."
+                    logger.warning(msg)
+                    return None
+                digest, size = downloaded
+                logger.debug(f"Downloaded image #{i} ({size} bytes).")
+
+                _, extension = os.path.splitext(urlparse(url).path)
+                path = f"images/{digest[:2]}/{digest}{extension}"
+                if not self._store(i, f, path, size):
+                    return None
+            finally:
+                self.store.discard(f)
+        with self._lock:
+            self._stored.add(path)
+        return {"url": url, "hash": digest, "path": path, "size": size}
+
+    def submit(
+        self,
+        urls: Sequence[str],
+        *,
+        headers: Mapping[str, str],
+        proxies: Mapping[str, str],
+        timeout: int,
+        known: Optional[Mapping[str, StoredImage]] = None,
+    ) -> List[Future]:
+        """
+        Queue the images of a listing.
+
+        Args:
+            urls: urls of the listing's images, in order.
+            headers: headers to be included in the requests (e.g. User-Agent).
+            proxies: proxies to route the requests through.
+            timeout: maximum amount of time, in seconds, to wait for an image to load.
+            known: images already stored, by remote url.
+
+        Returns:
+            for each image, in order, a future of its url, hash, size and path
+            relative to the images folder, or of None if we could not download or
+            store it.
+        """
+        futures = []
+        for i, url in enumerate(urls):
+            if known and url in known:
+                future: Future = Future()
+                future.set_result(known[url])
+            else:
+                future = self._executor.submit(
+                    self._process, i, url, headers, proxies, timeout
+                )
+            futures.append(future)
+        return futures
+
+    def fetch(self, urls: Sequence[str], **kwargs) -> List[Optional[StoredImage]]:
+        """
+        Download and store the images of a listing. See :meth:`submit`.
+
+        Returns:
+            the images, in order, None for the ones that failed.
+        """
+        return [future.result() for future in self.submit(urls, **kwargs)]
+
+
+class ImageIndex(object):
+    """
+    Images stored so far, by remote url, and the listings they belong to.
+
+    Database access happens on the calling thread only, which must be in an app
+    context.
+    """
+
+    def known(self, urls: Iterable[str]) -> Dict[str, StoredImage]:
+        """
+        Look up the images already downloaded from some remote urls.
+
+        Returns:
+            the known images, by remote url.
+        """
+        hashes = {url_hash(url): url for url in urls}
+        if not hashes:
+            return {}
+        rows = (
+            db.session.query(ImageUrl.url_hash, Image.hash, Image.path, Image.size)
+            .join(Image, ImageUrl.image_id == Image.id)
+            .filter(ImageUrl.url_hash.in_(sorted(hashes)))
+            .all()
+        )
+        return {
+            hashes[row[0]]: {
+                "url": hashes[row[0]],
+                "hash": row[1],
+                "path": row[2],
+                "size": row[3],
+            }
+            for row in rows
+        }
+
+    def add(
+        self,
+        images: Sequence[Optional[StoredImage]],
+        listing: Optional[Listing] = None,
+    ):
+        """
+        Record stored images, and which listing they belong to, in the session.
+
+        Args:
+            images: the listing's images, in order, as returned by
+                :meth:`ImagePipeline.fetch`.
+            listing: the listing, if it is new.
+        """
+        stored = [(i, image) for i, image in enumerate(images) if image is not None]
+        if not stored:
+            return
+        try:
+            # a concurrent scrape may record the same images first: we don't want
+            # that to cost us the listing.
+            with db.session.begin_nested():
+                rows = {
+                    row.hash: row
+                    for row in Image.query.filter(
+                        Image.hash.in_({image["hash"] for _, image in stored})
+                    )
+                }
+                url_hashes = {url_hash(image["url"]) for _, image in stored}
+                known_urls = {
+                    h
+                    for (h,) in db.session.query(ImageUrl.url_hash).filter(
+                        ImageUrl.url_hash.in_(url_hashes)
+                    )
+                }
+                for position, image in stored:
+                    row = rows.get(image["hash"])
+                    if row is None:
+                        row = Image(
+                            hash=image["hash"], path=image["path"], size=image["size"]
+                        )
+                        db.session.add(row)
+                        rows[image["hash"]] = row
+                    h = url_hash(image["url"])
+                    if h not in known_urls:
+                        db.session.add(
+                            ImageUrl(url_hash=h, url=image["url"], image=row)
+                        )
+                        known_urls.add(h)
+                    if listing is not None:
+                        db.session.add(
+                            ListingImage(listing=listing, image=row, position=position)
+                        )
+        except sa.exc.IntegrityError:
+            logger.debug("Failed to record the images.", exc_info=True)
+
+
+class ImageQueue(object):
+    """
+    Durable queue of image downloads, deferred until after their listing is ingested.
+
+    Scrapes :meth:`push` the images of the listings they ingest, and separate workers
+    :meth:`claim` batches of downloads and :meth:`complete` them. Once all the images
+    of a listing are done with, the stored ones are recorded in `Listing.images`.
+
+    The queue is the image_downloads table, so that it survives crashes and is shared
+    between processes. Downloads claimed by a worker that died are handed out again
+    once their lease expires. Failed downloads are retried up to `max_attempts`
+    times, by later claims.
+
+    Database access happens on the calling thread only, which must be in an app
+    context.
+
+    Args:
+        lease: time, in seconds, after which a claimed download that was not
+            completed can be claimed again.
+        max_attempts: number of claims after which we give up on a download.
+    """
+
+    def __init__(self, *, lease: float = 600, max_attempts: int = 3):
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def push(self, listing: Listing, urls: Sequence[str]):
+        """
+        Queue the images of a listing, in the session.
+
+        Args:
+            listing: the listing, without images yet.
+            urls: urls of the listing's images, in order.
+        """
+        if not urls:
+            return
+        for position, url in enumerate(urls):
+            db.session.add(ImageDownload(listing=listing, position=position, url=url))
+        listing.images_status = "pending"
+
+    def __len__(self) -> int:
+        return ImageDownload.query.filter(
+            ImageDownload.status.in_(["pending", "running"])
+        ).count()
+
+    def claim(self, limit: int) -> List[ImageDownload]:
+        """
+        Hand out the oldest downloads nobody is working on, and commit.
+
+        Args:
+            limit: maximum number of downloads to claim.
+        """
+        now = datetime.utcnow()
+        expired = now - timedelta(seconds=self.lease)
+        downloads = (
+            ImageDownload.query.filter(
+                (ImageDownload.status == "pending")
+                | (
+                    (ImageDownload.status == "running")
+                    & (ImageDownload.claimed_at < expired)
+                )
+            )
+            .order_by(ImageDownload.id)
+            .limit(limit)
+            # concurrent workers skip each other's downloads, where supported
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for download in downloads:
+            download.status = "running"
+            download.claimed_at = now
+            download.attempts += 1
+        db.session.commit()
+        return downloads
+
+    def complete(self, results: Sequence[Tuple[ImageDownload, Optional[StoredImage]]]):
+        """
+        Record the outcome of claimed downloads, and commit.
+
+        Args:
+            results: each download, with the stored image or None if it failed.
+        """
+        listing_ids = set()
+        for download, image in results:
+            if image is not None:
+                download.status = "done"
+                download.hash = image["hash"]
+                download.path = image["path"]
+                download.size = image["size"]
+            elif download.attempts >= self.max_attempts:
+                download.status = "failed"
+            else:
+                download.status = "pending"
+            listing_ids.add(download.listing_id)
+        db.session.flush()
+        for listing_id in sorted(listing_ids):
+            self._finish(listing_id)
+        db.session.commit()
+
+    def _finish(self, listing_id: int):
+        downloads = (
+            ImageDownload.query.filter_by(listing_id=listing_id)
+            .order_by(ImageDownload.position)
+            .all()
+        )
+        if any(d.status in ("pending", "running") for d in downloads):
+            return
+        images = [
+            (
+                {"url": d.url, "hash": d.hash, "path": d.path, "size": d.size}
+                if d.status == "done"
+                else None
+            )
+            for d in downloads
+        ]
+        listing = Listing.query.get(listing_id)
+        ImageIndex().add(images, listing)
+        listing.images = [image["path"] for image in images if image] or None
+        # derived again, now that the images are in
+        listing.image_variants = None
+        listing.images_status = (
+            "done" if all(d.status == "done" for d in downloads) else "failed"
+        )
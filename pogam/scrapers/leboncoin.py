@@ -1,12 +1,23 @@
 import logging
-import os
-import random
-import time
-import uuid
+import math
+from copy import deepcopy
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple, Union, cast
-from urllib.parse import urlparse
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 import pytz
 import requests
@@ -14,18 +25,75 @@ from fake_useragent import UserAgent  # type: ignore
 
 from . import exceptions
 from .. import db
-from ..models import Listing, Property
-from .proxies import all_proxies
-
-try:
-    import boto3  # type: ignore
-    from botocore.exceptions import ClientError  # type: ignore
-except ImportError:  # pragma: no cover
-    boto3 = None
-
+from ..models import ImageDownload, Listing
+from .dedup import ListingIndex
+from .engine import Engine
+from .httpcache import ResponseCache
+from .images import ImageIndex, ImagePipeline, ImageQueue
+from .proxies import ProxyCache, ProxyPool
+from .retry import RetryBudget, RetryPolicy
+from .throttle import Throttle
+from .watermarks import SearchWatermark
 
 logger = logging.getLogger(__name__)
 
+# pace of the requests to leboncoin's search API, in requests per second.
+# we start where the random 5-35 seconds sleep between pages used to average and let
+# the rate controller speed up or back off from there.
+RATES = {
+    "api.leboncoin.fr": {
+        "rate": 1 / 20,
+        "min_rate": 1 / 60,
+        "max_rate": 1,
+        "increase": 1 / 20,
+    }
+}
+
+# backoff between attempts at a request, and total number of retries over a scrape.
+RETRY = {"max_attempts": 10, "base_delay": 1, "max_delay": 30}
+IMAGE_RETRY = {"max_attempts": 4, "base_delay": 0.5, "max_delay": 5}
+RETRY_BUDGET = 200
+
+# paginating deep into a search is slow and unreliable: large searches are split into
+# shards of at most that many results. Open-ended price and size ranges are split at
+# these values first, by transaction.
+MAX_SHARD_RESULTS = 1000
+SHARD_PIVOTS = {
+    "price": {"rent": 1000, "buy": 250_000},
+    "square": {"rent": 40, "buy": 80},
+}
+
+# fields we keep from the ads, from their attributes (and the attributes' field holding
+# the value), and from their location
+AD_FIELDS = {
+    "external_listing_id": "list_id",
+    "first_publication_date": "first_publication_date",
+    "description": "body",
+    "url": "url",
+    "transaction": "category_name",
+    "price": "price",
+}
+ATTRIBUTE_FIELDS = {
+    "property_type": ("real_estate_type", "value_label"),
+    "size": ("square", "value"),
+    "rooms": ("rooms", "value"),
+    "is_furnished": ("furnished", "value"),
+    "charges_included": ("charges_included", "value"),
+    "broker_fee": ("fai", "value"),
+    "broker_fee_is_included": ("fai_included", "value"),
+    "dpe_consumption": ("energy_rate", "value"),
+    "dpe_emissions": ("ges", "value"),
+}
+LOCATION_FIELDS = {
+    "city": "city",
+    "postal_code": "zipcode",
+    "neighborhood": "city_label",
+    "latitude": "lat",
+    "longitude": "lng",
+}
+NULL_VALUES = ["non renseigné"]
+PARIS = pytz.timezone("Europe/Paris")
+
 
 class Transaction(Enum):
     rent = 10
@@ -55,6 +123,9 @@ def leboncoin(
     num_results: int = 100,
     max_duplicates: int = 25,
     timeout: int = 5,
+    incremental: bool = True,
+    defer_images: bool = False,
+    shard: bool = False,
 ) -> Dict[str, Union[List[str], List[Listing]]]:
 
     allowed_transactions = cast(Iterable[str], Transaction._member_names_)
@@ -86,13 +157,8 @@ def leboncoin(
         PropertyType[property_type].value for property_type in property_types
     ]
 
-    # fetch all the listings already processed
-    already_done_urls = [
-        l[0]
-        for l in db.session.query(Listing.url)
-        .filter(Listing.source == "leboncoin")
-        .all()
-    ]
+    # check listings against the database one page of results at a time
+    listing_index = ListingIndex("leboncoin")
 
     # build the search payload
     rooms = {}
@@ -140,280 +206,747 @@ def leboncoin(
     ua = UserAgent()
 
     # get a pool of proxies
-    proxy_pool = all_proxies(infinite=True)
-    proxy = next(proxy_pool)
-
-    # post the query
+    # NB: each search keeps the same proxy and user agent across pages, for as long as
+    # they work
     search_url = "https://api.leboncoin.fr/api/adfinder/v1/search"
+    proxy_cache = ProxyCache.default()
+    proxy_pool = proxy_cache.pool()
     headers = {
-        "User-Agent": ua.random,
         "Accept-Encoding": "gzip, deflate",
         "Accept-Language": "en-US,en;q=0.8,fr;q=0.6",
         "Referer": "https://www.leboncoin.fr/recherche",
         "Origin": "https://www.leboncoin.fr",
     }
-    done_with_all_pages = False
     added_listings: List[Listing] = []
     seen_listings: List[Listing] = []
     failed_listings: List[str] = []
-    done = -1
-    consecutive_duplicates = 0
-    while not done_with_all_pages:
-
-        search_attempts = 0
-        max_search_attempts = 50
-        while search_attempts < max_search_attempts:
-            proxies = {"http": proxy}
+    visited: Set[str] = set()
+    budget = RetryBudget(RETRY_BUDGET)
+    retry = RetryPolicy(**RETRY, budget=budget)
+    image_retry = RetryPolicy(**IMAGE_RETRY, budget=budget)
+    image_index = ImageIndex()
+    with Engine(
+        throttle=Throttle(RATES), proxy_pool=proxy_pool, cache=ResponseCache()
+    ) as engine, ImagePipeline(engine, image_retry) as images:
+
+        def _post(payload, session, headers):
+            return _search(
+                engine,
+                search_url,
+                payload,
+                session,
+                headers,
+                proxy_pool,
+                retry,
+                timeout,
+                lambda: ua.random,
+            )
 
-            try:
-                request = requests.post(
-                    search_url,
-                    headers=headers,
-                    json=payload,
-                    proxies=proxies,
-                    timeout=timeout,
-                )
-            except requests.exceptions.RequestException as e:
-                msg = f"👻Failed to retrieve {search_url} ({type(e).__name__}).👻"
-                logger.debug(msg)
-                proxy = next(proxy_pool)
-                headers.update({"User-Agent": ua.random})
-                search_attempts += 1
-                continue
-            if (
-                ("captcha" in request.text)
-                or ("datadome" in request.text)
-                or (not request.text)
-                or (request.status_code >= 400)
-            ):
-                msg = f"👻Failed to retrieve {request.url} (Captcha).👻"
-                logger.debug(msg)
-                proxy = next(proxy_pool)
-                headers.update({"User-Agent": ua.random})
-                search_attempts += 1
-                continue
-            # https://github.com/pytest-dev/pytest-cov/issues/368
-            break  # pragma: no cover
-        if search_attempts >= max_search_attempts:
-            msg = f"Failed to reach Le Bon Coin API after {search_attempts} attempts."
-            raise RuntimeError(msg)
-        response = request.json()
-
-        # parse json
-        for i, ad in enumerate(response.get("ads", [])):
-            done += 1
-            url = ad.get("url")
-            if url in already_done_urls:
-                msg = f"Skipping ad #{i}, as it is already in our DB: {url}."
-                logger.debug(msg)
-                consecutive_duplicates += 1
-                seen_listings.append(url)
-                continue
+        # large searches are split into shards, sized with count-only queries, that we
+        # paginate side by side
+        if shard:
 
-            msg = f"Parsing ad #{i}: {url} ..."
-            logger.debug(msg)
-            try:
-                listing, is_new = _leboncoin(ad, headers, proxies, timeout)
-            except exceptions.ListingParsingError as e:
-                logger.debug(e)
-                continue
-            except Exception:
-                msg = f"💥Unpexpected error.💥"
-                logging.exception(msg)
-                failed_listings.append(url)
-                continue
-            msg = f"💫Scrape suceeded.💫"
-            logger.debug(msg)
+            def _count(payload):
+                count_payload = dict(payload, limit_alu=0)
+                response = _post(count_payload, (search_url, "count"), dict(headers))
+                return response["total"]
 
-            if is_new:
-                added_listings.append(listing)
-                consecutive_duplicates = 0
-            else:
-                seen_listings.append(listing)
-                consecutive_duplicates += 1
-
-        if (
-            ("pivot" in response)
-            and (consecutive_duplicates <= max_duplicates)
-            and (done <= num_results)
-        ):
-            sleep = random.randint(5, 35)
-            msg = f"Sleeping for {sleep} seconds before going to next page."
+            shards = plan_shards(payload, _count, MAX_SHARD_RESULTS)
+            msg = f"Split the search into {len(shards)} shards."
             logger.debug(msg)
-            time.sleep(sleep)
-            payload.update({"pivot": response["pivot"]})
-            # NB: we keep the same proxy and user agent
         else:
-            done_with_all_pages = True
+            shards = [(payload, num_results)]
+        cursors = [
+            _Cursor(
+                shard_payload,
+                session=search_url if len(shards) == 1 else (search_url, i),
+                headers=headers,
+                num_results=shard_results,
+                incremental=incremental,
+            )
+            for i, (shard_payload, shard_results) in enumerate(shards)
+        ]
+
+        # num_results applies to the whole search, across its shards
+        done = -1
+        failed_shards: Dict[_Cursor, Exception] = {}
+        active = list(cursors)
+        while active:
+            # post the shards' queries concurrently...
+            pages = [
+                engine.submit(_post, cursor.payload, cursor.session, cursor.headers)
+                for cursor in active
+            ]
+            # ... and go through their pages one at a time
+            for cursor, page in zip(active, pages):
+                if done > num_results:
+                    cursor.finished = True
+                    continue
+                try:
+                    response = page.result()
+                except Exception as e:
+                    # give up on the shard, but not on the others
+                    msg = "💥Failed to scrape a shard of the search.💥"
+                    logger.exception(msg)
+                    failed_shards[cursor] = e
+                    cursor.finished = True
+                    continue
+                proxies = {"http": proxy_pool.get(session=cursor.session)}
+                watermark = cursor.watermark
+
+                # parse json
+                ads = response.get("ads", [])
+                reached_watermark = False
+                if watermark is not None:
+                    for i, ad in enumerate(ads):
+                        if watermark.passed(ad.get("index_date")):
+                            msg = (
+                                f"Reached the ads we were done with on "
+                                f"{watermark.value}. Stopping."
+                            )
+                            logger.debug(msg)
+                            ads = ads[:i]
+                            reached_watermark = True
+                            break
+                # ads can show up in more than one shard, e.g. if their price changed
+                # in between pages
+                ads = [ad for ad in ads if ad.get("url") not in visited]
+                visited.update(ad.get("url") for ad in ads)
+                candidates = [(ad.get("url"), ad.get("list_id")) for ad in ads]
+                is_known = listing_index.known(candidates)
+                new = [i for i in range(len(ads)) if not is_known[i]]
+
+                # parse the new ads in one pass...
+                columns, parsing_errors = _parse([ads[i] for i in new])
+                records = dict(zip(new, _records(columns, parsing_errors)))
+                errors = {new[j]: e for j, e in parsing_errors.items()}
+                known_images = (
+                    {}
+                    if defer_images
+                    else image_index.known(
+                        url
+                        for record in records.values()
+                        if record is not None
+                        for url in record["remote_image_urls"]
+                    )
+                )
 
+                # ... fetch their images concurrently...
+                tasks = {
+                    i: engine.submit(
+                        _fetch_images,
+                        record,
+                        dict(cursor.headers),
+                        proxies,
+                        timeout,
+                        None if defer_images else images,
+                        known_images,
+                    )
+                    for i, record in records.items()
+                    if record is not None
+                }
+                scraped = {}
+                for i, task in tasks.items():
+                    try:
+                        scraped[i] = task.result()
+                    except Exception as e:
+                        errors[i] = e
+
+                # ... and ingest the page as a unit
+                ingested = dict(zip(scraped, _ingest_page(list(scraped.values()))))
+                errors.update(
+                    {i: e for i, e in ingested.items() if isinstance(e, Exception)}
+                )
+
+                for i, ad in enumerate(ads):
+                    done += 1
+                    cursor.done += 1
+                    url = ad.get("url")
+                    if is_known[i]:
+                        msg = f"Skipping ad #{i}, as it is already in our DB: {url}."
+                        logger.debug(msg)
+                        cursor.consecutive_duplicates += 1
+                        seen_listings.append(url)
+                        if watermark is not None:
+                            watermark.seen(ad.get("index_date"))
+                        continue
+
+                    msg = f"Parsing ad #{i}: {url} ..."
+                    logger.debug(msg)
+                    error = errors.get(i)
+                    if isinstance(error, exceptions.ListingParsingError):
+                        logger.debug(error)
+                        # no point in trying again
+                        if watermark is not None:
+                            watermark.seen(ad.get("index_date"))
+                        continue
+                    if error is not None:
+                        msg = f"💥Unpexpected error.💥"
+                        logging.error(msg, exc_info=error)
+                        failed_listings.append(url)
+                        if watermark is not None:
+                            watermark.failed(ad.get("index_date"))
+                        continue
+                    listing, is_new = ingested[i]
+                    msg = f"💫Scrape suceeded.💫"
+                    logger.debug(msg)
+                    listing_index.add(url, listing.external_listing_id)
+                    if watermark is not None:
+                        watermark.seen(ad.get("index_date"))
+
+                    if is_new:
+                        added_listings.append(listing)
+                        cursor.consecutive_duplicates = 0
+                    else:
+                        seen_listings.append(listing)
+                        cursor.consecutive_duplicates += 1
+
+                if (
+                    ("pivot" in response)
+                    and not reached_watermark
+                    and (cursor.consecutive_duplicates <= max_duplicates)
+                    and (cursor.done <= cursor.num_results)
+                    and (done <= num_results)
+                ):
+                    cursor.payload.update({"pivot": response["pivot"]})
+                else:
+                    cursor.finished = True
+            active = [cursor for cursor in active if not cursor.finished]
+
+    for cursor in cursors:
+        # the ads of a shard we gave up on are not done with
+        if (cursor.watermark is not None) and (cursor not in failed_shards):
+            cursor.watermark.save()
+    proxy_cache.save(proxy_pool)
+    if failed_shards and (len(failed_shards) == len(cursors)):
+        raise next(iter(failed_shards.values()))
     return {"added": added_listings, "seen": seen_listings, "failed": failed_listings}
 
 
-def _leboncoin(
-    ad: Mapping[str, Any],
-    headers: Mapping[str, str],
-    proxies: Mapping[str, str],
-    timeout: int,
-) -> Tuple[Listing, bool]:
+def download_images(
+    num_images: int = 500, timeout: int = 5
+) -> Dict[str, List[ImageDownload]]:
+    """
+    Download the images queued by the scrapes with deferred images.
 
-    fields: Dict[str, str] = {
-        "external_listing_id": "list_id",
-        "first_publication_date": "first_publication_date",
-        "description": "body",
-        "url": "url",
-        "transaction": "category_name",
-        "price": "price",
-    }
-    data: Dict[str, Any] = {field: ad.get(fields[field]) for field in fields}
-    assert isinstance(data["price"], list)
-    assert len(data["price"]) == 1
-    data["price"] = data["price"][0]
-    data["external_listing_id"] = str(data["external_listing_id"])
-    assert isinstance(data["first_publication_date"], str)
-    data["first_publication_date"] = (
-        pytz.timezone("Europe/Paris")
-        .localize(datetime.fromisoformat(data["first_publication_date"]))
-        .astimezone(pytz.utc)
-        .isoformat()
-    )
+    Listings' images are recorded once all of them are done with. Downloads that fail
+    go back to the queue, until they run out of attempts.
 
-    attributes_fields = {
-        "property_type": ("real_estate_type", "value_label"),
-        "size": ("square", "value"),
-        "rooms": ("rooms", "value"),
-        "is_furnished": ("furnished", "value"),
-        "charges_included": ("charges_included", "value"),
-        "broker_fee": ("fai", "value"),
-        "broker_fee_is_included": ("fai_included", "value"),
-        "dpe_consumption": ("energy_rate", "value"),
-        "dpe_emissions": ("ges", "value"),
-    }
+    Args:
+        num_images: maximum number of images to download.
+        timeout: maximum amount of time, in seconds, to wait for an image to load.
 
-    def _get_attribute_field(
-        ad: Mapping[str, Any], key: str, value_field: str
-    ) -> Optional[str]:
-        _dict = [d for d in ad["attributes"] if d["key"] == key]
-        if not _dict:
-            return None
-        if len(_dict) > 1:
-            msg = f"Unexpectedly got more than one match for attribute '{key}'."
-            raise RuntimeError(msg)
+    Returns:
+        a dictionary of "downloaded" and "failed" downloads.
+    """
+    queue = ImageQueue()
+    downloads = queue.claim(num_images)
+    if not downloads:
+        return {"downloaded": [], "failed": []}
+    known_images = ImageIndex().known(download.url for download in downloads)
 
-        return _dict[0][value_field]
+    ua = UserAgent()
+    proxy_cache = ProxyCache.default()
+    proxy_pool = proxy_cache.pool()
+    proxy = proxy_pool.get()
+    headers = {"User-Agent": proxy_pool.user_agent(proxy, lambda: ua.random)}
+    proxies = {"http": proxy, "https": proxy}
+
+    with Engine(throttle=Throttle(RATES), proxy_pool=proxy_pool) as engine:
+        with ImagePipeline(engine, RetryPolicy(**IMAGE_RETRY)) as images:
+            stored_images = images.fetch(
+                [download.url for download in downloads],
+                headers=headers,
+                proxies=proxies,
+                timeout=timeout,
+                known=known_images,
+            )
+    queue.complete(list(zip(downloads, stored_images)))
 
-    data.update(
-        {
-            field: _get_attribute_field(ad, *attributes_fields[field])
-            for field in attributes_fields
-        }
-    )
-    data["is_furnished"] = data.get("is_furnished") == "1"
-    data["broker_fee_is_included"] = data.get("broker_fee_is_included") == "1"
-    data["dpe_consumption"] = (
-        data.get("dpe_consumption") if data.get("dpe_consumption") != "v" else None
-    )
-    data["dpe_emissions"] = (
-        data.get("dpe_emissions") if data.get("dpe_emissions") != "v" else None
+    proxy_cache.save(proxy_pool)
+    return {
+        "downloaded": [d for d, image in zip(downloads, stored_images) if image],
+        "failed": [d for d, image in zip(downloads, stored_images) if not image],
+    }
+
+
+def plan_shards(
+    payload: Mapping[str, Any],
+    count: Callable[[Dict[str, Any]], int],
+    max_results: int = MAX_SHARD_RESULTS,
+) -> List[Tuple[Dict[str, Any], int]]:
+    """
+    Split a search into shards of at most `max_results` results each.
+
+    Searches are split by property type, then by post code or department, then into
+    price bands and, as a last resort, into size bands, until each shard is small
+    enough. Bands are bisected, so the same search is split the same way from one
+    scrape to the next unless its number of results changes a lot.
+
+    Splits whose parts don't add up to the whole search are passed on, e.g. size
+    bands when some listings have no size: shards that can't be split without
+    missing listings are kept whole, however large.
+
+    Args:
+        payload: the search's payload, for leboncoin's search API.
+        count: function returning the number of results of a payload, e.g. by
+            posting it in count-only mode (`limit_alu: 0`).
+        max_results: maximum number of results per shard.
+
+    Returns:
+        the payloads of the shards that have results, with their number of results.
+    """
+
+    def _plan(payload, total):
+        if total <= max_results:
+            return [(payload, total)] if total else []
+        for parts, disjoint in _splits(payload):
+            totals = [count(part) for part in parts]
+            # we'd miss listings, or the filter we split on is ignored
+            if (sum(totals) < total) or (disjoint and (sum(totals) > total)):
+                continue
+            return [
+                shard
+                for part, part_total in zip(parts, totals)
+                for shard in _plan(part, part_total)
+            ]
+        msg = f"Could not split a search of {total} results any further."
+        logger.warning(msg)
+        return [(payload, total)]
+
+    payload = deepcopy(dict(payload))
+    return _plan(payload, count(payload))
+
+
+def _is_blocked(response: requests.Response) -> bool:
+    """Whether the search API turned us down, e.g. with a captcha."""
+    return (
+        ("captcha" in response.text)
+        or ("datadome" in response.text)
+        or (not response.text)
+        or (response.status_code >= 400)
     )
 
-    if data.get("charges_included", "1") not in ("1", None):
-        msg = f"Ambiguous price, as charges are not included: {ad}"
-        raise exceptions.ListingParsingError(msg)
 
-    null_values = ["non renseigné"]
-    data = {
-        k: data[k] if str(data[k]).lower() not in null_values else None for k in data
-    }
+class _Cursor(object):
+    """
+    Pagination state of a search, or of one of its shards.
+
+    Args:
+        payload: the search's payload.
+        session: key of the search's proxy session.
+        headers: headers of the search's requests. The user agent goes with the proxy.
+        num_results: approximate number of results after which we stop.
+        incremental: True to stop at the results previous scrapes were done with.
+    """
+
+    def __init__(
+        self,
+        payload: Dict[str, Any],
+        *,
+        session: Any,
+        headers: Mapping[str, str],
+        num_results: int,
+        incremental: bool,
+    ):
+        self.payload = payload
+        self.session = session
+        self.headers = dict(headers)
+        self.num_results = num_results
+        # results are sorted newest first: we can stop as soon as we reach the ads the
+        # previous scrapes of the same search were done with.
+        self.watermark = (
+            SearchWatermark(
+                "leboncoin", {k: v for k, v in payload.items() if k != "pivot"}
+            )
+            if incremental
+            else None
+        )
+        self.done = -1
+        self.consecutive_duplicates = 0
+        self.finished = False
+
+
+def _search(
+    engine: Engine,
+    url: str,
+    payload: Mapping[str, Any],
+    session: Any,
+    headers: Dict[str, str],
+    proxy_pool: ProxyPool,
+    retry: RetryPolicy,
+    timeout: int,
+    make_user_agent: Callable[[], str],
+) -> Dict[str, Any]:
+    """
+    Post a query to leboncoin's search API, switching proxies until one gets through.
 
-    location_fields = {
-        "city": "city",
-        "postal_code": "zipcode",
-        "neighborhood": "city_label",
-        "latitude": "lat",
-        "longitude": "lng",
-    }
-    data.update(
-        {
-            field: ad.get("location", {}).get(location_fields[field])
-            for field in location_fields
-        }
-    )
+    This does not touch the database, so it is safe to run on the engine's workers.
+    `headers` are updated with the user agent that goes with the session's proxy.
+
+    Returns:
+        the decoded response.
+
+    Raises:
+        RuntimeError if we ran out of attempts.
+    """
+    for attempt in retry.attempts():
+        proxy = proxy_pool.get(session=session)
+        if "User-Agent" not in headers:
+            headers["User-Agent"] = proxy_pool.user_agent(proxy, make_user_agent)
 
-    for field in ["size", "rooms", "broker_fee"]:
-        if (field not in data) or (not isinstance(data[field], str)):
-            continue
         try:
-            data[field] = float(data[field].replace(",", "."))
-        except (KeyError, ValueError, AttributeError):
-            data[field] = None
-
-    # download the images
-    is_aws_invocation = os.getenv("LAMBDA_TASK_ROOT") is not None
-    if is_aws_invocation:
-        s3 = boto3.client("s3")
-        bucket = os.getenv("BUCKET_NAME")
+            request = engine.post(
+                url,
+                headers=headers,
+                json=payload,
+                proxies={"http": proxy},
+                timeout=timeout,
+                blocked=_is_blocked,
+            )
+        except requests.exceptions.RequestException as e:
+            msg = f"👻Failed to retrieve {url} ({type(e).__name__}).👻"
+            logger.debug(msg)
+            proxy_pool.release(session)
+            headers.pop("User-Agent")
+            continue
+        if _is_blocked(request):
+            msg = f"👻Failed to retrieve {request.url} (Captcha).👻"
+            logger.debug(msg)
+            proxy_pool.release(session)
+            headers.pop("User-Agent")
+            continue
+        # https://github.com/pytest-dev/pytest-cov/issues/368
+        break  # pragma: no cover
     else:
-        all_images_folder = os.getenv(
-            "POGAM_IMAGES_FOLDER", os.path.join(os.path.expanduser("~/.pogam/images"))
-        )
+        msg = f"Failed to reach Le Bon Coin API after {attempt + 1} attempts."
+        raise RuntimeError(msg)
+    return request.json()
+
+
+def _splits(payload: Mapping[str, Any]) -> Iterator[Tuple[List[Dict[str, Any]], bool]]:
+    """
+    Ways of splitting a search's payload, in order of preference.
+
+    Yields:
+        the parts of the search, and whether they should be disjoint. Cities can be
+        part of departments, for instance.
+    """
+    filters = payload["filters"]
+    property_types = filters["enums"]["real_estate_type"]
+    if len(property_types) > 1:
+        yield [
+            _refine(payload, "enums", "real_estate_type", [property_type])
+            for property_type in property_types
+        ], True
+    locations = filters["location"]["locations"]
+    if len(locations) > 1:
+        yield [
+            _refine(payload, "location", "locations", [location])
+            for location in locations
+        ], False
+    transaction = Transaction(int(filters["category"]["id"])).name
+    for name in ["price", "square"]:
+        bands = _bisect(filters["ranges"][name], SHARD_PIVOTS[name][transaction])
+        if bands:
+            yield [_refine(payload, "ranges", name, band) for band in bands], True
+
+
+def _refine(payload: Mapping[str, Any], group: str, name: str, value: Any):
+    refined = deepcopy(dict(payload))
+    refined["filters"][group][name] = value
+    return refined
+
+
+def _bisect(band: Mapping[str, float], pivot: float) -> List[Dict[str, float]]:
+    """
+    Split a range filter into two disjoint bands, if it holds more than one value.
+
+    Prices and sizes are whole euros and square meters. Open-ended ranges are split
+    at `pivot`, or at twice their lower bound, so that their bands widen
+    geometrically.
+    """
+    low = band.get("min", 0)
+    high = band.get("max")
+    if high is None:
+        middle = math.ceil(max(pivot, 2 * low))
+    else:
+        middle = math.floor((low + high) / 2) + 1
+    if (middle - 1 < low) or ((high is not None) and (middle > high)):
+        return []
+    return [dict(band, max=middle - 1), dict(band, min=middle)]
 
-    folder_id = str(uuid.uuid4())
-    remote_image_urls = ad.get("images", {}).get("urls", [])
-    n_images = len(remote_image_urls)
-    relative_image_paths: List[Optional[str]] = [None] * n_images
-    width = max(len(str(n_images)), 2)
-    for i, remote_image_url in enumerate(remote_image_urls):
-        retries = 3
-        while True:
-            try:
-                http_response = requests.get(
-                    remote_image_url, headers=headers, proxies=proxies, timeout=timeout
-                )
-                if http_response.status_code >= 400:
-                    raise requests.exceptions.RequestException
-                break
-            except requests.exceptions.RequestException:
-                if retries <= 0:
-                    msg = f"Could not download image #{i}."
-                    logger.warning(msg)
-                    break
-                retries -= 1
-        if retries <= 0:
-            continue
 
-        name = str(i + 1).zfill(width)
-        _, extension = os.path.splitext(urlparse(remote_image_url).path)
-        current_images_folder = f"leboncoin/{folder_id}/"
-        relative_image_path = f"{current_images_folder}{name}{extension}"
-        relative_image_paths[i] = relative_image_path
+def _leboncoin(
+    ad: Mapping[str, Any],
+    headers: Mapping[str, str],
+    proxies: Mapping[str, str],
+    timeout: int,
+) -> Tuple[Listing, bool]:
+    """
+    Scrape a single ad from leboncoin.fr.
+
+    Args:
+        ad: the ad, as returned by leboncoin's search API.
+        headers: headers to be included in the request (e.g. User-Agent)
+        proxies: proxies to route the requests through.
+        timeout: maximum amount of time, in seconds, to wait for an image to load.
+
+    Returns:
+        an instance of the scraped listing and a flag indicating whether it is a new
+        listing.
+    """
+    columns, errors = _parse([ad])
+    if errors:
+        raise errors[0]
+    (data,) = _records(columns, errors)
+    with Engine(max_workers=1) as engine:
+        with ImagePipeline(engine, RetryPolicy(**IMAGE_RETRY)) as images:
+            data = _fetch_images(data, headers, proxies, timeout, images)
+    return _ingest(data)
+
+
+def _attributes(ad: Mapping[str, Any]) -> Dict[str, Mapping[str, Any]]:
+    """Index the attributes of an ad by key."""
+    attributes: Dict[str, Mapping[str, Any]] = {}
+    for attribute in ad["attributes"]:
+        key = attribute["key"]
+        if key in attributes:
+            msg = f"Unexpectedly got more than one match for attribute '{key}'."
+            raise RuntimeError(msg)
+        attributes[key] = attribute
+    return attributes
+
+
+def _extract(ad: Mapping[str, Any]) -> Dict[str, Any]:
+    """Extract the raw values we keep from an ad."""
+    row: Dict[str, Any] = {field: ad.get(AD_FIELDS[field]) for field in AD_FIELDS}
+    assert isinstance(row["price"], list)
+    assert len(row["price"]) == 1
+    row["price"] = row["price"][0]
+    assert isinstance(row["first_publication_date"], str)
+
+    attributes = _attributes(ad)
+    for field, (key, value_field) in ATTRIBUTE_FIELDS.items():
+        attribute = attributes.get(key)
+        row[field] = attribute[value_field] if attribute is not None else None
+    if row["charges_included"] not in ("1", None):
+        msg = f"Ambiguous price, as charges are not included: {ad}"
+        raise exceptions.ListingParsingError(msg)
 
-        if is_aws_invocation:
-            try:
-                s3.put_object(
-                    Body=http_response.content, Bucket=bucket, Key=relative_image_path
-                )
-            except ClientError:
-                msg = f"Could not download image #{i}."
-                logger.exception(msg)
+    location = ad.get("location", {})
+    row.update(
+        {field: location.get(LOCATION_FIELDS[field]) for field in LOCATION_FIELDS}
+    )
+    row["remote_image_urls"] = ad.get("images", {}).get("urls", [])
+    return row
+
+
+def _to_float(value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _parse(
+    ads: Sequence[Mapping[str, Any]],
+) -> Tuple[Dict[str, List[Any]], Dict[int, Exception]]:
+    """
+    Parse a page of ads from leboncoin's search API.
+
+    Ads are read once each, into columns, and the values are then converted a whole
+    column at a time.
+
+    Args:
+        ads: the ads, as returned by leboncoin's search API.
+
+    Returns:
+        the ads' data, as columns with one value per ad, and the errors of the ads we
+        failed to parse, by position. The values of those ads are all None.
+    """
+    names = (
+        list(AD_FIELDS)
+        + list(ATTRIBUTE_FIELDS)
+        + list(LOCATION_FIELDS)
+        + ["remote_image_urls"]
+    )
+    columns: Dict[str, List[Any]] = {name: [] for name in names}
+    errors: Dict[int, Exception] = {}
+    for i, ad in enumerate(ads):
+        try:
+            row = _extract(ad)
+        except Exception as e:
+            errors[i] = e
+            row = dict.fromkeys(names)
+        for name in names:
+            columns[name].append(row[name])
+
+    def _convert(name, function):
+        column = columns[name]
+        for i, value in enumerate(column):
+            if i in errors:
                 continue
-        else:
-            os.makedirs(
-                os.path.join(all_images_folder, current_images_folder), exist_ok=True
+            try:
+                column[i] = function(value)
+            except Exception as e:
+                errors[i] = e
+
+    _convert("external_listing_id", str)
+    _convert(
+        "first_publication_date",
+        lambda value: PARIS.localize(datetime.fromisoformat(value))
+        .astimezone(pytz.utc)
+        .isoformat(),
+    )
+    for name in ["is_furnished", "broker_fee_is_included"]:
+        _convert(name, lambda value: value == "1")
+    for name in ["dpe_consumption", "dpe_emissions"]:
+        _convert(name, lambda value: value if value != "v" else None)
+    for name in list(AD_FIELDS) + list(ATTRIBUTE_FIELDS):
+        _convert(
+            name, lambda value: value if str(value).lower() not in NULL_VALUES else None
+        )
+    for name in ["size", "rooms", "broker_fee"]:
+        _convert(name, _to_float)
+
+    for i in errors:
+        for column in columns.values():
+            column[i] = None
+    return columns, errors
+
+
+def _records(
+    columns: Mapping[str, List[Any]], errors: Mapping[int, Exception]
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Turn parsed columns into the listings' data, one dictionary per ad.
+
+    Returns:
+        the listings' data, in order, None for the ads we failed to parse.
+    """
+    num_ads = len(next(iter(columns.values()), []))
+    return [
+        (
+            None
+            if i in errors
+            else dict(
+                {name: column[i] for name, column in columns.items()},
+                source="leboncoin",
             )
-            with open(os.path.join(all_images_folder, relative_image_path), "wb") as f:
-                f.write(http_response.content)
-
-        data["images"] = list(filter(None, relative_image_paths)) or None
+        )
+        for i in range(num_ads)
+    ]
 
-    data["source"] = "leboncoin"
 
-    property = Property.create(data)
-    db.session.add(property)
-    db.session.flush()
-    data.update({"property_id": property.id})
-    listing, is_new = Listing.get_or_create(**data)
-    if is_new:
-        db.session.add(listing)
+def _fetch_images(
+    data: Dict[str, Any],
+    headers: Mapping[str, str],
+    proxies: Mapping[str, str],
+    timeout: int,
+    images: Optional[ImagePipeline],
+    known_images: Optional[Mapping[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Download the images of a parsed ad.
+
+    This does not touch the database, so it is safe to run on the engine's workers.
+    Images in `known_images`, by remote url, are not downloaded again. Without an
+    image pipeline, the images are left for :func:`_ingest` to queue.
+
+    Args:
+        data: the listing's data, as returned by :func:`_records`.
+
+    Returns:
+        the listing's data.
+    """
+    remote_image_urls = data.pop("remote_image_urls")
+    if images is None:
+        data["deferred_images"] = remote_image_urls
+        return data
+    stored_images = images.fetch(
+        remote_image_urls,
+        headers=headers,
+        proxies=proxies,
+        timeout=timeout,
+        known=known_images,
+    )
+    if any(stored_images):
+        data["images"] = [image["path"] for image in stored_images if image]
+    data["stored_images"] = stored_images
+    return data
+
+
+def _ingest_page(
+    records: Sequence[Dict[str, Any]],
+) -> List[Union[Tuple[Listing, bool], Exception]]:
+    """
+    Add a page of scraped listings to the database, in a single transaction.
+
+    If that fails, the listings are added one at a time instead, so that one bad
+    listing does not cost us the whole page.
+
+    Args:
+        records: the listings' data, as returned by :func:`_fetch_images`.
+
+    Returns:
+        for each listing, in order, an instance of the listing and a flag indicating
+        whether it is a new listing, or the error we ran into.
+    """
+    backup = deepcopy(records)
+    try:
+        outcomes: List[Union[Tuple[Listing, bool], Exception]] = []
+        outcomes += _upsert(records)
         db.session.commit()
+        return outcomes
+    except Exception:
+        db.session.rollback()
+        logger.debug("Failed to ingest the page at once.", exc_info=True)
 
-    return listing, is_new
+    outcomes = []
+    for data in backup:
+        try:
+            outcomes.append(_ingest(data))
+        except Exception as e:
+            db.session.rollback()
+            outcomes.append(e)
+    return outcomes
+
+
+def _ingest(data: Dict[str, Any]) -> Tuple[Listing, bool]:
+    """
+    Add a scraped listing to the database.
+
+    Args:
+        data: the listing's data, as returned by :func:`_fetch_images`.
+
+    Returns:
+        an instance of the listing and a flag indicating whether it is a new listing.
+    """
+    (outcome,) = _upsert([data])
+    db.session.commit()
+    return outcome
+
+
+def _upsert(records: Sequence[Dict[str, Any]]) -> List[Tuple[Listing, bool]]:
+    """
+    Add scraped listings, and their images, to the database session.
+
+    Returns:
+        for each listing, in order, an instance of the listing and a flag indicating
+        whether it is a new listing.
+    """
+    images = [
+        (data.pop("stored_images", []), data.pop("deferred_images", []))
+        for data in records
+    ]
+    outcomes = Listing.upsert(records)
+    image_index = ImageIndex()
+    queue = ImageQueue()
+    for (stored_images, deferred_images), (listing, is_new) in zip(images, outcomes):
+        image_index.add(stored_images, listing if is_new else None)
+        if is_new:
+            queue.push(listing, deferred_images)
+    return outcomes
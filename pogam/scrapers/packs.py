@@ -0,0 +1,352 @@
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from typing import IO, Collection, Dict, Iterable, Iterator, List, Optional
+
+from .. import db
+from ..models import Image, ImageDownload, ImageUrl, Listing, ListingImage
+from .images import CHUNK_SIZE, SPOOL_SIZE, ImageStore
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.pack$")
+
+
+class PackStore(ImageStore):
+    """
+    Images appended to large segment files, for local deployments.
+
+    Storing millions of small files makes backups, syncs and directory listings slow.
+    Packs append images to segment files of up to `max_segment_size` bytes instead,
+    and keep an index of where each image starts and how long it is. Images are read
+    through memory maps of the segments.
+
+    Images are never rewritten in place: storing an image again, or deleting it, only
+    updates the index. The space they took is reclaimed by :meth:`compact`.
+
+    The index is a sqlite database and appends are serialized with a file lock, so
+    packs are safe to share between threads and between processes.
+
+    Args:
+        folder: folder of the segments and of their index. Defaults to the packs/
+            folder of the images folder.
+        max_segment_size: size, in bytes, after which we start a new segment.
+    """
+
+    def __init__(self, folder: Optional[str] = None, *, max_segment_size: int = 2**30):
+        self.is_aws_invocation = False
+        if folder is None:
+            images_folder = os.getenv(
+                "POGAM_IMAGES_FOLDER", os.path.expanduser("~/.pogam/images")
+            )
+            folder = os.path.join(images_folder, "packs")
+        self.folder = folder
+        self.max_segment_size = max_segment_size
+        os.makedirs(folder, exist_ok=True)
+        # guards the index connection and the maps, and is held while appending
+        self._lock = threading.RLock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._index = sqlite3.connect(
+            os.path.join(folder, "index.sqlite"),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER)"
+        )
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+
+    def close(self):
+        with self._lock:
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps.clear()
+            self._index.close()
+
+    # ------------------------------------------------------------------------------ #
+    #                                   Segments                                      #
+    # ------------------------------------------------------------------------------ #
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.folder, f"segment-{segment:06d}.pack")
+
+    def segments(self) -> List[int]:
+        """Numbers of the segments, in order."""
+        return sorted(
+            int(match.group(1))
+            for match in map(SEGMENT_PATTERN.match, os.listdir(self.folder))
+            if match
+        )
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        # threads of this process, then other processes
+        with self._lock, open(os.path.join(self.folder, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _last_segment(self) -> int:
+        """Number of the latest segment, 0 if there has not been any."""
+        row = self._index.execute(
+            "SELECT value FROM meta WHERE key = 'last_segment'"
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        # packs from before we kept count
+        segments = self.segments()
+        return segments[-1] if segments else 0
+
+    def _new_segment(self) -> int:
+        """
+        Start a new segment, and return its number.
+
+        Segment numbers are never reused, even once their segment is compacted away,
+        so that the maps of other processes never point to the wrong segment.
+        """
+        segment = self._last_segment() + 1
+        self._index.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_segment', ?)",
+            (segment,),
+        )
+        return segment
+
+    def _append(self, segment: int, chunks: Iterable[bytes]) -> int:
+        """Append to a segment, and return the offset we appended at."""
+        with open(self._segment_path(segment), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                f.write(chunk)
+        return offset
+
+    def _store(self, key: str, chunks: Iterable[bytes]):
+        with self._locked():
+            segment = self._last_segment()
+            path = self._segment_path(segment)
+            # e.g. the latest segment was compacted away
+            if (not os.path.exists(path)) or (
+                os.path.getsize(path) >= self.max_segment_size
+            ):
+                segment = self._new_segment()
+            length = 0
+
+            def _count(chunks):
+                nonlocal length
+                for chunk in chunks:
+                    length += len(chunk)
+                    yield chunk
+
+            offset = self._append(segment, _count(chunks))
+            # a crash before the index is updated only leaves garbage in the segment
+            self._index.execute(
+                "INSERT OR REPLACE INTO entries (key, segment, offset, length) "
+                "VALUES (?, ?, ?, ?)",
+                (key, segment, offset, length),
+            )
+
+    # ------------------------------------------------------------------------------ #
+    #                                    Images                                       #
+    # ------------------------------------------------------------------------------ #
+    def exists(self, path: str) -> bool:
+        with self._lock:
+            row = self._index.execute(
+                "SELECT 1 FROM entries WHERE key = ?", (path,)
+            ).fetchone()
+        return row is not None
+
+    def read(self, path: str) -> bytes:
+        with self._lock:
+            row = self._index.execute(
+                "SELECT segment, offset, length FROM entries WHERE key = ?", (path,)
+            ).fetchone()
+            if row is None:
+                raise FileNotFoundError(path)
+            segment, offset, length = row
+            segment_map = self._maps.get(segment)
+            if (segment_map is None) or (len(segment_map) < offset + length):
+                # the segment grew since we mapped it
+                if segment_map is not None:
+                    segment_map.close()
+                with open(self._segment_path(segment), "rb") as f:
+                    segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = segment_map
+            return segment_map[offset : offset + length]
+
+    def write(self, path: str, content: bytes):
+        self._store(path, [content])
+
+    def spool(self) -> IO[bytes]:
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    def put(self, f: IO[bytes], path: str):
+        f.seek(0)
+        self._store(path, iter(lambda: f.read(CHUNK_SIZE), b""))
+
+    def discard(self, f: IO[bytes]):
+        f.close()
+
+    def delete(self, path: str):
+        """Forget an image. Its space is reclaimed by the next :meth:`compact`."""
+        with self._lock:
+            self._index.execute("DELETE FROM entries WHERE key = ?", (path,))
+
+    def keys(self) -> List[str]:
+        """Paths of all the stored images."""
+        with self._lock:
+            rows = self._index.execute("SELECT key FROM entries").fetchall()
+        return [key for (key,) in rows]
+
+    # ------------------------------------------------------------------------------ #
+    #                                  Compaction                                     #
+    # ------------------------------------------------------------------------------ #
+    def compact(
+        self,
+        keep: Optional[Collection[str]] = None,
+        candidates: Optional[Collection[str]] = None,
+    ) -> int:
+        """
+        Reclaim the space of deleted and overwritten images.
+
+        Segments holding garbage are rewritten to new segments, with only the images
+        still in the index, and deleted. Writers wait for the compaction to finish.
+
+        Args:
+            keep: if given, the images to keep. All the others are deleted first.
+            candidates: if given, the only images `keep` may delete, e.g. the images
+                stored when `keep` was decided on, so that the images stored since are
+                spared.
+
+        Returns:
+            the number of bytes reclaimed.
+        """
+        with self._locked():
+            if keep is not None:
+                keep = set(keep)
+                keys = self.keys() if candidates is None else candidates
+                self._index.executemany(
+                    "DELETE FROM entries WHERE key = ?",
+                    [(key,) for key in keys if key not in keep],
+                )
+
+            segments = self.segments()
+            target = None
+            rewritten = []
+            moved = []
+            copied = 0
+            for segment in segments:
+                entries = self._index.execute(
+                    "SELECT key, offset, length FROM entries WHERE segment = ? "
+                    "ORDER BY offset",
+                    (segment,),
+                ).fetchall()
+                path = self._segment_path(segment)
+                if sum(length for _, _, length in entries) == os.path.getsize(path):
+                    continue
+                rewritten.append(segment)
+                with open(path, "rb") as f:
+                    for key, offset, length in entries:
+                        if (target is None) or (
+                            os.path.getsize(self._segment_path(target))
+                            >= self.max_segment_size
+                        ):
+                            target = self._new_segment()
+                        f.seek(offset)
+                        new_offset = self._append(target, _chunks(f, length))
+                        moved.append((target, new_offset, key))
+                        copied += length
+
+            # the images are moved all at once, once they are all copied
+            self._index.execute("BEGIN")
+            self._index.executemany(
+                "UPDATE entries SET segment = ?, offset = ? WHERE key = ?", moved
+            )
+            self._index.execute("COMMIT")
+            reclaimed = -copied
+            for segment in rewritten:
+                segment_map = self._maps.pop(segment, None)
+                if segment_map is not None:
+                    segment_map.close()
+                path = self._segment_path(segment)
+                reclaimed += os.path.getsize(path)
+                os.remove(path)
+        logger.debug(
+            f"Compacted {len(rewritten)} segments, reclaiming {reclaimed} bytes."
+        )
+        return reclaimed
+
+
+def _chunks(f: IO[bytes], length: int) -> Iterator[bytes]:
+    while length > 0:
+        chunk = f.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            msg = "Unexpected end of segment."
+            raise EOFError(msg)
+        length -= len(chunk)
+        yield chunk
+
+
+def compact_images(store: Optional[PackStore] = None) -> Dict[str, int]:
+    """
+    Reclaim the space of the images no listing uses anymore, e.g. deleted listings'.
+
+    The images that are not listed in any listing's images or image variants, nor
+    downloaded for a listing whose images are still pending, are deleted from the
+    store, and forgotten by the image index so that they are downloaded again if
+    they show up in a new listing.
+
+    Must be called from within an app context.
+
+    Args:
+        store: the pack store to compact. Defaults to the configured image store.
+
+    Returns:
+        the number of images deleted and of bytes reclaimed.
+    """
+    if store is None:
+        default = ImageStore.default()
+        if not isinstance(default, PackStore):
+            msg = "Only the pack image store can be compacted."
+            raise RuntimeError(msg)
+        store = default
+
+    # images stored from now on are not ours to delete, whether or not they make it
+    # into `keep`
+    stored = store.keys()
+    indexed = db.session.query(Image.id, Image.path).all()
+
+    keep = set()
+    for images, variants in db.session.query(Listing.images, Listing.image_variants):
+        keep.update(images or [])
+        for paths in variants or []:
+            keep.update((paths or {}).values())
+    keep.update(
+        path
+        for (path,) in db.session.query(ImageDownload.path).filter(
+            ImageDownload.path.isnot(None)
+        )
+    )
+
+    deleted = [key for key in stored if key not in keep]
+    image_ids = [image_id for (image_id, path) in indexed if path not in keep]
+    if image_ids:
+        # not relying on cascades, which sqlite does not enforce by default
+        for model in [ListingImage, ImageUrl]:
+            model.query.filter(model.image_id.in_(image_ids)).delete(
+                synchronize_session=False
+            )
+        Image.query.filter(Image.id.in_(image_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    reclaimed = store.compact(keep, candidates=stored)
+    return {"deleted": len(deleted), "reclaimed": reclaimed}
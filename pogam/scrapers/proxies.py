@@ -1,33 +1,78 @@
+import functools
 import itertools as it
+import json
 import logging
 import os
 import random
+import tempfile
+import threading
+import time
 import warnings
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 import requests
+import sqlalchemy as sa  # type: ignore
+
+from .. import db
+from ..models import Proxy
 
 logger = logging.getLogger(__name__)
 
+# url fetched through each proxy to check that it works
+CHECK_URL = "https://httpbin.org/ip"
+
 
-def all_proxies(*, infinite=True, errors="raise"):
+def all_proxies(
+    *,
+    infinite=True,
+    errors="raise",
+    validate=False,
+    check_url=None,
+    timeout=3,
+):
     """
     Aggregate results from multiplie proxies into a single pool.
+
+    Args:
+        infinite: True to return an infinite iterator.
+        errors: 'warn' or 'raise'. When proxy retrieval fails, either warn but go on,
+            or raise a RuntimeError.
+        validate: True to only keep the proxies that respond, fastest first. See
+            :func:`validate_proxies`.
+        check_url: url used to validate the proxies.
+        timeout: maximum amount of time, in seconds, to wait for a proxy to respond.
     """
     if errors not in ["warn", "raise"]:
         msg = f"'errors' must be 'warn' or 'raise'. Got '{errors}' instead."
         raise ValueError(msg)
-    results = []
+
+    # fetch all the providers' lists concurrently
+    providers = []
 
     # proxy11.com
     api_key = os.getenv("PROXY11_API_KEY")
     if api_key:
-        results += proxy11(
-            api_key, type_="anonymous", speed=2, infinite=False, errors="warn"
-        )
+        proxy11_kwargs = dict(type_="anonymous", speed=2, infinite=False, errors="warn")
+        providers.append(functools.partial(proxy11, api_key, **proxy11_kwargs))
 
     # proxy-list.download
-    results += proxylist(infinite=False, errors="warn")
+    providers.append(functools.partial(proxylist, infinite=False, errors="warn"))
+
+    with ThreadPoolExecutor(max_workers=len(providers)) as executor:
+        futures = [executor.submit(provider) for provider in providers]
+    results = [proxy for future in futures for proxy in future.result()]
 
     # aggregate
     if set(results) == {None}:
@@ -40,10 +85,76 @@ def all_proxies(*, infinite=True, errors="raise"):
     else:
         results = [result for result in results if result is not None]
     random.shuffle(results)
+
+    if validate and results and (None not in results):
+        validated = validate_proxies(results, check_url=check_url, timeout=timeout)
+        if validated:
+            results = validated
+        else:
+            msg = "None of the proxies responded. Proceeding with all of them."
+            warnings.warn(msg)
+
     proxy_iter = it.cycle(results) if infinite else results
     return proxy_iter
 
 
+def validate_proxies(
+    proxies: Iterable[Optional[str]],
+    *,
+    check_url: Optional[str] = None,
+    timeout: float = 3,
+    max_workers: int = 32,
+) -> List[Optional[str]]:
+    """
+    Probe proxies in parallel and keep the ones that respond, fastest first.
+
+    Args:
+        proxies: the proxies to probe. `None` (a direct connection) is kept as is.
+        check_url: url to fetch through each proxy. Defaults to the
+            `POGAM_PROXY_CHECK_URL` environment variable, or :data:`CHECK_URL`.
+        timeout: maximum amount of time, in seconds, to wait for a proxy to respond.
+        max_workers: maximum number of proxies probed at the same time.
+
+    Returns:
+        the responsive proxies, ordered by latency.
+    """
+    if check_url is None:
+        check_url = os.getenv("POGAM_PROXY_CHECK_URL", CHECK_URL)
+    proxies = list(dict.fromkeys(proxies))
+    candidates = [proxy for proxy in proxies if proxy is not None]
+
+    def _probe(proxy: str) -> Optional[float]:
+        start = time.perf_counter()
+        try:
+            response = requests.get(
+                check_url, proxies={"http": proxy, "https": proxy}, timeout=timeout
+            )
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code >= 400:
+            return None
+        return time.perf_counter() - start
+
+    if candidates:
+        workers = min(max_workers, len(candidates))
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pogam-proxies"
+        ) as executor:
+            latencies = list(executor.map(_probe, candidates))
+    else:
+        latencies = []
+    responsive = sorted(
+        (latency, i) for i, latency in enumerate(latencies) if latency is not None
+    )
+    msg = f"{len(responsive)} out of {len(candidates)} proxies responded."
+    logger.debug(msg)
+
+    validated: List[Optional[str]] = [candidates[i] for _, i in responsive]
+    if None in proxies:
+        validated.append(None)
+    return validated
+
+
 def proxylist(*, protocol="http", infinite=True, errors="raise"):
     """
     Return an iterator of proxies from proxy-list.download.
@@ -141,3 +252,363 @@ def proxy11(
 
     proxy_iter = it.cycle(proxy_list) if infinite else proxy_list
     return proxy_iter
+
+
+class _ProxyStats(object):
+    persisted = ["requests", "successes", "captchas", "latency"]
+
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.captchas = 0
+        self.latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.quarantines = 0
+        self.quarantined_until = float("-inf")
+        self.user_agents: Dict[str, int] = {}
+
+
+class ProxyPool(object):
+    """
+    Pool of proxies handed out according to how well they have been doing.
+
+    Each proxy is scored on its success rate, its captcha rate and its latency, and
+    proxies are drawn at random, with probabilities proportional to their score.
+    Proxies that fail `threshold` times in a row are quarantined, for a cool-down
+    that doubles each time they get quarantined again.
+
+    The pool is also an infinite iterator, so that it can be used in place of the
+    cycles returned by :func:`all_proxies`.
+
+    Args:
+        proxies: the proxies in the pool. `None` stands for a direct connection.
+        stats: statistics of the proxies from previous scrapes, as returned by
+            :meth:`snapshot`.
+        threshold: number of consecutive failures that get a proxy quarantined.
+        quarantine: initial quarantine duration, in seconds.
+        max_quarantine: cap on the quarantine duration, in seconds.
+        latency_weight: weight of the latest latency in its moving average.
+        clock: monotonic clock, in seconds.
+        rng: random number generator.
+    """
+
+    def __init__(
+        self,
+        proxies: Iterable[Optional[str]],
+        *,
+        stats: Optional[Mapping[str, Mapping[str, Any]]] = None,
+        threshold: int = 3,
+        quarantine: float = 30,
+        max_quarantine: float = 900,
+        latency_weight: float = 0.3,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Optional[random.Random] = None,
+    ):
+        self.proxies: List[Optional[str]] = list(dict.fromkeys(proxies))
+        if not self.proxies:
+            msg = "Can not build a pool without any proxy."
+            raise ValueError(msg)
+        self.threshold = threshold
+        self.quarantine = quarantine
+        self.max_quarantine = max_quarantine
+        self.latency_weight = latency_weight
+        self._clock = clock
+        self._rng = rng if rng is not None else random.Random()
+        self._lock = threading.Lock()
+        self._stats = {proxy: _ProxyStats() for proxy in self.proxies}
+        for proxy, values in (stats or {}).items():
+            if proxy not in self._stats:
+                continue
+            for field in _ProxyStats.persisted:
+                default = getattr(self._stats[proxy], field)
+                setattr(self._stats[proxy], field, values.get(field, default))
+        self._sessions: Dict[Hashable, Optional[str]] = {}
+
+    def __iter__(self) -> "ProxyPool":
+        return self
+
+    def __next__(self) -> Optional[str]:
+        return self.get()
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Statistics of each proxy, to be persisted across scrapes."""
+        with self._lock:
+            return {
+                proxy: {field: getattr(stats, field) for field in _ProxyStats.persisted}
+                for proxy, stats in self._stats.items()
+                if proxy is not None
+            }
+
+    def score(self, proxy: Optional[str]) -> float:
+        """
+        Score of a proxy, between 0 and 1. Higher is better.
+
+        Success and captcha rates are smoothed, so that proxies we know nothing about
+        get a fair chance.
+        """
+        stats = self._stats[proxy]
+        success_rate = (stats.successes + 1) / (stats.requests + 2)
+        captcha_rate = (stats.captchas + 0.1) / (stats.requests + 1)
+        latency = stats.latency if stats.latency is not None else 1.0
+        return success_rate * (1 - min(captcha_rate, 1)) / (1 + latency)
+
+    def is_quarantined(self, proxy: Optional[str]) -> bool:
+        return self._clock() < self._stats[proxy].quarantined_until
+
+    def get(self, session: Optional[Hashable] = None) -> Optional[str]:
+        """
+        Draw a proxy from the pool.
+
+        Args:
+            session: key of a session (e.g. a paginated search). The same proxy is
+                handed out for the same session for as long as it is not quarantined.
+
+        Returns:
+            a proxy url, or None for a direct connection.
+        """
+        with self._lock:
+            if session is not None:
+                proxy = self._sessions.get(session, ...)
+                if (proxy is not ...) and not self.is_quarantined(proxy):
+                    return proxy
+            available = [p for p in self.proxies if not self.is_quarantined(p)]
+            if not available:
+                # every proxy is in quarantine: use the one that gets out the soonest
+                proxy = min(
+                    self.proxies, key=lambda p: self._stats[p].quarantined_until
+                )
+            else:
+                weights = [self.score(p) for p in available]
+                proxy = self._rng.choices(available, weights=weights)[0]
+            if session is not None:
+                self._sessions[session] = proxy
+            return proxy
+
+    def release(self, session: Hashable):
+        """Forget the proxy assigned to a session."""
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def user_agent(self, proxy: Optional[str], make: Callable[[], str]) -> str:
+        """
+        Pick a user agent to go with a proxy.
+
+        Args:
+            proxy: the proxy.
+            make: function returning a new, random, user agent.
+
+        Returns:
+            the user agent that has worked best with this proxy so far, if any,
+            or a new one.
+        """
+        with self._lock:
+            user_agents = self._stats[proxy].user_agents
+            best = max(user_agents, key=user_agents.get, default=None)
+            if (best is not None) and (user_agents[best] > 0):
+                return best
+        return make()
+
+    def report(
+        self,
+        proxy: Optional[str],
+        *,
+        ok: bool,
+        latency: Optional[float] = None,
+        captcha: bool = False,
+        user_agent: Optional[str] = None,
+    ):
+        """
+        Record the outcome of a request sent through a proxy.
+
+        Args:
+            proxy: the proxy.
+            ok: whether the request succeeded.
+            latency: time it took to get the response, in seconds.
+            captcha: whether we got served a captcha.
+            user_agent: user agent used for the request.
+        """
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            stats.requests += 1
+            if latency is not None:
+                stats.latency = (
+                    latency
+                    if stats.latency is None
+                    else (
+                        self.latency_weight * latency
+                        + (1 - self.latency_weight) * stats.latency
+                    )
+                )
+            if user_agent is not None:
+                outcome = 1 if ok else -1
+                stats.user_agents[user_agent] = (
+                    stats.user_agents.get(user_agent, 0) + outcome
+                )
+            if ok:
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                stats.quarantines = 0
+                return
+            stats.captchas += int(captcha)
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures < self.threshold:
+                return
+            duration = min(self.quarantine * 2**stats.quarantines, self.max_quarantine)
+            stats.quarantines += 1
+            stats.consecutive_failures = 0
+            stats.quarantined_until = self._clock() + duration
+        logger.debug(f"Quarantining proxy {proxy} for {duration:.0f}s.")
+
+
+class ProxyCache(object):
+    """
+    Proxies, and their statistics, kept across scrapes.
+
+    Fetching the proxy lists from the providers holds up the start of every scrape,
+    and the statistics collected by a :class:`ProxyPool` are lost at the end of it.
+    Caches hand out pools that are already warm and ranked, and only go back to the
+    providers once the lists are older than `ttl`.
+
+    Args:
+        ttl: time, in seconds, after which the proxy lists are fetched again.
+        validate: True to only keep the proxies that respond when fetching the lists.
+    """
+
+    def __init__(self, ttl: float = 1800, validate: bool = True):
+        self.ttl = ttl
+        self.validate = validate
+        self._fetched_at: Optional[datetime] = None
+
+    @staticmethod
+    def default(**kwargs) -> "ProxyCache":
+        """
+        Cache in the database when running in AWS, in a local file otherwise.
+        """
+        if os.getenv("LAMBDA_TASK_ROOT") is not None:
+            return DatabaseProxyCache(**kwargs)
+        return FileProxyCache(**kwargs)
+
+    def pool(self, **kwargs) -> ProxyPool:
+        """
+        Return a pool of the cached proxies, fetching fresh lists if they are stale.
+
+        Args:
+            kwargs: any keyword argument accepted by :class:`ProxyPool`.
+        """
+        cached = self._read()
+        fetched_at, stats = cached if cached is not None else (None, {})
+        now = datetime.utcnow()
+        if (fetched_at is not None) and (now - fetched_at).total_seconds() < self.ttl:
+            logger.debug(f"Using {len(stats)} cached proxies.")
+            self._fetched_at = fetched_at
+            return ProxyPool(stats, stats=stats, **kwargs)
+
+        proxies = all_proxies(infinite=False, validate=self.validate)
+        # we keep the statistics of the proxies we already know
+        self._fetched_at = now
+        return ProxyPool(proxies, stats=stats, **kwargs)
+
+    def save(self, pool: ProxyPool):
+        """Persist the proxies of a pool, and their statistics."""
+        stats = pool.snapshot()
+        if (self._fetched_at is None) or (not stats):
+            return
+        self._write(self._fetched_at, stats)
+
+    def _read(self) -> Optional[Tuple[datetime, Dict[str, Dict[str, Any]]]]:
+        raise NotImplementedError
+
+    def _write(self, fetched_at: datetime, stats: Mapping[str, Mapping[str, Any]]):
+        raise NotImplementedError
+
+
+class FileProxyCache(ProxyCache):
+    """
+    Proxy cache in a local JSON file.
+
+    Args:
+        path: path of the file. Defaults to the `POGAM_PROXY_CACHE` environment
+            variable, or ~/.pogam/proxies.json.
+        kwargs: any other keyword argument accepted by :class:`ProxyCache`.
+    """
+
+    def __init__(self, path: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        if path is None:
+            path = os.getenv(
+                "POGAM_PROXY_CACHE", os.path.expanduser("~/.pogam/proxies.json")
+            )
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+            fetched_at = datetime.fromisoformat(content["fetched_at"])
+            return fetched_at, content["proxies"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, fetched_at, stats):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        content = {"fetched_at": fetched_at.isoformat(), "proxies": stats}
+        # write to a temporary file first, so that concurrent scrapes never read a
+        # half-written cache
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+class DatabaseProxyCache(ProxyCache):
+    """
+    Proxy cache in the `proxies` table, shared by concurrent Lambda invocations.
+
+    Args:
+        kwargs: any keyword argument accepted by :class:`ProxyCache`.
+    """
+
+    def _read(self):
+        rows = Proxy.query.all()
+        if not rows:
+            return None
+        fetched_at = max(row.fetched_at for row in rows)
+        stats = {
+            row.url: {field: getattr(row, field) for field in _ProxyStats.persisted}
+            for row in rows
+            if row.fetched_at == fetched_at
+        }
+        return fetched_at, stats
+
+    def _write(self, fetched_at, stats):
+        now = datetime.utcnow()
+        try:
+            rows = {row.url: row for row in Proxy.query.all()}
+            for url, values in stats.items():
+                row = rows.pop(url, None)
+                if row is None:
+                    row = Proxy(url=url)
+                    db.session.add(row)
+                for field in _ProxyStats.persisted:
+                    setattr(row, field, values[field])
+                row.fetched_at = max(row.fetched_at or fetched_at, fetched_at)
+                row.updated_at = now
+            # drop the proxies that are no longer listed by the providers
+            for row in rows.values():
+                if row.fetched_at < fetched_at:
+                    db.session.delete(row)
+            db.session.commit()
+        except sa.exc.SQLAlchemyError:
+            # e.g. a concurrent invocation inserted the same proxies first
+            db.session.rollback()
+            logger.debug("Failed to update the proxy cache.", exc_info=True)
@@ -0,0 +1,166 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget(object):
+    """
+    Maximum number of retries shared by all the requests of a scrape.
+
+    Args:
+        total: number of retries available. None for an unlimited budget.
+    """
+
+    def __init__(self, total: Optional[int] = 200):
+        self.total = total
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> Optional[int]:
+        return None if self.total is None else self.total - self.spent
+
+    def spend(self, n: int = 1) -> bool:
+        """
+        Take `n` retries out of the budget.
+
+        Returns:
+            False, without spending anything, if there isn't enough left.
+        """
+        with self._lock:
+            if (self.total is not None) and (self.spent + n > self.total):
+                return False
+            self.spent += n
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff, with jitter, drawing on a retry budget.
+
+    Typical usage::
+
+        for attempt in policy.attempts():
+            try:
+                response = engine.get(url)
+            except requests.exceptions.RequestException:
+                continue
+            break
+        else:
+            raise RuntimeError("Giving up.")
+
+    Args:
+        max_attempts: maximum number of attempts, including the first one.
+        base_delay: delay before the first retry, in seconds.
+        max_delay: cap on the delay between two attempts, in seconds.
+        jitter: True to wait a random fraction of the delay ("full jitter"), so that
+            concurrent retries don't all hit the server at the same time.
+        budget: retry budget to draw from. Defaults to an unlimited budget.
+        sleep: function used to wait between attempts.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 10,
+        *,
+        base_delay: float = 1,
+        max_delay: float = 30,
+        jitter: bool = True,
+        budget: Optional[RetryBudget] = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if max_attempts < 1:
+            msg = f"'max_attempts' must be at least 1. Got {max_attempts} instead."
+            raise ValueError(msg)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget if budget is not None else RetryBudget(None)
+        self._sleep = sleep
+
+    def delay(self, retry: int) -> float:
+        """Delay before the `retry`-th retry (starting at 1), in seconds."""
+        delay = min(self.base_delay * 2 ** (retry - 1), self.max_delay)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def attempts(self) -> Iterator[int]:
+        """
+        Yield attempt numbers, waiting before each retry.
+
+        Stops after `max_attempts`, or as soon as the retry budget runs out.
+        """
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                if not self.budget.spend():
+                    logger.debug("Retry budget exhausted. Giving up.")
+                    return
+                self._sleep(self.delay(attempt))
+            yield attempt
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending requests through a key (e.g. a proxy or a host) that keeps failing.
+
+    After `threshold` consecutive failures, the circuit of a key opens: it is not
+    available for `cooldown` seconds. Past that, requests are let through again on
+    trial: the circuit closes at the first success, or re-opens for twice as long at
+    the first failure.
+
+    Args:
+        threshold: number of consecutive failures that trip the circuit.
+        cooldown: initial time, in seconds, during which a tripped key is unavailable.
+        max_cooldown: cap on the cooldown, in seconds.
+        clock: monotonic clock, in seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        *,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+        self._cooldowns: Dict[str, float] = {}
+        self._open_until: Dict[str, float] = {}
+
+    def is_open(self, key: str) -> bool:
+        """Whether requests through `key` should be refused for now."""
+        with self._lock:
+            return self._clock() < self._open_until.get(key, float("-inf"))
+
+    def success(self, key: str):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._cooldowns.pop(key, None)
+            self._open_until.pop(key, None)
+
+    def failure(self, key: str):
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures < self.threshold:
+                return
+            cooldown = self._cooldowns.get(key)
+            cooldown = (
+                self.cooldown
+                if cooldown is None
+                else min(2 * cooldown, self.max_cooldown)
+            )
+            self._cooldowns[key] = cooldown
+            self._open_until[key] = self._clock() + cooldown
+            # half-open: the next failure, after the cool-down, re-trips the circuit
+            self._failures[key] = self.threshold - 1
+        logger.debug(f"Circuit open for {key} for the next {cooldown:.0f}s.")
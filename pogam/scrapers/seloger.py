@@ -1,54 +1,64 @@
-import codecs
 import logging
-import re
 from enum import Enum
 from math import ceil, floor
 from typing import (
     Any,
-    Callable,
     Dict,
     Iterable,
     List,
     Mapping,
-    Match,
     Optional,
     Tuple,
     Union,
     cast,
 )
-from urllib.parse import unquote, urljoin, urlparse
+from urllib.parse import unquote, urlparse
 
 import requests
-from bs4 import BeautifulSoup  # type: ignore
 from fake_useragent import UserAgent  # type: ignore
 
 from .. import db
 from ..models import Listing, Property
 from . import exceptions
-from .proxies import all_proxies
+from .dedup import ListingIndex
+from .engine import Engine
+from .extractors import (
+    CONFIG_DETAIL_END,
+    CONFIG_DETAIL_START,
+    iter_text,
+    read_until,
+    seloger_config_detail,
+    seloger_features,
+    seloger_links,
+    seloger_listing,
+)
+from .geocodes import GeoCodeResolver
+from .httpcache import ResponseCache
+from .proxies import ProxyCache
+from .retry import RetryBudget, RetryPolicy
+from .throttle import Throttle
 
 logger = logging.getLogger(__name__)
 
-# https://stackoverflow.com/a/24519338
-ESCAPE_SEQUENCE_RE = re.compile(
-    r"""
-    ( \\U........      # 8-digit hex escapes
-    | \\u....          # 4-digit hex escapes
-    | \\x..            # 2-digit hex escapes
-    | \\[0-7]{1,3}     # Octal escapes
-    | \\N\{[^}]+\}     # Unicode characters by name
-    | \\[\\'"abfnrtv]  # Single-character escapes
-    )""",
-    re.UNICODE | re.VERBOSE,
-)
+# pace of the requests to seloger, in requests per second.
+RATES = {
+    "www.seloger.com": {"rate": 2, "min_rate": 0.2, "max_rate": 10, "increase": 0.2}
+}
+
+# backoff between attempts at a request, and total number of retries over a scrape.
+RETRY = {"max_attempts": 10, "base_delay": 1, "max_delay": 30}
+RETRY_BUDGET = 200
 
 
-def _to_seloger_geographical_code(post_code: str) -> Tuple[str, str]:
+def _to_seloger_geographical_code(post_code: str, timeout: int = 5) -> Tuple[str, str]:
     """
     Convert French 'Code Postal' to seloger's appropriate custom geographical code.
 
+    This always asks seloger. Use :data:`geocodes` to benefit from caching.
+
     Args:
         post_code: standard French post codes.
+        timeout: maximum amount of time, in seconds, to wait for seloger's response.
 
     Returns:
         - 'cp' or 'ci', the type of geographical code returned
@@ -63,7 +73,7 @@ def _to_seloger_geographical_code(post_code: str) -> Tuple[str, str]:
         f"https://autocomplete.svc.groupe-seloger.com/api/v2.0/auto/complete/fra"
         f"/63/10/8/SeLoger?text={post_code}"
     )
-    response = requests.get(url)
+    response = requests.get(url, timeout=timeout)
     cities = response.json()
 
     matches = []
@@ -105,16 +115,8 @@ def _to_seloger_geographical_code(post_code: str) -> Tuple[str, str]:
     return matches[0]
 
 
-def decode_escapes(s: str) -> str:
-    def decode_match(match: Match) -> str:
-        return codecs.decode(match.group(0), "unicode-escape")
-
-    try:
-        escaped = ESCAPE_SEQUENCE_RE.sub(decode_match, s)
-    except TypeError:
-        msg = f"Could not escape '{s}'."
-        raise TypeError(msg)
-    return escaped
+# seloger's geographical codes, cached across scrapes
+geocodes = GeoCodeResolver("seloger", _to_seloger_geographical_code)
 
 
 class Transaction(Enum):
@@ -153,6 +155,7 @@ def seloger(
     num_results: int = 100,
     max_duplicates: int = 25,
     timeout: int = 5,
+    lite: bool = False,
 ) -> Dict[str, Union[List[str], List[Listing]]]:
     """
     Scrape all listing matching search criteria.
@@ -176,6 +179,8 @@ def seloger(
         max_duplicates: keep scraping until we see this many consecutive listings
             that are already in our database.
         timeout: maximum amount of time, in seconds, to wait for a page to load.
+        lite: only fetch the listing pages, flagging the listings as partial. Their
+            details (amenities, broker fee, etc.) are fetched later by `enrich`.
 
     Returns:
         a dictionary of "added", "seen" and "failed" listings.
@@ -219,15 +224,12 @@ def seloger(
     max_beds = ceil(max_beds) if max_beds is not None else max_beds
 
     # convert code postal to se loger's internal coade
-    seloger_codes = [_to_seloger_geographical_code(cp) for cp in post_codes]
+    seloger_codes = geocodes.resolve_many(post_codes)
     ci = [geo_code for geo_type, geo_code in seloger_codes if geo_type == "ci"]
     cp = [geo_code for geo_type, geo_code in seloger_codes if geo_type == "cp"]
 
-    # fetch all the listings already processed
-    already_done_urls = [
-        l[0]
-        for l in db.session.query(Listing.url).filter(Listing.source == "seloger").all()
-    ]
+    # check listings against the database one page of results at a time
+    listing_index = ListingIndex("seloger")
 
     # build the search url
     search_url = "https://www.seloger.com/list.html"
@@ -256,7 +258,8 @@ def seloger(
     ua = UserAgent()
 
     # get a pool of proxies
-    proxy_pool = all_proxies(infinite=True)
+    proxy_cache = ProxyCache.default()
+    proxy_pool = proxy_cache.pool()
 
     added_listings: List[Listing] = []
     seen_listings: List[Listing] = []
@@ -264,118 +267,217 @@ def seloger(
     scraped = 0
     consecutive_duplicates = 0
     page_num = 0
-    while (scraped < num_results) and (consecutive_duplicates < max_duplicates):
-
-        # get a page of results
-        if page_num != 0:
-            params.update({"LISTING-LISTpg": page_num + 1})
-        search_attempts = 0
-        max_search_attempts = 50
-        while search_attempts < max_search_attempts:
-            headers = {"user-agent": ua.random}
-            proxy = next(proxy_pool)
-            proxies = {"http": proxy, "https": proxy}
-            try:
-                page = requests.get(
-                    search_url,
-                    headers=headers,
-                    params=params,
-                    proxies=proxies,
-                    timeout=timeout,
-                )
-            except requests.exceptions.RequestException:
-                search_attempts += 1
-                continue
-            if "captcha" in urlparse(page.url).path:
-                search_attempts += 1
-                continue
-            break
-        soup = BeautifulSoup(page.text, "html.parser")
-
-        is_seloger = r".*seloger.com.*"  # exclude sponsored external listings
-        links = [
-            link["href"]
-            for link in soup.find_all(
-                "a", attrs={"name": "classified-link", "href": re.compile(is_seloger)}
-            )
-        ]
-        links = [urljoin(link, urlparse(link).path) for link in links]
-        if not links:
-            break
-
-        # scrape each of the listings on the page
-        total = len(links)
-        done = [False for _ in range(total)]
-        msg = (
-            f"Starting the scrape of {total} listings "
-            f"fetched from {unquote(page.url)} ."
-        )
-        logger.info(msg)
-        previous_round = -1
-        while sum(done) > previous_round:
-            previous_round = sum(done)
-            for i, link in enumerate(links):
-                if done[i]:
-                    continue
-
-                if link in already_done_urls:
-                    msg = f"Skipping link #{i}, as it is already in our DB: {link}."
-                    logger.debug(msg)
-                    done[i] = True
-                    consecutive_duplicates += 1
-                    seen_listings.append(link)
-                    continue
-
-                msg = f"Scraping link #{i}: {link} ..."
-                logger.debug(msg)
+    budget = RetryBudget(RETRY_BUDGET)
+    retry = RetryPolicy(**RETRY, budget=budget)
+    with Engine(
+        throttle=Throttle(RATES), proxy_pool=proxy_pool, cache=ResponseCache()
+    ) as engine:
+        while (scraped < num_results) and (consecutive_duplicates < max_duplicates):
+
+            # get a page of results
+            if page_num != 0:
+                params.update({"LISTING-LISTpg": page_num + 1})
+            for attempt in retry.attempts():
+                proxy = proxy_pool.get()
+                headers = {
+                    "user-agent": proxy_pool.user_agent(proxy, lambda: ua.random)
+                }
                 proxies = {"http": proxy, "https": proxy}
                 try:
-                    listing, is_new = _seloger(
-                        link,
-                        headers={"User-Agent": ua.random},
+                    page = engine.get(
+                        search_url,
+                        headers=headers,
+                        params=params,
                         proxies=proxies,
                         timeout=timeout,
+                        stream=True,
                     )
-                except requests.exceptions.RequestException as e:
-                    msg = f"👻Failed to retrieve the page ({type(e).__name__}).👻"
-                    logger.debug(msg)
-                    proxy = next(proxy_pool)
-                    continue
-                except exceptions.ListingParsingError as e:
-                    logger.debug(e)
+                    if "captcha" in urlparse(page.url).path:
+                        page.close()
+                        continue
+                    candidates = list(seloger_links(iter_text(page)))
+                except requests.exceptions.RequestException:
                     continue
-                except Exception:
-                    # we don't want to interrupt the program, but we don't want to
-                    # silence the unexpected error.
-                    msg = f"💥Unpexpected error.💥"
-                    logging.exception(msg)
-                    continue
-                msg = f"💫Scrape suceeded.💫"
-                logger.debug(msg)
-                done[i] = True
-                if is_new:
-                    consecutive_duplicates = 0
-                    added_listings.append(listing)
-                else:
-                    # should be rare, but is possible when the same listing
-                    # is availalble under two different links. e.g.
-                    # https://www.seloger.com/annonces/achat-de-prestige/appartement/paris-9eme-75/152886317.htm  # noqa
-                    # https://www.seloger.com/annonces/achat-de-prestige/appartement/paris-9eme-75/trudaine-maubeuge/152886317.htm  # noqa
-                    consecutive_duplicates += 1
-                    seen_listings.append(link)
-                if consecutive_duplicates >= max_duplicates:
+                break
+            else:
+                msg = f"Failed to reach seloger after {attempt + 1} attempts."
+                logger.warning(msg)
+                break
+            if not candidates:
+                break
+            links = [link for link, _ in candidates]
+
+            # scrape each of the listings on the page
+            is_known = listing_index.known(candidates)
+            total = len(links)
+            done = [False for _ in range(total)]
+            msg = (
+                f"Starting the scrape of {total} listings "
+                f"fetched from {unquote(page.url)} ."
+            )
+            logger.info(msg)
+
+            # sweep the page again, for as long as we make progress, to retry the
+            # listings we failed to scrape.
+            for sweep in RetryPolicy(**RETRY).attempts():
+                progress = sum(done)
+
+                # fetch and parse all the remaining listings concurrently...
+                tasks = {}
+                for i, link in enumerate(links):
+                    if done[i] or is_known[i]:
+                        continue
+                    if (sweep > 0) and not budget.spend():
+                        logger.debug("Retry budget exhausted. Giving up.")
+                        break
+                    proxy = proxy_pool.get()
+                    user_agent = proxy_pool.user_agent(proxy, lambda: ua.random)
+                    tasks[i] = engine.submit(
+                        _scrape,
+                        link,
+                        headers={"User-Agent": user_agent},
+                        proxies={"http": proxy, "https": proxy},
+                        timeout=timeout,
+                        engine=engine,
+                        lite=lite,
+                    )
+
+                # ... but ingest them one at a time, in order
+                for i, link in enumerate(links):
+                    if done[i]:
+                        continue
+                    if consecutive_duplicates >= max_duplicates:
+                        if i in tasks:
+                            tasks[i].cancel()
+                        continue
+
+                    if is_known[i]:
+                        msg = f"Skipping link #{i}, as it is already in our DB: {link}."
+                        logger.debug(msg)
+                        done[i] = True
+                        consecutive_duplicates += 1
+                        seen_listings.append(link)
+                        continue
+                    if i not in tasks:
+                        continue
+
+                    msg = f"Scraping link #{i}: {link} ..."
+                    logger.debug(msg)
+                    try:
+                        listing, is_new = _ingest(tasks[i].result())
+                    except requests.exceptions.RequestException as e:
+                        msg = f"👻Failed to retrieve the page ({type(e).__name__}).👻"
+                        logger.debug(msg)
+                        continue
+                    except exceptions.ListingParsingError as e:
+                        logger.debug(e)
+                        continue
+                    except Exception:
+                        # we don't want to interrupt the program, but we don't want to
+                        # silence the unexpected error.
+                        msg = f"💥Unpexpected error.💥"
+                        logging.exception(msg)
+                        continue
+                    msg = f"💫Scrape suceeded.💫"
+                    logger.debug(msg)
+                    done[i] = True
+                    listing_index.add(link, listing.external_listing_id)
+                    if is_new:
+                        consecutive_duplicates = 0
+                        added_listings.append(listing)
+                    else:
+                        # should be rare, but is possible when the same listing
+                        # is availalble under two different links. e.g.
+                        # https://www.seloger.com/annonces/achat-de-prestige/appartement/paris-9eme-75/152886317.htm  # noqa
+                        # https://www.seloger.com/annonces/achat-de-prestige/appartement/paris-9eme-75/trudaine-maubeuge/152886317.htm  # noqa
+                        consecutive_duplicates += 1
+                        seen_listings.append(link)
+
+                if (
+                    all(done)
+                    or (sum(done) == progress)
+                    or (consecutive_duplicates >= max_duplicates)
+                ):
                     break
 
-        failed_listings += [link for is_done, link in zip(done, links) if not is_done]
-        scraped += sum(done)
-        page_num += 1
+            failed_listings += [
+                link for is_done, link in zip(done, links) if not is_done
+            ]
+            scraped += sum(done)
+            page_num += 1
 
     if failed_listings:
         logger.debug(f"Failed to scrape {', '.join(failed_listings)}.")
 
+    proxy_cache.save(proxy_pool)
     return {"added": added_listings, "seen": seen_listings, "failed": failed_listings}
 
 
+def enrich(num_listings: int = 100, timeout: int = 5) -> Dict[str, List[Listing]]:
+    """
+    Fetch the details of the listings scraped in lite mode.
+
+    The oldest partial listings are enriched first. Listings we fail to enrich stay
+    partial, and will be picked up again by the next call.
+
+    Args:
+        num_listings: maximum number of listings to enrich.
+        timeout: maximum amount of time, in seconds, to wait for a page to load.
+
+    Returns:
+        a dictionary of "enriched" and "failed" listings.
+    """
+    listings = (
+        Listing.query.filter(Listing.source == "seloger", Listing.is_partial.is_(True))
+        .order_by(Listing.created_at, Listing.id)
+        .limit(num_listings)
+        .all()
+    )
+
+    ua = UserAgent()
+    proxy_cache = ProxyCache.default()
+    proxy_pool = proxy_cache.pool()
+
+    enriched_listings: List[Listing] = []
+    failed_listings: List[Listing] = []
+    with Engine(
+        throttle=Throttle(RATES), proxy_pool=proxy_pool, cache=ResponseCache()
+    ) as engine:
+        tasks = []
+        for listing in listings:
+            proxy = proxy_pool.get()
+            user_agent = proxy_pool.user_agent(proxy, lambda: ua.random)
+            tasks.append(
+                engine.submit(
+                    _scrape_details,
+                    listing.external_listing_id,
+                    listing.price,
+                    headers={"User-Agent": user_agent},
+                    proxies={"http": proxy, "https": proxy},
+                    timeout=timeout,
+                    engine=engine,
+                )
+            )
+
+        for listing, task in zip(listings, tasks):
+            try:
+                details = task.result()
+            except (
+                requests.exceptions.RequestException,
+                exceptions.ListingParsingError,
+            ) as e:
+                msg = f"Failed to enrich {listing.url} ({type(e).__name__})."
+                logger.debug(msg)
+                failed_listings.append(listing)
+                continue
+            _enrich(listing, details)
+            enriched_listings.append(listing)
+    db.session.commit()
+
+    proxy_cache.save(proxy_pool)
+    return {"enriched": enriched_listings, "failed": failed_listings}
+
+
 def _seloger(
     url: str,
     headers: Mapping[str, str] = None,
@@ -393,85 +495,106 @@ def _seloger(
         an instance of the scraped listing and a flag indicating whether it is a new
         listing.
     """
+    with Engine(max_workers=1) as engine:
+        data = _scrape(
+            url, headers=headers, proxies=proxies, timeout=timeout, engine=engine
+        )
+    return _ingest(data)
+
+
+def _scrape(
+    url: str,
+    headers: Mapping[str, str] = None,
+    proxies: Optional[Mapping[str, str]] = None,
+    timeout: int = 5,
+    *,
+    engine: Engine,
+    lite: bool = False,
+) -> Dict[str, Any]:
+    """
+    Fetch and parse a single listing from seloger.com.
+
+    This does not touch the database, so it is safe to run on the engine's workers.
+
+    Args:
+        url: URL of the listing.
+        headers: headers to be included in the request (e.g. User-Agent)
+        proxies: proxies to route the requests through.
+        timeout: maximum amount of time, in seconds, to wait for a page to load.
+        engine: engine through which to send the requests.
+        lite: skip the listing's details, and flag it as partial.
+
+    Returns:
+        the listing's data.
+    """
     if headers is None:
         ua = UserAgent()
         headers = {"user-agent": ua.random}
-    page = requests.get(url, headers=headers, proxies=proxies, timeout=timeout)
+    page = engine.get(
+        url, headers=headers, proxies=proxies, timeout=timeout, stream=True
+    )
     if "captcha" in page.url:
+        page.close()
         raise exceptions.Captcha
 
-    is_field = (
-        r"Object\.defineProperty\(\s*ConfigDetail,\s*['\"](.*)['\"],\s*"
-        r"{\s*value:\s*['\"](.*)['\"],\s*enumerable:\s*\S+\s*}"
-    )
-    matches = dict(re.findall(is_field, page.text))
-
+    # we don't need anything past the ConfigDetail object, so we stop reading there
+    html = read_until(page, CONFIG_DETAIL_START, CONFIG_DETAIL_END)
+    matches = seloger_config_detail(html)
     if not matches:
         msg = f"Could not find the expected objects in the listing's HTML source."
         raise exceptions.ListingParsingError(msg)
+    data = seloger_listing(matches)
+
+    if lite:
+        data["is_partial"] = True
+    else:
+        data.update(
+            _scrape_details(
+                data.get("external_listing_id"),
+                data.get("price"),
+                headers=headers,
+                proxies=proxies,
+                timeout=timeout,
+                engine=engine,
+            )
+        )
 
-    fields = {
-        "property_type": "typeBien",
-        "size": "surfaceT",
-        "floor": "etage",
-        "rooms": "nbPieces",
-        "bedrooms": "nbChambres",
-        "balconies": "balcon",
-        "heating": "idTypeChauffage",
-        "kitchen": "idTypeCuisine",
-        "dpe_consumption": "dpeC",
-        "dpe_emissions": "dpeL",
-        "postal_code": "cp",
-        "city": "ville",
-        "neighborhood": "nomQuartier",
-        "latitude": "mapCoordonneesLatitude",
-        "longitude": "mapCoordonneesLongitude",
-        "north_east_lat": "mapBoundingboxNortheastLatitude",
-        "north_east_long": "mapBoundingboxNortheastLongitude",
-        "south_west_lat": "mapBoundingboxSouthwestLatitude",
-        "south_west_long": "mapBoundingboxSouthwestLongitude",
-        "transaction": "typeTransaction",
-        "description": "descriptionBien",
-        "price": "rawPrice",
-        "external_listing_id": "idAnnonce",
-    }
-    data = {field: matches.get(fields[field], None) for field in fields}
-    if "description" in data:
-        data["description"] = decode_escapes(data["description"])
-    data["bathrooms"] = (
-        float(matches.get("bain", 0) or 0) + float(matches.get("eau", 0) or 0) / 2
-    )
-    data["currency"] = "€"
-
-    # replace the french decimal comma with the decimal point on numerical fields
-    for field in [
-        "price",
-        "size",
-        "floor",
-        "floors",
-        "rooms",
-        "bedrooms",
-        "balconies",
-        "dpe_consumption",
-        "dpe_emissions",
-        "latitude",
-        "longitude",
-        "north_east_lat",
-        "north_east_long",
-        "south_west_lat",
-        "south_west_long",
-    ]:
-        try:
-            data[field] = float(data[field].replace(",", "."))
-        except (KeyError, ValueError, AttributeError):
-            pass
+    data["source"] = "seloger"
+    data["url"] = url
+
+    return data
+
+
+def _scrape_details(
+    external_listing_id: str,
+    price: Optional[float],
+    headers: Mapping[str, str] = None,
+    proxies: Optional[Mapping[str, str]] = None,
+    timeout: int = 5,
+    *,
+    engine: Engine,
+) -> Dict[str, Any]:
+    """
+    Fetch and parse the details (amenities, fees, etc.) of a seloger listing.
 
-    # fetch and add the property details
+    This does not touch the database, so it is safe to run on the engine's workers.
+
+    Args:
+        external_listing_id: seloger's id of the listing.
+        price: the listing's price, to work out the broker fee.
+        headers: headers to be included in the request (e.g. User-Agent)
+        proxies: proxies to route the requests through.
+        timeout: maximum amount of time, in seconds, to wait for a page to load.
+        engine: engine through which to send the requests.
+
+    Returns:
+        the listing's details.
+    """
     details_url = (
         f"https://www.seloger.com/detail,json,caracteristique_bien.json?"
-        f"idannonce={data.get('external_listing_id')}"
+        f"idannonce={external_listing_id}"
     )
-    details_page = requests.get(
+    details_page = engine.get(
         details_url, headers=headers, proxies=proxies, timeout=timeout
     )
     if "captcha" in details_page.url:
@@ -481,70 +604,7 @@ def _seloger(
         raise exceptions.ListingParsingError(msg)
     details = details_page.json()
 
-    def _get_category_field(
-        details: Mapping[str, Any],
-        section: str,
-        field: str,
-        *,
-        group: int = 0,
-        cast: Callable = bool,
-    ) -> Any:
-
-        assert isinstance(details["categories"], list)
-        criteria = [
-            category["criteria"]
-            for category in details["categories"]
-            if category["name"] == section
-        ]
-        if not criteria:
-            return False if cast is bool else None
-        assert len(criteria) == 1
-        criteria = criteria[0]
-
-        matches = list(
-            filter(
-                None, [re.search(field, c["value"], re.IGNORECASE) for c in criteria]
-            )
-        )
-        if not matches:
-            return False if cast is bool else None
-
-        if len(matches) > 1:
-            if cast is bool:
-                return True
-            else:
-                msg = (
-                    f"Unexpectedly got several matches while searching for "
-                    f"'{field}' in section '{section}'."
-                )
-                raise RuntimeError(msg)
-        return cast(matches[0].group(group))
-
-    data["terraces"] = _get_category_field(
-        details, "Les +", r"(\d+) Terrasse", group=1, cast=int
-    )
-
-    data["has_lawn"] = _get_category_field(details, "A l'extérieur", "Jardin")
-    data["has_pool"] = _get_category_field(details, "Les +", "Piscine")
-    data["has_elevator"] = _get_category_field(details, "Les +", "Ascenseur")
-    data["has_fireplace"] = _get_category_field(details, "Les +", "Cheminée")
-    data["has_hardwood_floors"] = _get_category_field(
-        details, "A l'intérieur", "Parquet"
-    )
-    data["has_view"] = _get_category_field(details, "Les +", "Vue")
-    data["exposure"] = _get_category_field(
-        details, "Les +", r"orientation (.*)", group=1, cast=lambda x: x.strip().lower()
-    )
-    if data.get("exposure") is not None:
-        translator = {"nord": "north", "sud": "south", "est": "east", "ouest": "west"}
-        for french in translator:
-            data["exposure"] = data["exposure"].replace(french, translator[french])
-
-    data["has_cellar"] = _get_category_field(details, "Les +", "Cave")
-    data["parkings"] = _get_category_field(
-        details, "A l'extérieur", r"(\d+) Parking", group=1, cast=int
-    )
-    data["has_super"] = _get_category_field(details, "Les +", "Gardien")
+    data = seloger_features(details)
 
     # fetch the listings's details
     try:
@@ -554,8 +614,8 @@ def _seloger(
             prix_hors_honoraires = details["infos_acquereur"]["prix"][
                 "prix_hors_honoraires"
             ]
-            data["broker_fee"] = data["price"] - prix_hors_honoraires
-        except KeyError:
+            data["broker_fee"] = price - prix_hors_honoraires
+        except (KeyError, TypeError):
             pass
     try:
         data["security_deposit"] = details["infos_acquereur"]["prix"]["garantie"]
@@ -572,16 +632,37 @@ def _seloger(
     except KeyError:
         pass
 
-    data["source"] = "seloger"
-    data["url"] = url
+    return data
 
-    property = Property.create(data)
-    db.session.add(property)
-    db.session.flush()
-    data.update({"property_id": property.id})
-    listing, is_new = Listing.get_or_create(**data)
-    if is_new:
-        db.session.add(listing)
-        db.session.commit()
 
+def _ingest(data: Dict[str, Any]) -> Tuple[Listing, bool]:
+    """
+    Add a scraped listing to the database.
+
+    Args:
+        data: the listing's data, as returned by `_scrape`.
+
+    Returns:
+        an instance of the listing and a flag indicating whether it is a new listing.
+    """
+    ((listing, is_new),) = Listing.upsert([data])
+    db.session.commit()
     return listing, is_new
+
+
+def _enrich(listing: Listing, details: Dict[str, Any]):
+    """
+    Add the details of a partial listing, and of its property, to the database session.
+
+    Args:
+        listing: the partial listing.
+        details: the listing's details, as returned by `_scrape_details`.
+    """
+    for field, value in details.items():
+        # we want to replace all falsy values, except an explicit False, with None
+        value = value if (value or (value is False)) else None
+        if hasattr(Property, field):
+            setattr(listing.property_, field, value)
+        elif hasattr(Listing, field):
+            setattr(listing, field, value)
+    listing.is_partial = False
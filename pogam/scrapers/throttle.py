@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Mapping, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class RateController(object):
+    """
+    Token bucket whose rate adapts to the responses of the server (AIMD).
+
+    Every clean response increases the rate by a fixed step, up to `max_rate`. Every
+    sign of trouble (captcha, error status code, timeout) multiplies it by `decrease`,
+    down to `min_rate`. Callers block in :meth:`acquire` until a token is available.
+
+    Args:
+        rate: initial rate, in requests per second.
+        min_rate: lowest rate we back off to.
+        max_rate: highest rate we speed up to.
+        burst: maximum number of tokens that can accumulate while idle.
+        increase: additive increase of the rate after each clean response.
+            Defaults to `min_rate`.
+        decrease: multiplicative decrease of the rate after each failure.
+        clock: monotonic clock, in seconds.
+        sleep: function used to wait for a token.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        *,
+        min_rate: float,
+        max_rate: float,
+        burst: float = 1,
+        increase: Optional[float] = None,
+        decrease: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if not (0 < min_rate <= rate <= max_rate):
+            msg = (
+                f"Expected 0 < min_rate <= rate <= max_rate. "
+                f"Got {min_rate}, {rate} and {max_rate} instead."
+            )
+            raise ValueError(msg)
+        if not (0 < decrease < 1):
+            msg = f"'decrease' must be between 0 and 1. Got {decrease} instead."
+            raise ValueError(msg)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase if increase is not None else min_rate
+        self.decrease = decrease
+        self._rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._updated_at = clock()
+
+    @property
+    def rate(self) -> float:
+        """Current rate, in requests per second."""
+        return self._rate
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(now - self._updated_at, 0)
+        self._tokens = min(self._tokens + elapsed * self._rate, self.burst)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """
+        Wait for our turn to send a request.
+
+        Returns:
+            the time waited, in seconds.
+        """
+        with self._lock:
+            self._refill()
+            # reserve a token now, even if it means going into debt, so that concurrent
+            # callers line up one after the other instead of all waking up at once.
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def success(self):
+        """Record a clean response."""
+        with self._lock:
+            self._refill()
+            self._rate = min(self._rate + self.increase, self.max_rate)
+
+    def failure(self):
+        """Record a captcha, an error status code or a timeout."""
+        with self._lock:
+            self._refill()
+            self._rate = max(self._rate * self.decrease, self.min_rate)
+
+
+class Throttle(object):
+    """
+    Per-host rate controllers.
+
+    Args:
+        rates: for each host (e.g. 'www.seloger.com'), keyword arguments of its
+            :class:`RateController`. Requests to other hosts are not throttled.
+    """
+
+    def __init__(self, rates: Optional[Mapping[str, Mapping]] = None):
+        self._controllers: Dict[str, RateController] = {
+            host: RateController(**kwargs) for host, kwargs in (rates or {}).items()
+        }
+
+    def controller(self, url: str) -> Optional[RateController]:
+        """Return the rate controller of the url's host, if any."""
+        return self._controllers.get(urlparse(url).netloc)
+
+    def acquire(self, url: str):
+        controller = self.controller(url)
+        if controller is None:
+            return
+        waited = controller.acquire()
+        if waited:
+            host = urlparse(url).netloc
+            msg = (
+                f"Waited {waited:.1f}s for {host} "
+                f"(currently {controller.rate:.3f} requests/s)."
+            )
+            logger.debug(msg)
+
+    def success(self, url: str):
+        controller = self.controller(url)
+        if controller is not None:
+            controller.success()
+
+    def failure(self, url: str):
+        controller = self.controller(url)
+        if controller is None:
+            return
+        controller.failure()
+        msg = (
+            f"Backing off {urlparse(url).netloc}: "
+            f"now at {controller.rate:.3f} requests/s."
+        )
+        logger.debug(msg)
@@ -0,0 +1,158 @@
+import io
+import logging
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from .. import db
+from ..models import Listing
+from .images import ImageStore
+
+try:
+    from PIL import Image as PILImage  # type: ignore
+    from PIL import ImageOps  # type: ignore
+except ImportError:  # pragma: no cover
+    PILImage = None
+
+logger = logging.getLogger(__name__)
+
+# derived versions of the images, stored next to the originals
+VARIANTS = {
+    "thumbnail": {"suffix": ".thumb.webp", "max_size": 320, "quality": 75},
+    "webp": {"suffix": ".webp", "max_size": None, "quality": 80},
+}
+
+# the store of the current worker
+_store: Optional[ImageStore] = None
+
+
+def variant_path(path: str, name: str) -> str:
+    """Path of a variant of the image stored at `path`."""
+    base, _ = os.path.splitext(path)
+    return base + VARIANTS[name]["suffix"]
+
+
+def transcode(content: bytes) -> Dict[str, bytes]:
+    """
+    Derive the variants of an image.
+
+    Args:
+        content: the original image.
+
+    Returns:
+        the content of each variant, by name.
+    """
+    variants = {}
+    with PILImage.open(io.BytesIO(content)) as original:
+        # honour the camera's orientation, since the variants lose the EXIF tags
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        for name, variant in VARIANTS.items():
+            resized = image.copy()
+            if variant["max_size"] is not None:
+                resized.thumbnail((variant["max_size"], variant["max_size"]))
+            buffer = io.BytesIO()
+            resized.save(buffer, format="WEBP", quality=variant["quality"])
+            variants[name] = buffer.getvalue()
+    return variants
+
+
+def _init_worker():
+    global _store
+    _store = ImageStore.default()
+
+
+def _derive(path: str) -> Optional[Dict[str, str]]:
+    """
+    Derive and store the variants of a stored image, unless they already are.
+
+    Returns:
+        the path of each variant, by name, or None if the image is missing or is not
+        an image.
+    """
+    assert _store is not None
+    paths = {name: variant_path(path, name) for name in VARIANTS}
+    if all(_store.exists(p) for p in paths.values()):
+        return paths
+    try:
+        content = _store.read(path)
+    except FileNotFoundError:
+        return None
+    try:
+        variants = transcode(content)
+    except (OSError, ValueError):
+        # e.g. not an image, or a truncated one
+        logger.debug(f"Could not transcode {path}.", exc_info=True)
+        return None
+    for name, variant in variants.items():
+        _store.write(paths[name], variant)
+    return paths
+
+
+def _pool(max_workers: Optional[int]) -> Executor:
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker)
+    except (OSError, NotImplementedError):
+        # e.g. on AWS Lambda, which has no shared memory for process pools
+        logger.debug("Process pools are not available. Falling back to threads.")
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=_init_worker)
+
+
+def derive_variants(
+    num_listings: int = 100, max_workers: Optional[int] = None
+) -> Dict[str, List[Listing]]:
+    """
+    Derive thumbnails and WebP versions of the stored images of listings.
+
+    The images are transcoded in a process pool, off the scrapes' critical path. The
+    paths of the variants are recorded in `Listing.image_variants`, in the same order
+    as `Listing.images`. Variants are stored by content, like the originals, so
+    images shared by several listings are only transcoded once. Listings whose
+    deferred images are still pending are left for later.
+
+    Must be called from within an app context.
+
+    Args:
+        num_listings: maximum number of listings to process, oldest first.
+        max_workers: number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        the listings that were processed and the ones we failed to process.
+    """
+    if PILImage is None:
+        msg = "Deriving image variants requires Pillow: pip install Pillow."
+        raise RuntimeError(msg)
+
+    listings = (
+        Listing.query.filter(
+            Listing.image_variants.is_(None),
+            # deferred images we are still waiting on
+            db.or_(Listing.images_status.is_(None), Listing.images_status != "pending"),
+        )
+        .order_by(Listing.created_at)
+        .limit(num_listings)
+        .all()
+    )
+    processed: List[Listing] = []
+    failed: List[Listing] = []
+    with _pool(max_workers) as pool:
+        tasks: Dict[str, Future] = {}
+        for listing in listings:
+            for path in listing.images or []:
+                if path not in tasks:
+                    tasks[path] = pool.submit(_derive, path)
+
+        for listing in listings:
+            try:
+                listing.image_variants = [
+                    tasks[path].result() for path in listing.images or []
+                ]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                logger.exception(f"Failed to derive the images of {listing.url}.")
+                failed.append(listing)
+                continue
+            processed.append(listing)
+    return {"processed": processed, "failed": failed}
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import Any, Optional
+
+import sqlalchemy as sa  # type: ignore
+
+from .. import db
+from ..models import Watermark
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(search: Any) -> Any:
+    if isinstance(search, dict):
+        return {str(k): _normalize(v) for k, v in search.items()}
+    if isinstance(search, (list, tuple, set)):
+        items = [_normalize(item) for item in search]
+        return sorted(items, key=lambda item: json.dumps(item, sort_keys=True))
+    return search
+
+
+def search_key(search: Any) -> str:
+    """
+    Hash search parameters, regardless of the order of their keys and lists.
+
+    Args:
+        search: the search's parameters. Anything JSON serializable.
+
+    Returns:
+        a hexadecimal digest.
+    """
+    normalized = json.dumps(_normalize(search), sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class SearchWatermark(object):
+    """
+    High-water mark of a search whose results are sorted newest first.
+
+    Scrapes remember the sort key of the newest result they are done with, so that
+    the next scrape of the same search can stop as soon as it reaches older results.
+    Results we failed to scrape hold the watermark back, so that they are retried.
+
+    Database access happens on the calling thread only, which must be in an app
+    context.
+
+    Args:
+        source: source of the search, e.g. 'leboncoin'.
+        search: the search's parameters, excluding pagination.
+    """
+
+    def __init__(self, source: str, search: Any):
+        self.source = source
+        self.search = search_key(search)
+        row = Watermark.query.filter_by(source=source, search=self.search).first()
+        self.value: Optional[str] = row.value if row is not None else None
+        self._newest: Optional[str] = None
+        self._oldest_failure: Optional[str] = None
+
+    def passed(self, key: Optional[str]) -> bool:
+        """Whether a result is older than the newest result of the previous scrapes."""
+        return (self.value is not None) and (key is not None) and (key < self.value)
+
+    def seen(self, key: Optional[str]):
+        """Record that we are done with a result."""
+        if key is not None and (self._newest is None or key > self._newest):
+            self._newest = key
+
+    def failed(self, key: Optional[str]):
+        """Record that we failed to scrape a result, and should try again next time."""
+        if key is not None and (
+            self._oldest_failure is None or key < self._oldest_failure
+        ):
+            self._oldest_failure = key
+
+    def save(self):
+        """Move the watermark past the results we are done with."""
+        values = [v for v in [self.value, self._newest] if v is not None]
+        if not values:
+            return
+        value = max(values)
+        if self._oldest_failure is not None:
+            value = min(value, self._oldest_failure)
+        if value == self.value:
+            return
+
+        try:
+            row = Watermark.query.filter_by(
+                source=self.source, search=self.search
+            ).first()
+            if row is None:
+                row = Watermark(source=self.source, search=self.search)
+                db.session.add(row)
+            row.value, row.updated_at = value, datetime.utcnow()
+            db.session.commit()
+        except sa.exc.SQLAlchemyError:
+            # e.g. a concurrent scrape of the same search saved its watermark first
+            db.session.rollback()
+            logger.debug("Failed to save the watermark.", exc_info=True)
+            return
+        msg = f"Moved the {self.source} watermark from {self.value} to {value}."
+        logger.debug(msg)
+        self.value = value
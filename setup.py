@@ -58,6 +58,7 @@ setup(
             "httmock",
             "ipython",
             "boto3",
+            "Pillow",
         ]
     },
     entry_points="""
@@ -302,15 +302,22 @@ def in_memory_db():
 
 
 @pytest.fixture()
-def mock_proxies():
+def mock_proxies(tmp_path):
     content = """0.1.2.3:45"""
 
-    @urlmatch(netloc=r"(www.proxy-list.download)|(proxy11.com)")
+    # proxy lists, and the url we check them against
+    @urlmatch(netloc=r"(www.proxy-list.download)|(proxy11.com)|(httpbin.org)")
     def mock_response(url, request):
         return response(200, content=content, headers={"Content-Type": "text/plain"})
 
+    tmp = os.getenv("POGAM_PROXY_CACHE")
+    os.environ["POGAM_PROXY_CACHE"] = str(tmp_path / "proxies.json")
     with contextlib.ExitStack() as stack:
         yield stack.enter_context(HTTMock(mock_response))
+    if tmp is not None:
+        os.environ["POGAM_PROXY_CACHE"] = tmp
+    else:
+        del os.environ["POGAM_PROXY_CACHE"]
 
 
 @pytest.fixture
@@ -320,3 +327,15 @@ def images_folder(tmp_path):
     yield
     if tmp is not None:
         os.environ["POGAM_IMAGES_FOLDER"] = tmp
+
+
+@pytest.fixture(autouse=True)
+def http_cache(tmp_path):
+    # scrapes should never revalidate against, or fill up, the user's cache
+    tmp = os.getenv("POGAM_HTTP_CACHE")
+    os.environ["POGAM_HTTP_CACHE"] = str(tmp_path / "http_cache.sqlite")
+    yield
+    if tmp is not None:
+        os.environ["POGAM_HTTP_CACHE"] = tmp
+    else:
+        del os.environ["POGAM_HTTP_CACHE"]
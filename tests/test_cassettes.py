@@ -0,0 +1,129 @@
+import importlib
+import json
+import os
+import time
+
+import pytest
+import requests
+from httmock import HTTMock, response, urlmatch
+
+from pogam import create_app
+from pogam.scrapers.cassettes import Cassette, full_speed
+from pogam.scrapers.leboncoin import leboncoin
+
+here = os.path.dirname(__file__)
+fixtures_folder = os.path.join(here, "fixtures", "leboncoin")
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def cassette_path(tmp_path):
+    return str(tmp_path / "cassette.jsonl.gz")
+
+
+@pytest.fixture
+def mock_host():
+    calls = {"n": 0}
+
+    @urlmatch(netloc="recorded.test")
+    def mock_response(url, request):
+        calls["n"] += 1
+        if url.path == "/error":
+            raise requests.exceptions.ReadTimeout
+        body = {"path": url.path, "query": url.query, "call": calls["n"]}
+        if request.body:
+            body["body"] = json.loads(request.body)
+        headers = {"Content-Type": "application/json"}
+        return response(200, body, headers=headers, request=request)
+
+    return mock_response
+
+
+@pytest.fixture
+def mock_search():
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        content = json.load(f)["response"]
+    content.pop("pivot")
+
+    @urlmatch(netloc="api.leboncoin.fr", path="/api/adfinder/v1/search", method="post")
+    def mock_response(url, request):
+        return response(200, content, request=request)
+
+    @urlmatch(netloc=r".*img.*.leboncoin.fr.*")
+    def mock_image(url, request):
+        with open(os.path.join(fixtures_folder, "img.jpg"), "rb") as f:
+            return response(200, f.read(), request=request)
+
+    return mock_response, mock_image
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_record_and_replay(cassette_path, mock_host):
+    with HTTMock(mock_host), Cassette(cassette_path).record():
+        recorded = [
+            requests.get("https://recorded.test/a?y=2&x=1").json(),
+            requests.get("https://recorded.test/a?x=1&y=2").json(),
+            requests.post("https://recorded.test/b", json={"page": 1}).json(),
+            requests.post("https://recorded.test/b", json={"page": 2}).json(),
+        ]
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            requests.get("https://recorded.test/error")
+    assert os.path.exists(cassette_path)
+
+    with Cassette(cassette_path).replay():
+        replayed = [
+            requests.get("https://recorded.test/a?x=1&y=2").json(),
+            requests.get("https://recorded.test/a?x=1&y=2").json(),
+            requests.post("https://recorded.test/b", json={"page": 2}).json(),
+            requests.post("https://recorded.test/b", json={"page": 1}).json(),
+        ]
+        # we ran out of recorded answers: the last one is repeated
+        assert requests.get("https://recorded.test/a?x=1&y=2").json() == recorded[1]
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            requests.get("https://recorded.test/error")
+        with pytest.raises(requests.exceptions.ConnectionError, match="No recorded"):
+            requests.get("https://recorded.test/c")
+    assert replayed == [recorded[0], recorded[1], recorded[3], recorded[2]]
+
+
+def test_replay_latency(cassette_path, mock_host):
+    with HTTMock(mock_host), Cassette(cassette_path).record() as cassette:
+        requests.get("https://recorded.test/a")
+        cassette.interactions[0]["elapsed"] = 0.1
+
+    with Cassette(cassette_path).replay(latency=True):
+        start = time.monotonic()
+        r = requests.get("https://recorded.test/a")
+        assert time.monotonic() - start >= 0.1
+    assert r.elapsed.total_seconds() == 0.1
+
+
+def test_full_speed():
+    module = importlib.import_module("pogam.scrapers.seloger")
+    rates, retry = dict(module.RATES), dict(module.RETRY)
+    with full_speed():
+        assert module.RATES == {}
+        assert module.RETRY["base_delay"] == 0
+    assert module.RATES == rates
+    assert module.RETRY == retry
+
+
+def test_replay_scrape(
+    cassette_path, mock_search, mock_proxies, in_memory_db, images_folder
+):
+    search = {"transaction": "rent", "post_codes": ["92130"], "max_duplicates": 500}
+    with HTTMock(*mock_search), Cassette(cassette_path).record(), full_speed():
+        with create_app("cli").app_context():
+            recorded = leboncoin(**search)
+
+    with Cassette(cassette_path).replay(), full_speed():
+        with create_app("cli").app_context():
+            replayed = leboncoin(**search)
+
+    for key in ["added", "seen", "failed"]:
+        assert len(replayed[key]) == len(recorded[key])
+    assert recorded["added"]
@@ -0,0 +1,81 @@
+import pytest
+
+from pogam import create_app, db
+from pogam.models import Listing
+from pogam.scrapers.dedup import ListingIndex
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        for source, url, external_listing_id in [
+            ("seloger", "https://www.seloger.com/1.htm", "1"),
+            ("seloger", "https://www.seloger.com/2.htm", "2"),
+            ("leboncoin", "https://www.leboncoin.fr/3.htm", "3"),
+        ]:
+            listing = Listing.create(
+                source=source,
+                url=url,
+                transaction="rent",
+                external_listing_id=external_listing_id,
+            )
+            db.session.add(listing)
+        db.session.commit()
+        yield app
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_known_listings(app):
+    index = ListingIndex("seloger")
+    actual = index.known(
+        [
+            ("https://www.seloger.com/1.htm", None),
+            ("https://www.seloger.com/other/2.htm", "2"),
+            ("https://www.leboncoin.fr/3.htm", "3"),
+            ("https://www.seloger.com/4.htm", None),
+        ]
+    )
+    assert actual == [True, True, False, False]
+
+
+def test_known_listings_normalized_urls(app):
+    index = ListingIndex("seloger")
+    actual = index.known(
+        [
+            ("HTTPS://WWW.SELOGER.COM:443/1.htm#photos", None),
+            ("https://www.seloger.com/1.HTM", None),
+        ]
+    )
+    assert actual == [True, False]
+
+
+def test_known_listings_are_cached(app):
+    index = ListingIndex("seloger")
+    queries = []
+    original_query = index._query
+
+    def _query(urls, ids):
+        queries.append((urls, ids))
+        return original_query(urls, ids)
+
+    index._query = _query
+    index.known([("https://www.seloger.com/1.htm", None)])
+    index.add("https://www.seloger.com/5.htm", "5")
+    actual = index.known(
+        [("https://www.seloger.com/1.htm", None), (None, "5"), (None, "6")]
+    )
+    assert actual == [True, True, False]
+    assert queries == [(["https://www.seloger.com/1.htm"], []), ([], ["6"])]
+
+
+def test_lru_eviction(app):
+    index = ListingIndex("seloger", maxsize=2)
+    for i in range(5):
+        index.add(f"https://www.seloger.com/{i}.htm")
+    assert len(index._known) == 2
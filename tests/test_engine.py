@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+import requests
+from httmock import HTTMock, response, urlmatch
+
+from pogam.scrapers.engine import Engine
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def slow_host():
+    calls = {"total": 0, "concurrent": 0, "max_concurrent": 0}
+    lock = threading.Lock()
+
+    @urlmatch(netloc="slow.test")
+    def mock_response(url, request):
+        with lock:
+            calls["total"] += 1
+            calls["concurrent"] += 1
+            calls["max_concurrent"] = max(calls["max_concurrent"], calls["concurrent"])
+        time.sleep(0.05)
+        with lock:
+            calls["concurrent"] -= 1
+        if url.path == "/error":
+            raise requests.exceptions.ConnectionError
+        return response(200, url.path, request=request)
+
+    with HTTMock(mock_response):
+        yield calls
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_max_per_host(slow_host):
+    with Engine(max_workers=8, max_per_host=2) as engine:
+        futures = [
+            engine.submit(engine.get, f"https://slow.test/{i}") for i in range(8)
+        ]
+        texts = [future.result().text for future in futures]
+    assert texts == [f"/{i}" for i in range(8)]
+    assert slow_host["total"] == 8
+    assert slow_host["max_concurrent"] == 2
+
+
+def test_in_flight_requests_are_shared(slow_host):
+    with Engine(max_workers=4) as engine:
+        futures = [
+            engine.submit(engine.get, "https://slow.test/same", params={"a": 1})
+            for _ in range(4)
+        ]
+        responses = [future.result() for future in futures]
+    assert slow_host["total"] == 1
+    assert all(r is responses[0] for r in responses)
+
+
+def test_in_flight_errors_are_shared(slow_host):
+    with Engine(max_workers=4) as engine:
+        futures = [
+            engine.submit(engine.get, "https://slow.test/error") for _ in range(4)
+        ]
+        for future in futures:
+            with pytest.raises(requests.exceptions.ConnectionError):
+                future.result()
+    assert slow_host["total"] == 1
+
+
+def test_in_flight_requests_are_resolved_on_any_error(slow_host):
+    def blocked(response):
+        raise ValueError("Oops.")
+
+    with Engine(max_workers=4) as engine:
+        futures = [
+            engine.submit(engine.get, "https://slow.test/same", blocked=blocked)
+            for _ in range(2)
+        ]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result(timeout=5)
+        assert not engine._in_flight
+        assert engine.get("https://slow.test/same").text == "/same"
+
+
+def test_one_session_per_proxy():
+    with Engine() as engine:
+        proxies = {"http": "http://0.1.2.3:45"}
+        assert engine.session(proxies) is engine.session(dict(proxies))
+        assert engine.session(proxies) is not engine.session(None)
+        assert engine.session(proxies).proxies == proxies
@@ -0,0 +1,184 @@
+import json
+import os
+
+import pytest
+from httmock import response
+
+from pogam.scrapers import extractors
+from pogam.scrapers.extractors import (
+    CONFIG_DETAIL_END,
+    CONFIG_DETAIL_START,
+    decode_escapes,
+    iter_text,
+    read_until,
+    seloger_config_detail,
+    seloger_features,
+    seloger_links,
+    seloger_listing,
+)
+
+here = os.path.dirname(__file__)
+root_folder = os.path.abspath(os.path.join(here, ".."))
+fixtures_folder = os.path.join(root_folder, "tests", "fixtures", "seloger")
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def make_page():
+    def _make_page(content):
+        page = response(200, content)
+        page.encoding = "utf-8"
+        return page
+
+    return _make_page
+
+
+@pytest.fixture
+def results_page():
+    return """
+    <html><body>
+      <a name="classified-link" href="https://www.seloger.com/annonces/a/1.htm?x=1">
+        first
+      </a>
+      <a name="other" href="https://www.seloger.com/annonces/a/2.htm">not a listing</a>
+      <a name="classified-link" href="https://www.external.com/annonces/3.htm">ad</a>
+      <a name="classified-link" href="https://www.seloger.com/annonces/b/4.htm?a&amp;b">
+        fourth
+      </a>
+      <a name="classified-link" href="https://www.seloger.com/annonces/a/b/1.htm">
+        first, under another url
+      </a>
+      <a name="classified-link" href="https://www.seloger.com/annonces/a/1.htm">
+        first, again
+      </a>
+      <a name="classified-link" href="https://www.seloger.com/annonces/projet">no id</a>
+    </body></html>
+    """
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+@pytest.mark.parametrize("chunk_size", [1, 3, 5, 1_000])
+def test_read_until(make_page, chunk_size):
+    content = "before <start> middle é <end> after <end>".encode("utf-8")
+    page = make_page(content)
+    actual = read_until(page, b"<start>", b"<end>", chunk_size=chunk_size)
+    assert actual == "before <start> middle é "
+
+
+@pytest.mark.parametrize(
+    "content", ["no markers <end>", "<end> end before start <start> but not after"]
+)
+def test_read_until_reads_everything_without_markers(make_page, content):
+    page = make_page(content.encode("utf-8"))
+    assert read_until(page, b"<start>", b"<end>", chunk_size=4) == content
+
+
+def test_decode_escapes():
+    assert decode_escapes("l\\'agence") == "l'agence"
+    assert decode_escapes("caf\\u00e9\\n") == "café\n"
+    assert decode_escapes("nothing to decode") == "nothing to decode"
+    with pytest.raises(TypeError):
+        decode_escapes(None)
+
+
+def test_seloger_listing(make_page):
+    with open(os.path.join(fixtures_folder, "success.html"), "rb") as f:
+        content = f.read()
+
+    page = make_page(content)
+    html = read_until(page, CONFIG_DETAIL_START, CONFIG_DETAIL_END)
+    assert len(html) < len(content) / 2
+
+    # stopping early doesn't lose anything
+    expected = seloger_config_detail(content.decode("utf-8"))
+    actual = seloger_config_detail(html)
+    assert actual == expected
+
+    data = seloger_listing(actual)
+    assert data["external_listing_id"] == "153986069"
+    assert data["city"] == "Neuilly sur Seine"
+    assert data["description"].startswith("NEUILLY CHAUVEAU Situé au calme")
+    assert "d'une résidence" in data["description"]
+    assert data["bathrooms"] == 1.0
+    assert data["currency"] == "€"
+    assert (data["price"], data["size"], data["rooms"]) == (1175.0, 28.39, 1.0)
+    assert data["latitude"] == ""  # not a number: left as is
+
+
+def test_seloger_fields_not_found():
+    with open(os.path.join(fixtures_folder, "fields_not_found.html")) as f:
+        assert seloger_config_detail(f.read()) == {}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 10_000])
+def test_seloger_links(make_page, results_page, chunk_size):
+    page = make_page(results_page.encode("utf-8"))
+    actual = list(seloger_links(iter_text(page, chunk_size=chunk_size)))
+    expected = [
+        ("https://www.seloger.com/annonces/a/1.htm", "1"),
+        ("https://www.seloger.com/annonces/b/4.htm", "4"),
+        ("https://www.seloger.com/annonces/projet", None),
+    ]
+    assert actual == expected
+
+
+def test_seloger_links_fallback(monkeypatch, results_page):
+    def _feed(self, data):
+        raise AssertionError("Broken markup.")
+
+    monkeypatch.setattr(extractors._SelogerLinkParser, "feed", _feed)
+    actual = list(seloger_links([results_page[:100], results_page[100:]]))
+    assert [listing_id for _, listing_id in actual] == ["1", "4", None]
+
+
+def test_seloger_features():
+    with open(os.path.join(fixtures_folder, "success_details.json")) as f:
+        details = json.load(f)
+    expected = {
+        "terraces": 1,
+        "has_lawn": False,
+        "has_pool": False,
+        "has_elevator": False,
+        "has_fireplace": False,
+        "has_hardwood_floors": False,
+        "has_view": False,
+        "exposure": None,
+        "has_cellar": False,
+        "parkings": None,
+        "has_super": False,
+    }
+    actual = seloger_features(details)
+    assert actual == expected
+    assert list(actual) == list(expected)
+
+
+def test_seloger_features_matches():
+    details = {
+        "categories": [
+            {
+                "name": "Les +",
+                "criteria": [
+                    {"value": "Vue dégagée"},
+                    {"value": "Vue sur mer"},
+                    {"value": "Orientation Nord "},
+                    {"value": "piscine"},
+                ],
+            },
+            {"name": "A l'extérieur", "criteria": [{"value": "2 Parkings"}]},
+            {"name": "Autres", "criteria": [{"value": "Ascenseur"}]},
+        ]
+    }
+    actual = seloger_features(details)
+    assert actual["has_view"] is True
+    assert actual["has_pool"] is True
+    assert actual["has_elevator"] is False
+    assert actual["exposure"] == "north"
+    assert actual["parkings"] == 2
+
+    details["categories"][1]["criteria"].append({"value": "1 Parking"})
+    with pytest.raises(RuntimeError, match=r".*several matches.*Parking.*"):
+        seloger_features(details)
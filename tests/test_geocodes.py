@@ -0,0 +1,123 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from pogam import create_app, db
+from pogam.models import GeographicalCode
+from pogam.scrapers.geocodes import GeoCodeResolver
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def fetch():
+    class Fetch:
+        def __init__(self):
+            self.calls = []
+            self.lock = threading.Lock()
+            self.failures = {}
+
+        def __call__(self, post_code):
+            with self.lock:
+                self.calls.append(post_code)
+                failures = self.failures.get(post_code, 0)
+                self.failures[post_code] = failures - 1
+            if failures > 0:
+                raise requests.exceptions.ConnectionError
+            if post_code == "99999":
+                raise ValueError(f"Unknown post code '{post_code}'.")
+            if len(post_code) == 2:
+                return ("cp", post_code)
+            return ("ci", post_code[:2] + "0" + post_code[2:])
+
+    return Fetch()
+
+
+@pytest.fixture
+def no_offline_table(tmp_path):
+    return str(tmp_path / "missing.csv")
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_resolve_many(app, fetch, no_offline_table):
+    resolver = GeoCodeResolver("test", fetch, offline_table=no_offline_table)
+    actual = resolver.resolve_many(["75", 92200, "75", "93100"])
+    assert actual == [("cp", "75"), ("ci", "920200"), ("cp", "75"), ("ci", "930100")]
+    assert sorted(fetch.calls) == ["75", "92200", "93100"]
+
+    # answered from memory
+    assert resolver.resolve("92200") == ("ci", "920200")
+    assert len(fetch.calls) == 3
+
+    # answered from the database, by another resolver
+    other_resolver = GeoCodeResolver("test", fetch, offline_table=no_offline_table)
+    assert other_resolver.resolve("93100") == ("ci", "930100")
+    assert len(fetch.calls) == 3
+    assert GeographicalCode.query.count() == 3
+
+
+def test_expired_codes_are_fetched_again(app, fetch, no_offline_table):
+    resolver = GeoCodeResolver("test", fetch, offline_table=no_offline_table)
+    resolver.resolve("75")
+    row = GeographicalCode.query.one()
+    row.fetched_at = datetime.utcnow() - timedelta(days=365)
+    db.session.commit()
+
+    other_resolver = GeoCodeResolver("test", fetch, offline_table=no_offline_table)
+    assert other_resolver.resolve("75") == ("cp", "75")
+    assert fetch.calls == ["75", "75"]
+    assert GeographicalCode.query.one().fetched_at > datetime.utcnow() - timedelta(1)
+
+
+def test_offline_table(app, fetch, tmp_path):
+    offline_table = tmp_path / "codes.csv"
+    offline_table.write_text("post_code,geo_type,geo_code\n75016,ci,750116\n")
+    resolver = GeoCodeResolver("test", fetch, offline_table=str(offline_table))
+    assert resolver.resolve_many(["75016", "75"]) == [("ci", "750116"), ("cp", "75")]
+    assert fetch.calls == ["75"]
+
+
+def test_export(app, fetch, tmp_path, no_offline_table):
+    resolver = GeoCodeResolver("test", fetch, offline_table=no_offline_table)
+    resolver.resolve_many(["92200", "75"])
+    path = str(tmp_path / "codes.csv")
+    resolver.export(path)
+
+    offline_resolver = GeoCodeResolver("test", fetch, offline_table=path)
+    offline_resolver._query = lambda post_codes: {}
+    assert offline_resolver.resolve_many(["75", "92200"]) == [
+        ("cp", "75"),
+        ("ci", "920200"),
+    ]
+    assert len(fetch.calls) == 2
+
+
+def test_errors(app, fetch, no_offline_table):
+    fetch.failures = {"75": 2, "92200": 10}
+    resolver = GeoCodeResolver(
+        "test",
+        fetch,
+        offline_table=no_offline_table,
+        retry={"max_attempts": 3, "base_delay": 0},
+    )
+    with pytest.raises(ValueError, match="Unknown post code '99999'."):
+        resolver.resolve_many(["75", "99999", "92200"])
+    assert fetch.calls.count("75") == 3
+    with pytest.raises(requests.exceptions.ConnectionError):
+        resolver.resolve("92200")
+
+    # the codes we did get are kept
+    assert resolver.resolve("75") == ("cp", "75")
+    assert fetch.calls.count("75") == 3
@@ -0,0 +1,140 @@
+import sqlite3
+
+import pytest
+import requests
+from httmock import HTTMock, response, urlmatch
+
+from pogam.scrapers.engine import Engine
+from pogam.scrapers.httpcache import ResponseCache, normalize_url
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def host():
+    requests_ = []
+
+    @urlmatch(netloc="cached.test")
+    def mock_response(url, request):
+        requests_.append(request)
+        body = ("é" * 1000 + url.path).encode("utf-8")
+        if url.path == "/no-validators":
+            return response(200, body, request=request)
+        etag = f'"{url.path}"'
+        if request.headers.get("If-None-Match") == etag:
+            return response(304, b"", headers={"ETag": etag}, request=request)
+        headers = {"ETag": etag, "Content-Type": "text/plain; charset=utf-8"}
+        return response(200, body, headers=headers, request=request)
+
+    with HTTMock(mock_response):
+        yield requests_
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("HTTPS://Example.test:443/a?b=2&a=1#top", "https://example.test/a?a=1&b=2"),
+        ("http://example.test:8080", "http://example.test:8080/"),
+        ("https://example.test/a?a=", "https://example.test/a?a="),
+    ],
+)
+def test_normalize_url(url, expected):
+    assert normalize_url(url) == expected
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_conditional_requests(cache, host, stream):
+    with Engine(cache=cache) as engine:
+        first = engine.get("https://cached.test/a", params={"x": 1}, stream=stream)
+        first_text = "".join(first.iter_content(100, decode_unicode=True))
+        second = engine.get("https://CACHED.test/a?x=1", stream=stream)
+        second_text = "".join(second.iter_content(100, decode_unicode=True))
+
+    assert first_text == second_text == "é" * 1000 + "/a"
+    assert not getattr(first, "from_cache", False)
+    assert second.from_cache
+    assert second.status_code == 200
+    assert second.headers["etag"] == '"/a"'
+    assert "If-None-Match" not in host[0].headers
+    assert host[1].headers["If-None-Match"] == '"/a"'
+    assert len(cache) == 1
+    assert cache.size < 1000
+
+
+def test_partly_read_streamed_responses_are_not_cached(cache, host):
+    with Engine(cache=cache) as engine:
+        first = engine.get("https://cached.test/a", stream=True)
+        next(first.iter_content(100))
+        first.close()
+        engine.get("https://cached.test/a", stream=True).close()
+    assert len(cache) == 0
+    assert "If-None-Match" not in host[1].headers
+
+
+def test_responses_without_validators_are_not_cached(cache, host):
+    with Engine(cache=cache) as engine:
+        engine.get("https://cached.test/no-validators")
+        engine.get("https://cached.test/no-validators")
+    assert len(cache) == 0
+    assert "If-None-Match" not in host[1].headers
+
+
+def test_lru_eviction(cache, host):
+    with Engine(cache=cache) as engine:
+        engine.get("https://cached.test/a")
+    cache.max_size = cache.size * 2 + 10
+
+    with Engine(cache=cache) as engine:
+        engine.get("https://cached.test/b")
+        engine.get("https://cached.test/a")  # a is now more recent than b
+        engine.get("https://cached.test/c")
+    assert cache.get("https://cached.test/a") is not None
+    assert cache.get("https://cached.test/b") is None
+    assert cache.get("https://cached.test/c") is not None
+    assert cache.size <= cache.max_size
+    assert cache.size == len(cache.get("https://cached.test/a").body) + len(
+        cache.get("https://cached.test/c").body
+    )
+
+
+def test_size_is_kept_up_to_date(tmp_path, host):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path)
+    with Engine(cache=cache) as engine:
+        response = engine.get("https://cached.test/a")
+        size = cache.size
+        # cached again, on top of itself
+        cache.put("https://cached.test/a", response)
+        assert cache.size == size
+        engine.get("https://cached.test/b")
+    cache.close()
+
+    # another process, or an older cache
+    connection = sqlite3.connect(path)
+    connection.execute("DELETE FROM stats")
+    connection.commit()
+    connection.close()
+    cache = ResponseCache(path)
+    assert cache.size == 2 * size
+    cache.close()
+
+
+def test_shared_between_caches(tmp_path, host):
+    path = str(tmp_path / "cache.sqlite")
+    with Engine(cache=ResponseCache(path)) as engine:
+        engine.get("https://cached.test/a")
+    with Engine(cache=ResponseCache(path)) as engine:
+        response = engine.get("https://cached.test/a")
+    assert response.from_cache
+    assert isinstance(response, requests.Response)
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+from httmock import HTTMock, response, urlmatch
+
+from pogam import create_app, db
+from pogam.models import Image, ImageUrl, Listing, ListingImage
+from pogam.scrapers.engine import Engine
+from pogam.scrapers.images import ImageIndex, ImagePipeline
+from pogam.scrapers.retry import RetryPolicy
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def image_host():
+    calls = {"concurrent": 0, "max_concurrent": 0, "count": 0}
+    lock = threading.Lock()
+
+    @urlmatch(netloc=r"img\d.test")
+    def mock_response(url, request):
+        with lock:
+            calls["count"] += 1
+            calls["concurrent"] += 1
+            calls["max_concurrent"] = max(calls["max_concurrent"], calls["concurrent"])
+        # the first images are the slowest, so that they finish last
+        name, _ = os.path.splitext(os.path.basename(url.path))
+        time.sleep(0.05 / int(name))
+        with lock:
+            calls["concurrent"] -= 1
+        if name == "3":
+            return response(404, request=request)
+        # odd and even images have the same content
+        return response(200, f"image {int(name) % 2}".encode(), request=request)
+
+    with HTTMock(mock_response):
+        yield calls
+
+
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+def _path(content):
+    digest = hashlib.sha256(content).hexdigest()
+    return f"images/{digest[:2]}/{digest}.jpg"
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_image_pipeline(image_host, images_folder):
+    urls = [f"https://img{i % 2}.test/{i}.jpg" for i in range(1, 6)]
+    retry = RetryPolicy(2, base_delay=0)
+    with Engine(max_per_host=4) as engine, ImagePipeline(engine, retry) as images:
+        stored = images.fetch(urls, headers={}, proxies={}, timeout=1)
+
+    odd, even = _path(b"image 1"), _path(b"image 0")
+    assert [image and image["path"] for image in stored] == [
+        odd,
+        even,
+        None,
+        even,
+        odd,
+    ]
+    assert [image and image["url"] for image in stored if image] == [
+        urls[0],
+        urls[1],
+        urls[3],
+        urls[4],
+    ]
+    assert image_host["max_concurrent"] > 1
+    folder = os.environ["POGAM_IMAGES_FOLDER"]
+    assert sorted(os.listdir(os.path.join(folder, "images", odd[7:9]))) == [odd[10:]]
+    for image in filter(None, stored):
+        with open(os.path.join(folder, image["path"]), "rb") as f:
+            assert hashlib.sha256(f.read()).hexdigest() == image["hash"]
+
+
+def test_image_pipeline_known_urls(image_host, images_folder):
+    urls = [f"https://img0.test/{i}.jpg" for i in [1, 2]]
+    known = {
+        urls[0]: {"url": urls[0], "hash": "abc", "path": "images/ab/abc", "size": 3}
+    }
+    retry = RetryPolicy(2, base_delay=0)
+    with Engine() as engine, ImagePipeline(engine, retry) as images:
+        stored = images.fetch(urls, headers={}, proxies={}, timeout=1, known=known)
+
+    assert stored[0] == known[urls[0]]
+    assert stored[1]["path"] == _path(b"image 0")
+    assert image_host["count"] == 1
+
+
+def test_image_index(app):
+    listing = Listing(source="test", url="https://listing.test", transaction="rent")
+    db.session.add(listing)
+    db.session.flush()
+    index = ImageIndex()
+    urls = ["https://img0.test/1.jpg", "https://img1.test/1.jpg"]
+    assert index.known(urls) == {}
+
+    image = {"url": urls[0], "hash": "a" * 64, "path": "images/aa/aaa.jpg", "size": 3}
+    same_image = {**image, "url": urls[1]}
+    index.add([image, None, same_image], listing)
+    db.session.commit()
+    assert Image.query.count() == 1
+    assert ImageUrl.query.count() == 2
+    assert [li.position for li in ListingImage.query.order_by("position")] == [0, 2]
+    assert index.known(urls + ["https://img2.test/1.jpg"]) == {
+        urls[0]: image,
+        urls[1]: same_image,
+    }
+
+    # recording the images again, e.g. for a duplicate listing, is a no-op
+    index.add([image, same_image])
+    db.session.commit()
+    assert Image.query.count() == 1
+    assert ImageUrl.query.count() == 2
+
+
+@pytest.mark.parametrize("content_length", [True, False])
+def test_image_pipeline_size_cap(images_folder, content_length):
+    @urlmatch(netloc=r"big.test")
+    def mock_response(url, request):
+        size = int(os.path.basename(url.path).split(".")[0])
+        headers = {"Content-Length": str(size)} if content_length else {}
+        return response(200, b"x" * size, headers=headers, request=request)
+
+    urls = [f"https://big.test/{size}.jpg" for size in [100, 200_000, 300_000]]
+    retry = RetryPolicy(2, base_delay=0)
+    with HTTMock(mock_response), Engine() as engine:
+        with ImagePipeline(engine, retry, max_image_size=250_000) as images:
+            stored = images.fetch(urls, headers={}, proxies={}, timeout=1)
+
+    assert [image and image["size"] for image in stored] == [100, 200_000, None]
+    assert images.bytes_stored == 200_100
+    if content_length:
+        assert images.bytes_downloaded == 200_100
+    else:
+        assert 200_100 + 250_000 < images.bytes_downloaded < 200_100 + 300_000
+    # nothing is left behind in the temporary folder
+    folder = os.environ["POGAM_IMAGES_FOLDER"]
+    assert os.listdir(os.path.join(folder, "tmp")) == []
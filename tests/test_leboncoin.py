@@ -1,3 +1,4 @@
+import importlib
 import json
 import logging
 import math
@@ -9,7 +10,17 @@ import requests
 from httmock import HTTMock, response, urlmatch
 
 from pogam import create_app
-from pogam.scrapers.leboncoin import leboncoin
+from pogam.models import ImageDownload, Listing
+from pogam.scrapers.exceptions import ListingParsingError
+from pogam.scrapers.leboncoin import (
+    _ingest_page,
+    _parse,
+    _records,
+    download_images,
+    leboncoin,
+    plan_shards,
+)
+from pogam.scrapers.variants import derive_variants
 
 here = os.path.dirname(__file__)
 root_folder = os.path.abspath(os.path.join(here, ".."))
@@ -19,6 +30,32 @@ fixtures_folder = os.path.join(root_folder, "tests", "fixtures", "leboncoin")
 # ------------------------------------------------------------------------------------ #
 #                                       Fixtures                                       #
 # ------------------------------------------------------------------------------------ #
+@pytest.fixture(autouse=True)
+def no_wait(monkeypatch):
+    # rate controllers and retry policies have their own tests;
+    # don't wait between mocked requests.
+    module = importlib.import_module("pogam.scrapers.leboncoin")
+    monkeypatch.setattr(module, "RATES", {})
+    for name in ["RETRY", "IMAGE_RETRY"]:
+        monkeypatch.setitem(getattr(module, name), "base_delay", 0)
+
+
+def _matches(payload, property_type, zipcode, price):
+    """Whether a listing is one of the results of a search."""
+    filters = payload["filters"]
+    band = filters["ranges"]["price"]
+    return (
+        # none of the listings have a size
+        (not filters["ranges"]["square"])
+        and (property_type in filters["enums"]["real_estate_type"])
+        and any(
+            location["zipcode"] == zipcode
+            for location in filters["location"]["locations"]
+        )
+        and (band.get("min", 0) <= price <= band.get("max", math.inf))
+    )
+
+
 @pytest.fixture
 def make_search_and_response(snapshot):
     def _make_search_and_response(name):
@@ -89,6 +126,62 @@ def mock_image():
     return mock_response
 
 
+@pytest.fixture
+def make_sharded_response(monkeypatch):
+    # shard searches of more than 30 listings, and serve the results 10 at a time
+    module = importlib.import_module("pogam.scrapers.leboncoin")
+    monkeypatch.setattr(module, "MAX_SHARD_RESULTS", 30)
+    page_length = 10
+
+    def _property_type(ad):
+        attributes = [a for a in ad["attributes"] if a["key"] == "real_estate_type"]
+        return attributes[0]["value"]
+
+    def _make_sharded_response(fail=None):
+        with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+            _response = json.load(f)["response"]
+        ads = _response.pop("ads")
+        _response.pop("pivot")
+        counts = []
+
+        @urlmatch(
+            netloc="api.leboncoin.fr", path="/api/adfinder/v1/search", method="post"
+        )
+        def mock_response(url, request):
+            payload = json.loads(request.body.decode("utf-8"))
+            results = [
+                ad
+                for ad in ads
+                if _matches(
+                    payload,
+                    _property_type(ad),
+                    ad["location"]["zipcode"],
+                    ad["price"][0],
+                )
+            ]
+            if payload["limit_alu"] == 0:
+                counts.append(len(results))
+                return response(
+                    200, dict(_response, total=len(results)), request=request
+                )
+            if (fail is not None) and fail(payload):
+                return response(200, "captcha")
+            pivot = payload["pivot"]
+            page = 0 if pivot == "0,0,0" else int(pivot)
+            content = dict(
+                _response,
+                ads=results[page * page_length : (page + 1) * page_length],
+                total=len(results),
+            )
+            if (page + 1) * page_length < len(results):
+                content["pivot"] = str(page + 1)
+            return response(200, content, request=request)
+
+        return mock_response, ads, counts
+
+    return _make_sharded_response
+
+
 # ------------------------------------------------------------------------------------ #
 #                                         Tests                                        #
 # ------------------------------------------------------------------------------------ #
@@ -178,3 +271,290 @@ def test_invalid_inputs(
         with app.app_context():
             with pytest.raises(exception, match=match):
                 leboncoin(**search)
+
+
+def test_incremental_scrape(mock_image, mock_proxies, in_memory_db, images_folder):
+    """
+    Scrapes of the same search stop at the ads the previous scrapes were done with.
+    """
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        _response = json.load(f)["response"]
+    ads = _response.pop("ads")
+    _response.pop("pivot")
+    page_length = 50
+    requests_ = []
+
+    @urlmatch(netloc="api.leboncoin.fr", path="/api/adfinder/v1/search", method="post")
+    def mock_response(url, request):
+        pivot = json.loads(request.body.decode("utf-8"))["pivot"]
+        page = 0 if pivot == "0,0,0" else int(pivot)
+        requests_.append(page)
+        content = dict(
+            _response, ads=ads[page * page_length : (page + 1) * page_length]
+        )
+        if (page + 1) * page_length < len(ads):
+            content["pivot"] = str(page + 1)
+        return response(200, content, request=request)
+
+    search = {"transaction": "rent", "post_codes": ["92130"], "max_duplicates": 500}
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        first = leboncoin(**search)
+        assert requests_ == [0, 1]
+        assert first["added"]
+
+        # a new ad was published since. The newest ad of the first scrape is
+        # malformed: it failed, and is retried.
+        assert first["failed"] == [ads[0]["url"]]
+        new_ad = dict(ads[2], list_id=1, index_date="2020-03-06 09:00:00")
+        new_ad["url"] = new_ad["url"].replace(str(ads[2]["list_id"]), "1")
+        ads.insert(0, new_ad)
+        second = leboncoin(**search)
+        assert requests_ == [0, 1, 0]
+        assert [listing.url for listing in second["added"]] == [new_ad["url"]]
+        assert second["failed"] == [ads[1]["url"]]
+        assert not second["seen"]
+
+        third = leboncoin(**search, incremental=False)
+        assert requests_ == [0, 1, 0, 0, 1]
+        assert not third["added"]
+
+
+def test_deferred_images(mock_proxies, in_memory_db, images_folder):
+    """
+    Listings are added without waiting for their images, which are downloaded later.
+    """
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        _response = json.load(f)["response"]
+    _response.pop("pivot")
+    _response["ads"] = _response["ads"][2:7]
+    image_requests = []
+
+    @urlmatch(netloc="api.leboncoin.fr", path="/api/adfinder/v1/search", method="post")
+    def mock_response(url, request):
+        return response(200, _response, request=request)
+
+    @urlmatch(netloc=r".*img.*.leboncoin.fr.*")
+    def mock_image(url, request):
+        image_requests.append(request.url)
+        with open(os.path.join(fixtures_folder, "img.jpg"), "rb") as f:
+            return response(200, f.read(), request=request)
+
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        results = leboncoin("rent", "92130", defer_images=True)
+        assert results["added"]
+        assert not image_requests
+        with_images = [listing for listing in results["added"] if listing.images_status]
+        assert with_images
+        for listing in with_images:
+            assert listing.images_status == "pending"
+            assert listing.images is None
+
+        num_images = ImageDownload.query.count()
+        downloaded = download_images(num_images=num_images - 1)
+        assert len(downloaded["downloaded"]) == num_images - 1
+        assert not downloaded["failed"]
+        assert [listing.images_status for listing in with_images].count("pending") == 1
+
+        downloaded = download_images()
+        assert len(downloaded["downloaded"]) == 1
+        assert len(image_requests) == num_images
+        for listing in with_images:
+            assert listing.images_status == "done"
+            assert (
+                len(listing.images)
+                == ImageDownload.query.filter_by(listing_id=listing.id).count()
+            )
+        assert download_images() == {"downloaded": [], "failed": []}
+
+
+def test_deferred_images_variants(mock_proxies, in_memory_db, images_folder):
+    """
+    Variants are derived once the deferred images are downloaded, not before.
+    """
+    pytest.importorskip("PIL")
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        _response = json.load(f)["response"]
+    _response.pop("pivot")
+    _response["ads"] = _response["ads"][2:4]
+
+    @urlmatch(netloc="api.leboncoin.fr", path="/api/adfinder/v1/search", method="post")
+    def mock_response(url, request):
+        return response(200, _response, request=request)
+
+    @urlmatch(netloc=r".*img.*.leboncoin.fr.*")
+    def mock_image(url, request):
+        with open(os.path.join(fixtures_folder, "img.jpg"), "rb") as f:
+            return response(200, f.read(), request=request)
+
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        results = leboncoin("rent", "92130", defer_images=True)
+        listings = [listing for listing in results["added"] if listing.images_status]
+        assert listings
+        assert derive_variants(max_workers=1)["processed"] == [
+            listing for listing in results["added"] if not listing.images_status
+        ]
+        for listing in listings:
+            assert listing.image_variants is None
+
+        download_images()
+        derived = derive_variants(max_workers=1)
+        assert derived == {"processed": listings, "failed": []}
+        folder = os.environ["POGAM_IMAGES_FOLDER"]
+        for listing in listings:
+            assert len(listing.image_variants) == len(listing.images)
+            for variants in listing.image_variants:
+                assert variants is not None
+                for path in variants.values():
+                    assert os.path.exists(os.path.join(folder, path))
+
+
+def test_parse_page():
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        ads = json.load(f)["response"]["ads"][:5]
+
+    columns, errors = _parse(ads)
+    assert all(len(column) == len(ads) for column in columns.values())
+    # the first ad has two property types, the second an ambiguous price
+    assert isinstance(errors[0], RuntimeError)
+    assert isinstance(errors[1], ListingParsingError)
+    assert columns["url"][:2] == [None, None]
+    assert columns["url"][2:] == [ad["url"] for ad in ads[2:]]
+    assert columns["external_listing_id"][2:] == [str(ad["list_id"]) for ad in ads[2:]]
+    assert all(
+        date.endswith("+00:00") for date in columns["first_publication_date"][2:]
+    )
+
+    records = _records(columns, errors)
+    assert records[:2] == [None, None]
+    assert all(record["source"] == "leboncoin" for record in records[2:])
+
+
+def test_ingest_page(in_memory_db):
+    with open(os.path.join(fixtures_folder, "success.json"), "r") as f:
+        ads = json.load(f)["response"]["ads"][2:5]
+    columns, errors = _parse(ads)
+    assert not errors
+    records = [dict(record, stored_images=[]) for record in _records(columns, errors)]
+    records[1]["property_type"] = None
+
+    app = create_app("cli")
+    with app.app_context():
+        outcomes = _ingest_page(records)
+        assert isinstance(outcomes[1], ValueError)
+        assert [outcome[1] for outcome in outcomes[::2]] == [True, True]
+        assert Listing.query.count() == 2
+
+
+def test_plan_shards():
+    listings = [
+        (property_type, zipcode, price)
+        for property_type in ["1", "2"]
+        for zipcode in ["92130", "75016"]
+        for price in range(400, 3000, 20)
+    ]
+    # a popular price
+    listings += [("2", "92130", 1500)] * 40
+    payload = {
+        "filters": {
+            "category": {"id": "10"},
+            "enums": {"ad_type": ["offer"], "real_estate_type": ["1", "2", "3"]},
+            "ranges": {"rooms": {}, "square": {}, "price": {}},
+            "location": {
+                "locations": [
+                    {"locationType": "city", "zipcode": zipcode}
+                    for zipcode in ["92130", "75016"]
+                ]
+            },
+        }
+    }
+
+    def count(payload):
+        return sum(_matches(payload, *listing) for listing in listings)
+
+    shards = plan_shards(payload, count, max_results=30)
+    assert all(total > 0 for _, total in shards)
+    # the popular price can't be split by price, and nothing has a size
+    ((popular, total),) = [shard for shard in shards if shard[1] > 30]
+    assert popular["filters"]["ranges"]["price"] == {"min": 1500, "max": 1500}
+    assert total == 41
+    # shards are disjoint and cover the whole search
+    assert sum(total for _, total in shards) == len(listings)
+    for listing in listings:
+        assert sum(_matches(payload, *listing) for payload, _ in shards) == 1
+    # none of the listings are of the third property type
+    assert all(
+        payload["filters"]["enums"]["real_estate_type"] != ["3"]
+        for payload, _ in shards
+    )
+
+
+def test_sharded_scrape(make_sharded_response, mock_image, mock_proxies, in_memory_db):
+    """
+    Large searches are split into shards, that together cover the whole search.
+    """
+    mock_response, ads, counts = make_sharded_response()
+    search = {"transaction": "rent", "post_codes": ["92130"], "max_duplicates": 500}
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        results = leboncoin(**search, shard=True)
+        # the whole search, apartments, houses, then apartments by price band
+        assert counts[:3] == [len(ads), len(ads), 0]
+        assert len(counts) > 3
+        urls = [
+            listing if isinstance(listing, str) else listing.url
+            for listing in results["added"] + results["seen"]
+        ] + results["failed"]
+        assert len(urls) == len(set(urls))
+        # malformed ads are neither added, seen nor failed
+        unsharded = leboncoin(**search, incremental=False)
+        assert not unsharded["added"]
+        assert len(unsharded["seen"]) + len(unsharded["failed"]) == len(urls)
+
+
+def test_sharded_scrape_num_results(
+    make_sharded_response, mock_image, mock_proxies, in_memory_db
+):
+    """
+    The maximum number of results applies to the whole search, not to each shard.
+    """
+    mock_response, _, _ = make_sharded_response()
+    search = {"transaction": "rent", "post_codes": ["92130"], "max_duplicates": 500}
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        results = leboncoin(**search, num_results=15, shard=True)
+        scraped = results["added"] + results["seen"] + results["failed"]
+        # we stop at the end of the page that goes over the limit
+        assert 15 < len(scraped) <= 15 + 10
+
+
+def test_sharded_scrape_failed_shard(
+    make_sharded_response, mock_image, mock_proxies, in_memory_db
+):
+    """
+    A shard we fail to scrape does not stop the other shards.
+    """
+
+    def _fail(payload):
+        # the most expensive listings
+        band = payload["filters"]["ranges"]["price"]
+        return ("min" in band) and ("max" not in band)
+
+    mock_response, _, _ = make_sharded_response(fail=_fail)
+    search = {"transaction": "rent", "post_codes": ["92130"], "max_duplicates": 500}
+    app = create_app("cli")
+    with HTTMock(mock_response, mock_image), app.app_context():
+        partial = leboncoin(**search, shard=True)
+        scraped = partial["added"] + partial["seen"] + partial["failed"]
+        assert scraped
+
+    mock_response, _, _ = make_sharded_response()
+    with HTTMock(mock_response, mock_image), app.app_context():
+        # the shards we gave up on are scraped in full the next time around
+        results = leboncoin(**search, shard=True)
+        assert results["added"]
+        assert len(scraped) < len(
+            results["added"] + results["seen"] + results["failed"]
+        )
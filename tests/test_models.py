@@ -0,0 +1,111 @@
+import pytest
+
+from pogam import create_app, db
+from pogam.models import Listing, Property
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+def _record(i, **overrides):
+    record = {
+        "source": "test",
+        "url": f"https://test.com/{i}",
+        "external_listing_id": str(i),
+        "transaction": "rent",
+        "price": 1000 + i,
+        "property_type": "apartment",
+        "city": "paris",
+    }
+    record.update(overrides)
+    return record
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_upsert(app):
+    outcomes = Listing.upsert([_record(1), _record(2)])
+    db.session.commit()
+    assert [is_new for _, is_new in outcomes] == [True, True]
+    listing = outcomes[0][0]
+    assert listing.price == 1001
+    assert listing.currency == "€"
+    assert listing.created_at is not None
+    assert listing.property_.city.name == "paris"
+    assert Listing.query.filter(Listing.images.is_(None)).count() == 2
+
+    outcomes = Listing.upsert(
+        [
+            # known by id, under a new url
+            _record(1, url="https://test.com/one"),
+            # known by url
+            _record(2, external_listing_id=None),
+            _record(3),
+            # twice in the same batch
+            _record(3),
+            # same id, from another source
+            _record(1, source="other", url="https://other.com/1"),
+        ]
+    )
+    db.session.commit()
+    assert [is_new for _, is_new in outcomes] == [False, False, True, False, True]
+    assert outcomes[0][0].url == "https://test.com/1"
+    # known by url, whatever the case of its host or its fragment
+    ((listing, is_new),) = Listing.upsert(
+        [_record(4, url="https://TEST.COM/2#photos", external_listing_id=None)]
+    )
+    assert not is_new
+    assert listing.external_listing_id == "2"
+    assert outcomes[1][0].external_listing_id == "2"
+    assert outcomes[2][0] is outcomes[3][0]
+    assert Listing.query.count() == 4
+    # only the new listings got a property
+    assert Property.query.count() == 4
+
+
+def test_upsert_update(app):
+    Listing.upsert([_record(1)])
+    db.session.commit()
+
+    ((listing, is_new),) = Listing.upsert(
+        [_record(1, price=900, description=None)], update=True
+    )
+    db.session.commit()
+    assert not is_new
+    assert listing.price == 900
+    assert Listing.query.one().price == 900
+
+
+def test_upsert_requires_fields(app):
+    with pytest.raises(ValueError, match="url"):
+        Listing.upsert([_record(1, url=None)])
+
+
+@pytest.mark.parametrize(
+    "url, other, same",
+    [
+        ("https://test.com/1", "HTTPS://Test.com:443/1#photos", True),
+        ("http://test.com/1", "http://test.com:80/1", True),
+        ("https://test.com/1", "https://test.com:8443/1", False),
+        ("https://test.com/1", "https://test.com/1?page=2", False),
+        ("https://test.com/a", "https://test.com/A", False),
+    ],
+)
+def test_hash_url(url, other, same):
+    assert len(Listing.hash_url(url)) == 32
+    assert (Listing.hash_url(url) == Listing.hash_url(other)) is same
+
+
+def test_url_hash_is_kept_in_sync(app):
+    listing = Listing(source="test", url="https://test.com/1", transaction="rent")
+    assert listing.url_hash == Listing.hash_url("https://test.com/1")
+    listing.url = "https://test.com/2"
+    assert listing.url_hash == Listing.hash_url("https://test.com/2")
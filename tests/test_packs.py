@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pogam import create_app, db
+from pogam.models import Image, ImageUrl, Listing
+from pogam.scrapers.images import ImageStore
+from pogam.scrapers.packs import PackStore, compact_images
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def store(tmp_path):
+    store = PackStore(str(tmp_path / "packs"), max_segment_size=100)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_default(images_folder, monkeypatch):
+    assert type(ImageStore.default()) is ImageStore
+    monkeypatch.setenv("POGAM_IMAGES_BACKEND", "pack")
+    store = ImageStore.default()
+    assert isinstance(store, PackStore)
+    assert store.folder == os.path.join(os.environ["POGAM_IMAGES_FOLDER"], "packs")
+    store.close()
+
+
+def test_pack_store(store):
+    assert not store.exists("a")
+    with pytest.raises(FileNotFoundError):
+        store.read("a")
+
+    store.write("a", b"a" * 60)
+    store.write("b", b"b" * 60)
+    with store.spool() as f:
+        f.write(b"c" * 30)
+        store.put(f, "c")
+    assert store.read("a") == b"a" * 60
+    assert store.read("b") == b"b" * 60
+    assert store.read("c") == b"c" * 30
+    # segments roll over once they are full
+    assert store.segments() == [1, 2]
+
+    # the reader remaps segments that grew
+    store.write("d", b"d" * 10)
+    assert store.read("d") == b"d" * 10
+
+    # stored by another process, e.g. a worker deriving variants
+    other = PackStore(store.folder, max_segment_size=100)
+    other.write("e", b"e")
+    other.close()
+    assert store.read("e") == b"e"
+    assert sorted(store.keys()) == ["a", "b", "c", "d", "e"]
+
+
+def test_pack_store_threads(store):
+    keys = [str(i) for i in range(50)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda key: store.write(key, key.encode() * 10), keys))
+        contents = list(executor.map(store.read, keys))
+    assert contents == [key.encode() * 10 for key in keys]
+
+
+def test_compact(store):
+    for key in "abcd":
+        store.write(key, key.encode() * 40)
+    store.write("a", b"A" * 40)
+    store.delete("c")
+    assert store.segments() == [1, 2]
+
+    reclaimed = store.compact(keep=["a", "b", "c"])
+    # the first a, c and d
+    assert reclaimed == 3 * 40
+    assert sorted(store.keys()) == ["a", "b"]
+    assert store.read("a") == b"A" * 40
+    assert store.read("b") == b"b" * 40
+    assert store.segments() == [3]
+
+    # nothing left to reclaim
+    assert store.compact() == 0
+    assert store.segments() == [3]
+
+
+def test_compact_never_reuses_segments(store):
+    store.write("a", b"a" * 40)
+    store.delete("a")
+    store.compact()
+    assert store.segments() == []
+
+    # another process may still have segment 1 mapped
+    store.write("b", b"b" * 100)
+    assert store.segments() == [2]
+    other = PackStore(store.folder, max_segment_size=100)
+    other.write("c", b"c" * 40)
+    other.close()
+    assert store.segments() == [2, 3]
+
+
+def test_compact_candidates(store):
+    for key in "abc":
+        store.write(key, key.encode() * 10)
+    # c was stored after we decided what to keep
+    store.compact(keep=["a"], candidates=["a", "b"])
+    assert sorted(store.keys()) == ["a", "c"]
+    assert store.read("c") == b"c" * 10
+
+
+def test_compact_images(app, store):
+    for key in ["a.jpg", "a.thumb.webp", "b.jpg", "c.jpg"]:
+        store.write(key, b"x" * 10)
+    db.session.add_all(
+        [
+            Listing(
+                source="test",
+                url="https://a.test",
+                transaction="rent",
+                images=["a.jpg"],
+                image_variants=[{"thumbnail": "a.thumb.webp"}],
+            ),
+            Image(hash="a", path="a.jpg", size=10),
+            Image(hash="b", path="b.jpg", size=10),
+        ]
+    )
+    db.session.flush()
+    db.session.add(ImageUrl(url_hash="b", url="https://b.test/b.jpg", image_id=2))
+    db.session.commit()
+
+    assert compact_images(store) == {"deleted": 2, "reclaimed": 20}
+    assert sorted(store.keys()) == ["a.jpg", "a.thumb.webp"]
+    assert [image.path for image in Image.query] == ["a.jpg"]
+    assert ImageUrl.query.count() == 0
+
+
+def test_compact_images_requires_packs(app, images_folder):
+    with pytest.raises(RuntimeError, match="pack"):
+        compact_images()
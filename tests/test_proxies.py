@@ -1,13 +1,23 @@
+import collections
 import contextlib
+import http.server
 import itertools as it
 import os
+import random
 import re
+import socket
+import threading
+import time
 import warnings
+from unittest import mock
 
 import pytest
+import requests
 from httmock import HTTMock, all_requests, response, urlmatch
 
+from pogam import create_app
 from pogam.scrapers import proxies
+from pogam.scrapers.engine import Engine
 
 # modified version of https://www.regular-expressions.info/ip.html
 is_ip_address = re.compile(
@@ -102,6 +112,65 @@ def mock_proxies(mock_proxylist, mock_proxy11):
     return [mock_proxylist, mock_proxy11]
 
 
+@pytest.fixture
+def local_proxies():
+    """
+    Stand-ins for proxies, on localhost: a fast one, a slow one, a broken one and a
+    dead one.
+    """
+
+    def _make_handler(delay, status_code):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(delay)
+                self.send_response(status_code)
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    servers = {}
+    for name, delay, status_code in [
+        ("fast", 0, 200),
+        ("slow", 0.2, 200),
+        ("broken", 0, 502),
+    ]:
+        server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), _make_handler(delay, status_code)
+        )
+        threading.Thread(
+            target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        ).start()
+        servers[name] = server
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead_port = s.getsockname()[1]
+
+    urls = {
+        name: f"http://127.0.0.1:{s.server_address[1]}" for name, s in servers.items()
+    }
+    urls["dead"] = f"http://127.0.0.1:{dead_port}"
+    yield urls
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def clock():
+    class Clock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    return Clock()
+
+
 @pytest.fixture(
     params=[
         ("proxylist", {}),
@@ -221,3 +290,164 @@ def test_all_proxies_missing_proxy11_api_key(no_proxy11_api_key, mock_proxies):
             stack.enter_context(HTTMock(mock_proxy["response"](proxy_is_down=False)))
         proxy_pool = proxies.all_proxies(infinite=False)
     assert all([re.match(is_ip_address, proxy) for proxy in proxy_pool])
+
+
+def test_pool_favors_healthy_proxies():
+    pool = proxies.ProxyPool(["good", "slow", "captcha"], rng=random.Random(0))
+    for _ in range(10):
+        pool.report("good", ok=True, latency=0.2)
+        pool.report("slow", ok=True, latency=5)
+        pool.report("captcha", ok=True, latency=0.2)
+        pool.report("captcha", ok=False, captcha=True)
+    assert pool.score("good") > pool.score("captcha") > pool.score("slow")
+    counts = collections.Counter(next(pool) for _ in range(1_000))
+    assert counts["good"] > counts["captcha"] > counts["slow"] > 0
+
+
+def test_pool_quarantine(clock):
+    pool = proxies.ProxyPool(["good", "dead"], threshold=2, quarantine=10, clock=clock)
+    for _ in range(2):
+        pool.report("dead", ok=False)
+    assert pool.is_quarantined("dead")
+    assert {pool.get() for _ in range(100)} == {"good"}
+
+    # the cool-down doubles if the proxy fails again after its quarantine
+    clock.now = 10
+    assert not pool.is_quarantined("dead")
+    for _ in range(2):
+        pool.report("dead", ok=False)
+    clock.now = 29
+    assert pool.is_quarantined("dead")
+    clock.now = 30
+    assert not pool.is_quarantined("dead")
+
+    # when everything is in quarantine, we use what gets out the soonest
+    for _ in range(2):
+        pool.report("good", ok=False)
+        pool.report("dead", ok=False)
+    assert pool.get() == "good"
+
+
+def test_pool_sticky_sessions(clock):
+    pool = proxies.ProxyPool(["a", "b", "c"], threshold=1, clock=clock)
+    proxy = pool.get(session="search")
+    assert {pool.get(session="search") for _ in range(100)} == {proxy}
+    pool.report(proxy, ok=False)
+    assert pool.get(session="search") != proxy
+    pool.release("search")
+    assert "search" not in pool._sessions
+
+
+def test_pool_user_agents():
+    pool = proxies.ProxyPool(["a"])
+    assert pool.user_agent("a", lambda: "new") == "new"
+    pool.report("a", ok=True, user_agent="works")
+    pool.report("a", ok=False, captcha=True, user_agent="captcha")
+    assert pool.user_agent("a", lambda: "new") == "works"
+    pool.report("a", ok=False, captcha=True, user_agent="works")
+    assert pool.user_agent("a", lambda: "new") == "new"
+
+
+def test_empty_pool():
+    with pytest.raises(ValueError):
+        proxies.ProxyPool([])
+
+
+def test_engine_reports_to_pool():
+    @urlmatch(netloc="ok.test")
+    def mock_ok(url, request):
+        return {"status_code": 200, "content": "ok"}
+
+    @urlmatch(netloc="captcha.test")
+    def mock_captcha(url, request):
+        return {"status_code": 200, "content": "captcha"}
+
+    @urlmatch(netloc="down.test")
+    def mock_down(url, request):
+        raise requests.exceptions.ProxyError
+
+    pool = proxies.ProxyPool(["http://0.1.2.3:45"])
+    proxy = {"http": "http://0.1.2.3:45"}
+    headers = {"User-Agent": "agent"}
+    with HTTMock(mock_ok, mock_captcha, mock_down), Engine(proxy_pool=pool) as engine:
+        engine.get("http://ok.test/", proxies=proxy, headers=headers)
+        engine.get(
+            "http://captcha.test/",
+            proxies=proxy,
+            blocked=lambda response: "captcha" in response.text,
+        )
+        with pytest.raises(requests.exceptions.ProxyError):
+            engine.get("http://down.test/", proxies=proxy)
+        # requests that don't go through the proxy are not reported
+        engine.get("http://ok.test/")
+    stats = pool._stats["http://0.1.2.3:45"]
+    assert (stats.requests, stats.successes, stats.captchas) == (3, 1, 1)
+    assert stats.user_agents == {"agent": 1}
+
+
+@pytest.mark.parametrize("backend", ["file", "database"])
+def test_proxy_cache(
+    backend, tmp_path, in_memory_db, no_proxy11_api_key, mock_proxylist
+):
+    app = create_app()
+    mock_response = mock_proxylist["response"](proxy_is_down=False)
+    path = str(tmp_path / "cache.json")
+
+    def make_cache(ttl):
+        if backend == "file":
+            return proxies.FileProxyCache(path, ttl=ttl, validate=False)
+        return proxies.DatabaseProxyCache(ttl=ttl, validate=False)
+
+    calls = []
+    original_all_proxies = proxies.all_proxies
+
+    def _all_proxies(**kwargs):
+        calls.append(kwargs)
+        return original_all_proxies(**kwargs)
+
+    with app.app_context(), HTTMock(mock_response), mock.patch.object(
+        proxies, "all_proxies", _all_proxies
+    ):
+        cache = make_cache(ttl=60)
+        pool = cache.pool()
+        assert len(pool) == 13  # unique proxies
+        pool.report(pool.proxies[0], ok=True, latency=0.5)
+        cache.save(pool)
+
+        # a later scrape gets a warm pool, without going back to the providers
+        warm_pool = make_cache(ttl=60).pool()
+        assert len(calls) == 1
+        assert warm_pool.snapshot() == pool.snapshot()
+
+        # once the cache is stale, we fetch the lists again but keep the stats
+        stale_pool = make_cache(ttl=0).pool()
+        assert len(calls) == 2
+        assert stale_pool.snapshot() == pool.snapshot()
+
+
+def test_default_proxy_cache(monkeypatch):
+    monkeypatch.delenv("LAMBDA_TASK_ROOT", raising=False)
+    assert isinstance(proxies.ProxyCache.default(), proxies.FileProxyCache)
+    monkeypatch.setenv("LAMBDA_TASK_ROOT", "/var/task")
+    assert isinstance(proxies.ProxyCache.default(), proxies.DatabaseProxyCache)
+
+
+def test_validate_proxies(local_proxies):
+    candidates = [local_proxies[name] for name in ["dead", "slow", "broken", "fast"]]
+    validated = proxies.validate_proxies(
+        candidates + [None], check_url="http://check.test/", timeout=1
+    )
+    assert validated == [local_proxies["fast"], local_proxies["slow"], None]
+
+
+def test_all_proxies_validation(local_proxies, no_proxy11_api_key):
+    @urlmatch(netloc="www.proxy-list.download")
+    def mock_response(url, request):
+        content = "\n".join(p.replace("http://", "") for p in local_proxies.values())
+        return response(200, content=content, headers={"Content-Type": "text/plain"})
+
+    with HTTMock(mock_response):
+        pool = proxies.all_proxies(
+            infinite=False, validate=True, check_url="http://check.test/", timeout=1
+        )
+    assert pool == [local_proxies["fast"], local_proxies["slow"]]
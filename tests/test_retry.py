@@ -0,0 +1,98 @@
+import pytest
+import requests
+from httmock import HTTMock, urlmatch
+
+from pogam.scrapers import exceptions
+from pogam.scrapers.engine import Engine
+from pogam.scrapers.retry import CircuitBreaker, RetryBudget, RetryPolicy
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def clock():
+    class Clock:
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    return Clock()
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_retry_budget():
+    budget = RetryBudget(3)
+    assert budget.spend(2)
+    assert not budget.spend(2)
+    assert budget.remaining == 1
+    assert budget.spend()
+    assert not budget.spend()
+    assert RetryBudget(None).spend(1_000_000)
+
+
+def test_exponential_backoff():
+    slept = []
+    policy = RetryPolicy(5, base_delay=1, max_delay=5, jitter=False, sleep=slept.append)
+    assert list(policy.attempts()) == [0, 1, 2, 3, 4]
+    assert slept == [1, 2, 4, 5]
+
+
+def test_jitter():
+    policy = RetryPolicy(5, base_delay=1, max_delay=5)
+    assert all(0 <= policy.delay(3) <= 4 for _ in range(100))
+
+
+def test_policies_share_budget():
+    budget = RetryBudget(3)
+    policies = [RetryPolicy(3, budget=budget, sleep=lambda _: None) for _ in range(2)]
+    attempts = [list(policy.attempts()) for policy in policies]
+    assert attempts == [[0, 1, 2], [0, 1]]
+
+
+def test_circuit_breaker(clock):
+    breaker = CircuitBreaker(2, cooldown=10, max_cooldown=15, clock=clock)
+    breaker.failure("proxy")
+    assert not breaker.is_open("proxy")
+    breaker.failure("proxy")
+    assert breaker.is_open("proxy")
+    assert not breaker.is_open("other proxy")
+
+    # a single failure after the cool-down trips the circuit again, for longer
+    clock.now = 10
+    assert not breaker.is_open("proxy")
+    breaker.failure("proxy")
+    clock.now = 24
+    assert breaker.is_open("proxy")
+    clock.now = 25
+    assert not breaker.is_open("proxy")
+
+    # a success closes the circuit for good
+    breaker.success("proxy")
+    breaker.failure("proxy")
+    assert not breaker.is_open("proxy")
+
+
+def test_engine_trips_proxy_circuit():
+    calls = []
+
+    @urlmatch(netloc="flaky.test")
+    def mock_response(url, request):
+        calls.append(url)
+        raise requests.exceptions.ProxyError
+
+    proxies = {"https": "http://0.1.2.3:45"}
+    with HTTMock(mock_response), Engine(breakers=CircuitBreaker(3)) as engine:
+        for _ in range(3):
+            with pytest.raises(requests.exceptions.ProxyError):
+                engine.get("https://flaky.test/", proxies=proxies)
+        with pytest.raises(exceptions.CircuitOpen):
+            engine.get("https://flaky.test/", proxies=proxies)
+        # the host itself is fine
+        with pytest.raises(requests.exceptions.ProxyError):
+            engine.get("https://flaky.test/")
+    assert len(calls) == 4
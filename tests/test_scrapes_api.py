@@ -1,14 +1,68 @@
+import importlib.util
 import logging
+import os
 import re
 
 import pytest
 from click.testing import CliRunner
 
+from pogam import scrapers
 from pogam.cli import cli
 
+here = os.path.dirname(__file__)
+root_folder = os.path.abspath(os.path.join(here, ".."))
 logger = logging.getLogger("pogam-tests")
 
 
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def handlers(monkeypatch):
+    path = os.path.join(root_folder, "app", "scrapes-api", "handlers.py")
+    spec = importlib.util.spec_from_file_location("scrapes_api_handlers", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    class _Client(object):
+        def publish(self, **kwargs):
+            return {}
+
+    monkeypatch.setattr(module.boto3, "client", lambda *args, **kwargs: _Client())
+    return module
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("leboncoin", {"shard": True, "defer_images": True}),
+        ("seloger", {"lite": True}),
+    ],
+)
+def test_run_source_options(source, expected, handlers, monkeypatch, in_memory_db):
+    calls = []
+
+    def scraper(transaction, post_codes, **kwargs):
+        calls.append(kwargs)
+        return {"added": [], "seen": [], "failed": []}
+
+    monkeypatch.setattr(scrapers, source, scraper)
+    search = {
+        "transaction": "rent",
+        "post_codes": ["92130"],
+        "sources": [source],
+        "min_size": 30,
+        "shard": True,
+        "defer_images": True,
+        "lite": True,
+    }
+    handlers.run({"search": search}, None)
+    assert calls == [dict(expected, min_size=30)]
+
+
 @pytest.mark.aws
 @pytest.mark.parametrize(
     "transaction, post_codes, min_size, max_size, logged_in",
@@ -7,7 +7,14 @@ from requests.compat import urlparse
 
 from pogam import create_app
 from pogam.scrapers import exceptions
-from pogam.scrapers.seloger import _seloger, _to_seloger_geographical_code
+from pogam.scrapers.engine import Engine
+from pogam.scrapers.seloger import (
+    _ingest,
+    _scrape,
+    _seloger,
+    _to_seloger_geographical_code,
+    enrich,
+)
 
 here = os.path.dirname(__file__)
 root_folder = os.path.abspath(os.path.join(here, ".."))
@@ -105,6 +112,42 @@ def test_known_single_listing(
                 _seloger(url, headers=headers)
 
 
+def test_lite_scrape_and_enrich(
+    make_response, mock_details_page, mock_proxies, in_memory_db
+):
+    """
+    Lite scrapes skip the listing's details, which are added by `enrich`.
+    """
+    url = "https://seloger-success.test"
+    details_requests = []
+
+    @urlmatch(netloc="www.seloger.com", path="/detail,json,caracteristique_bien.json")
+    def count_details_requests(url, request):
+        details_requests.append(url)
+
+    app = create_app()
+    with app.app_context():
+        with HTTMock(make_response("success", url), count_details_requests):
+            with Engine(max_workers=1) as engine:
+                listing, is_new = _ingest(_scrape(url, engine=engine, lite=True))
+        assert is_new
+        assert listing.is_partial
+        assert listing.property_.has_cellar is None
+        assert not details_requests
+
+        with HTTMock(count_details_requests, mock_details_page):
+            results = enrich()
+        assert [listing.id for listing in results["enriched"]] == [listing.id]
+        assert not results["failed"]
+        assert len(details_requests) == 1
+        assert listing.is_partial is False
+        assert listing.property_.has_cellar is not None
+
+        # nothing left to enrich
+        assert enrich() == {"enriched": [], "failed": []}
+        assert len(details_requests) == 1
+
+
 @pytest.mark.parametrize(
     "post_code,seloger_code",
     [
@@ -0,0 +1,84 @@
+import pytest
+
+from pogam.scrapers.throttle import RateController, Throttle
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def clock():
+    class Clock:
+        def __init__(self):
+            self.now = 0.0
+            self.slept = []
+
+        def __call__(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+
+    return Clock()
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_token_bucket(clock):
+    controller = RateController(
+        2, min_rate=1, max_rate=4, clock=clock, sleep=clock.sleep
+    )
+    waits = [controller.acquire() for _ in range(3)]
+    assert waits == [0, 0.5, 0.5]
+    assert clock.now == 1
+
+
+def test_tokens_accumulate_up_to_burst(clock):
+    controller = RateController(
+        1, min_rate=1, max_rate=4, burst=2, clock=clock, sleep=clock.sleep
+    )
+    controller.acquire()
+    clock.now += 10
+    waits = [controller.acquire() for _ in range(3)]
+    assert waits == [0, 0, 1]
+
+
+def test_aimd(clock):
+    controller = RateController(
+        2, min_rate=1, max_rate=4, increase=0.5, clock=clock, sleep=clock.sleep
+    )
+    controller.success()
+    assert controller.rate == 2.5
+    controller.failure()
+    assert controller.rate == 1.25
+    controller.failure()
+    assert controller.rate == 1
+    for _ in range(10):
+        controller.success()
+    assert controller.rate == 4
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"rate": 0, "min_rate": 0, "max_rate": 1},
+        {"rate": 2, "min_rate": 1, "max_rate": 1},
+        {"rate": 1, "min_rate": 1, "max_rate": 1, "decrease": 1},
+    ],
+)
+def test_invalid_parameters(kwargs):
+    with pytest.raises(ValueError):
+        RateController(**kwargs)
+
+
+def test_throttle_per_host():
+    throttle = Throttle({"www.seloger.com": {"rate": 2, "min_rate": 1, "max_rate": 4}})
+    assert throttle.controller("https://www.seloger.com/list.html") is not None
+    assert throttle.controller("https://www.leboncoin.fr/") is None
+    throttle.failure("https://www.seloger.com/list.html")
+    assert throttle.controller("https://www.seloger.com/").rate == 1
+    # hosts without a controller are left alone
+    throttle.acquire("https://www.leboncoin.fr/")
+    throttle.failure("https://www.leboncoin.fr/")
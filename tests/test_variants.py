@@ -0,0 +1,78 @@
+import io
+import os
+
+import pytest
+
+from pogam import create_app, db
+from pogam.models import Listing
+from pogam.scrapers.variants import derive_variants, transcode, variant_path
+
+PILImage = pytest.importorskip("PIL.Image")
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+def _jpeg(width, height):
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (width, height), color=(200, 30, 30)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_variant_path():
+    assert variant_path("images/ab/abc.jpg", "thumbnail") == "images/ab/abc.thumb.webp"
+    assert variant_path("images/ab/abc.jpg", "webp") == "images/ab/abc.webp"
+
+
+def test_transcode():
+    variants = transcode(_jpeg(1200, 800))
+    with PILImage.open(io.BytesIO(variants["thumbnail"])) as thumbnail:
+        assert thumbnail.format == "WEBP"
+        assert thumbnail.size == (320, 213)
+    with PILImage.open(io.BytesIO(variants["webp"])) as webp:
+        assert webp.format == "WEBP"
+        assert webp.size == (1200, 800)
+
+
+def test_derive_variants(app, images_folder):
+    folder = os.environ["POGAM_IMAGES_FOLDER"]
+    paths = ["images/aa/a.jpg", "images/bb/b.jpg", "images/cc/missing.jpg"]
+    for path, content in zip(paths[:2], [_jpeg(640, 480), b"not an image"]):
+        os.makedirs(os.path.join(folder, os.path.dirname(path)))
+        with open(os.path.join(folder, path), "wb") as f:
+            f.write(content)
+    listings = [
+        Listing(source="test", url="https://a.test", transaction="rent", images=paths),
+        # sharing an image with the first listing
+        Listing(
+            source="test", url="https://b.test", transaction="rent", images=paths[:1]
+        ),
+        Listing(source="test", url="https://c.test", transaction="rent"),
+    ]
+    db.session.add_all(listings)
+    db.session.commit()
+
+    results = derive_variants(max_workers=2)
+    assert results == {"processed": listings, "failed": []}
+    expected = {
+        "thumbnail": "images/aa/a.thumb.webp",
+        "webp": "images/aa/a.webp",
+    }
+    assert listings[0].image_variants == [expected, None, None]
+    assert listings[1].image_variants == [expected]
+    assert listings[2].image_variants == []
+    for path in expected.values():
+        assert os.path.exists(os.path.join(folder, path))
+
+    # listings are only processed once
+    assert derive_variants() == {"processed": [], "failed": []}
@@ -0,0 +1,53 @@
+import pytest
+
+from pogam import create_app
+from pogam.models import Watermark
+from pogam.scrapers.watermarks import SearchWatermark, search_key
+
+
+# ------------------------------------------------------------------------------------ #
+#                                       Fixtures                                       #
+# ------------------------------------------------------------------------------------ #
+@pytest.fixture
+def app(in_memory_db):
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+# ------------------------------------------------------------------------------------ #
+#                                         Tests                                        #
+# ------------------------------------------------------------------------------------ #
+def test_search_key():
+    search = {"codes": ["75", "92"], "filters": {"rooms": {"min": 1, "max": 3}}}
+    same_search = {"filters": {"rooms": {"max": 3, "min": 1}}, "codes": ["92", "75"]}
+    other_search = {"codes": ["75"], "filters": {"rooms": {"min": 1, "max": 3}}}
+    assert search_key(search) == search_key(same_search)
+    assert search_key(search) != search_key(other_search)
+
+
+def test_watermark(app):
+    watermark = SearchWatermark("test", {"a": 1})
+    assert watermark.value is None
+    assert not watermark.passed("2020-01-01")
+    watermark.save()
+    assert Watermark.query.count() == 0
+
+    for key in ["2020-01-03", "2020-01-02", None]:
+        watermark.seen(key)
+    watermark.save()
+    assert watermark.value == "2020-01-03"
+
+    watermark = SearchWatermark("test", {"a": 1})
+    assert watermark.value == "2020-01-03"
+    assert not watermark.passed("2020-01-03")
+    assert watermark.passed("2020-01-02")
+    assert SearchWatermark("test", {"a": 2}).value is None
+    assert SearchWatermark("other", {"a": 1}).value is None
+
+    # results we failed to scrape hold the watermark back
+    watermark.seen("2020-01-05")
+    watermark.failed("2020-01-04")
+    watermark.save()
+    assert watermark.value == "2020-01-04"
+    assert Watermark.query.one().value == "2020-01-04"